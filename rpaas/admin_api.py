@@ -2,7 +2,9 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
 import json
+import bson
 from bson import json_util
 
 from flask import request, Response
@@ -10,13 +12,39 @@ from flask import request, Response
 from rpaas import auth, get_manager, storage, plan, flavor
 
 
+HEALING_TIME_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S")
+
+
+def _healing_time(value):
+    for time_format in HEALING_TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+
 @auth.required
 def healings():
     manager = get_manager()
     quantity = request.args.get("quantity", type=int)
     if quantity is None or quantity <= 0:
         quantity = 20
-    healing_list = manager.storage.list_healings(quantity)
+    filters = {}
+    for field in ("instance", "machine", "status"):
+        if request.args.get(field):
+            filters[field] = request.args[field]
+    for field in ("since", "until", "before"):
+        if request.args.get(field):
+            try:
+                filters[field] = _healing_time(request.args[field])
+            except ValueError:
+                return "invalid {} time, use YYYY-MM-DDTHH:MM:SS".format(field), 400
+    if request.args.get("before_id"):
+        if not bson.ObjectId.is_valid(request.args["before_id"]):
+            return "invalid before_id", 400
+        filters["before_id"] = bson.ObjectId(request.args["before_id"])
+    healing_list = manager.storage.list_healings(quantity, **filters)
     return json.dumps(healing_list, default=json_util.default)
 
 
@@ -142,8 +170,47 @@ def restore_instance():
     instance_name = request.form.get("instance_name")
     if not instance_name:
         return "instance name required", 400
+    max_unavailable = request.form.get("max_unavailable")
+    if max_unavailable is not None:
+        try:
+            max_unavailable = int(max_unavailable)
+            if max_unavailable < 1:
+                raise ValueError()
+        except ValueError:
+            return "max_unavailable must be an integer value greather than 0", 400
+    manager = get_manager()
+    return Response(manager.restore_instance(instance_name, max_unavailable), content_type='event/stream')
+
+
+@auth.required
+def list_indexes():
+    manager = get_manager()
+    return json.dumps(manager.storage.index_report())
+
+
+@auth.required
+def ensure_indexes():
+    manager = get_manager()
+    manager.storage.ensure_indexes()
+    return json.dumps(manager.storage.index_report())
+
+
+@auth.required
+def expiring_certificates():
+    manager = get_manager()
+    days = request.args.get("days", "30")
+    if not days.isdigit():
+        return "invalid days, use a non-negative integer", 400
+    days = int(days)
+    until = datetime.datetime.utcnow() + datetime.timedelta(days=days)
+    certificates = list(manager.storage.find_expiring_certificates(until))
+    return json.dumps(certificates, default=json_util.default)
+
+
+@auth.required
+def sync_certificates():
     manager = get_manager()
-    return Response(manager.restore_instance(instance_name), content_type='event/stream')
+    return json.dumps({"synced": manager.sync_certificates_expiry()})
 
 
 def register_views(app, list_plans, list_flavors):
@@ -175,3 +242,11 @@ def register_views(app, list_plans, list_flavors):
                      view_func=set_team_quota)
     app.add_url_rule("/admin/restore", methods=["POST"],
                      view_func=restore_instance)
+    app.add_url_rule("/admin/indexes", methods=["GET"],
+                     view_func=list_indexes)
+    app.add_url_rule("/admin/indexes", methods=["POST"],
+                     view_func=ensure_indexes)
+    app.add_url_rule("/admin/certificates", methods=["GET"],
+                     view_func=expiring_certificates)
+    app.add_url_rule("/admin/certificates", methods=["POST"],
+                     view_func=sync_certificates)
@@ -262,9 +262,23 @@ def set_quota(args):
 def list_healings(args):
     parser = _base_args("list-healings")
     parser.add_argument("-n", "--quantity", default=20, required=False, type=int)
+    parser.add_argument("-i", "--instance", required=False)
+    parser.add_argument("-m", "--machine", required=False)
+    parser.add_argument("--status", required=False)
+    parser.add_argument("--since", required=False, help="YYYY-MM-DDTHH:MM:SS (UTC)")
+    parser.add_argument("--until", required=False, help="YYYY-MM-DDTHH:MM:SS (UTC)")
+    parser.add_argument("--before", required=False, help="pagination cursor")
+    parser.add_argument("--before-id", required=False, help="pagination cursor")
     parsed_args = parser.parse_args(args)
-    result = proxy_request(parsed_args.service, "/admin/healings?quantity=" + str(parsed_args.quantity),
-                           method="GET")
+    params = [("quantity", parsed_args.quantity)]
+    for field in ("instance", "machine", "status", "since", "until", "before", "before_id"):
+        if getattr(parsed_args, field):
+            params.append((field, getattr(parsed_args, field)))
+    # the callback is itself a query string value of the proxy url, so its
+    # separators and values must survive one extra round of unquoting
+    query = "%26".join("{}={}".format(field, urllib.quote(urllib.quote(str(value), safe=":"), safe=":"))
+                       for field, value in params)
+    result = proxy_request(parsed_args.service, "/admin/healings?" + query, method="GET")
     body = result.read().rstrip("\n")
     if result.getcode() != 200:
         sys.stderr.write("ERROR: " + body + "\n")
@@ -277,14 +291,23 @@ def list_healings(args):
         sys.exit(1)
     healings_table = DisplayTable(['Instance', 'Machine', 'Start Time', 'Duration', 'Status'])
     _render_healings_list(healings_table, healings_list)
+    if healings_list and len(healings_list) == parsed_args.quantity:
+        cursor = "--before {}".format(healings_list[-1]['start_time'].strftime("%Y-%m-%dT%H:%M:%S.%f"))
+        if healings_list[-1].get('_id'):
+            cursor += " --before-id {}".format(healings_list[-1]['_id'])
+        sys.stdout.write("More healings available, use {}\n".format(cursor))
 
 
 def restore_instance(args):
     parser = _base_args("restore-instance")
     parser.add_argument("-i", "--instance", required=True)
+    parser.add_argument("-m", "--max-unavailable", type=int, required=False)
     parsed_args = parser.parse_args(args)
+    body = {"instance_name": parsed_args.instance}
+    if parsed_args.max_unavailable:
+        body["max_unavailable"] = parsed_args.max_unavailable
     result = proxy_request(parsed_args.service, "/admin/restore", method="POST",
-                           body=urllib.urlencode({"instance_name": parsed_args.instance}),
+                           body=urllib.urlencode(body),
                            headers={"Content-Type": "application/x-www-form-urlencoded"})
     if result.getcode() == 200:
         for msg in parser_result(result):
@@ -295,6 +318,48 @@ def restore_instance(args):
         sys.exit(1)
 
 
+def indexes(args):
+    parser = _base_args("indexes")
+    parser.add_argument("--ensure", action="store_true", default=False)
+    parsed_args = parser.parse_args(args)
+    method = "POST" if parsed_args.ensure else "GET"
+    result = proxy_request(parsed_args.service, "/admin/indexes", method=method)
+    body = result.read().rstrip("\n")
+    if result.getcode() != 200:
+        sys.stderr.write("ERROR: " + body + "\n")
+        sys.exit(1)
+    indexes_table = DisplayTable(['Collection', 'Query', 'Indexed', 'Plan'])
+    for query in json.loads(body):
+        indexes_table.add_row(query['collection'], query['query'], "yes" if query['indexed'] else "no",
+                              ", ".join(query['indexes']) or "COLLSCAN")
+    indexes_table.display()
+
+
+def expiring_certificates(args):
+    parser = _base_args("expiring-certificates")
+    parser.add_argument("-d", "--days", type=int, default=30)
+    parser.add_argument("--sync", action="store_true", default=False)
+    parsed_args = parser.parse_args(args)
+    if parsed_args.sync:
+        result = proxy_request(parsed_args.service, "/admin/certificates", method="POST")
+        body = result.read().rstrip("\n")
+        if result.getcode() != 200:
+            sys.stderr.write("ERROR: " + body + "\n")
+            sys.exit(1)
+        sys.stdout.write("Synced expiry of {} certificates\n".format(json.loads(body)["synced"]))
+    result = proxy_request(parsed_args.service, "/admin/certificates?days={}".format(parsed_args.days),
+                           method="GET")
+    body = result.read().rstrip("\n")
+    if result.getcode() != 200:
+        sys.stderr.write("ERROR: " + body + "\n")
+        sys.exit(1)
+    certificates_table = DisplayTable(['Instance', 'Domain', 'Source', 'Expires'])
+    for certificate in json.loads(body, object_hook=json_util.object_hook):
+        certificates_table.add_row(certificate['instance'], certificate.get('domain'), certificate.get('source'),
+                                   certificate['expires'].strftime("%Y-%m-%d %H:%M:%S"))
+    certificates_table.display()
+
+
 def parser_result(fileobj, buffersize=1):
     for chunk in iter(partial(fileobj.read, buffersize), ''):
         yield chunk
@@ -326,7 +391,9 @@ def available_commands():
         "show-quota": show_quota,
         "set-quota": set_quota,
         "list-healings": list_healings,
-        "restore-instance": restore_instance
+        "restore-instance": restore_instance,
+        "indexes": indexes,
+        "expiring-certificates": expiring_certificates
     }
 
 
@@ -12,8 +12,8 @@ from flask import Flask, Response, request
 from raven.contrib.flask import Sentry
 import hm.log
 
-from rpaas import (admin_api, router_api, admin_plugin, auth, get_manager, manager,
-                   plugin, storage, tasks)
+from rpaas import (admin_api, router_api, admin_plugin, auth, get_manager, keypool, manager,
+                   plugin, storage, tasks, instance_context)
 from rpaas.misc import (validate_name, validate_content, ValidationError, require_plan, check_option_enable)
 
 api = Flask(__name__)
@@ -28,6 +28,12 @@ else:
 api.logger.addHandler(handler)
 hm.log.set_handler(handler)
 
+if int(os.environ.get("KEY_POOL_SIZE", 0)) > 0:
+    keypool.get_pool()
+
+if check_option_enable(os.environ.get("RPAAS_ENSURE_INDEXES")):
+    get_manager().storage.ensure_indexes()
+
 if check_option_enable(os.environ.get("RUN_LE_RENEWER")):
     from rpaas.ssl_plugins import le_renewer
     le_renewer.LeRenewer().start()
@@ -42,7 +48,11 @@ if check_option_enable(os.environ.get("RUN_RESTORE_MACHINE")):
     RestoreMachine().start()
 
 if check_option_enable(os.environ.get("RUN_RESTORE_MACHINE")) and \
-   check_option_enable(os.environ.get("RUN_CHECK_MACHINE")):
+   check_option_enable(os.environ.get("RUN_HEALTH_WATCHER")):
+    from rpaas.healing import HealthWatcher
+    HealthWatcher().start()
+elif check_option_enable(os.environ.get("RUN_RESTORE_MACHINE")) and \
+        check_option_enable(os.environ.get("RUN_CHECK_MACHINE")):
     from rpaas.healing import CheckMachine
     CheckMachine().start()
 
@@ -51,6 +61,16 @@ if check_option_enable(os.environ.get("RUN_SESSION_RESUMPTION")):
     SessionResumption().start()
 
 
+@api.before_request
+def begin_instance_context():
+    instance_context.begin_request()
+
+
+@api.teardown_request
+def end_instance_context(exception=None):
+    instance_context.end_request()
+
+
 @api.route("/resources/plans", methods=["GET"])
 @api.route("/resources/<name>/plans", methods=["GET"])
 @auth.required
@@ -403,38 +423,62 @@ def purge_location(name):
     if not path:
         return 'missing required path', 400
     try:
-        instances_purged = get_manager().purge_location(name, path, preserve_path)
+        hosts = get_manager().purge_location_hosts(name, path, preserve_path)
     except storage.InstanceNotFoundError:
         return "Instance not found", 404
     except tasks.NotReadyError as e:
         return "Instance not ready: {}".format(e), 412
+    instances_purged = len([host for host in hosts.values() if host["purged"]])
+    if request.accept_mimetypes.best_match(["text/plain", "application/json"]) == "application/json":
+        return api.response_class(
+            response=json.dumps({"path": path, "instances_purged": instances_purged, "hosts": hosts}),
+            status=200,
+            mimetype='application/json'
+        )
     return "Path found and purged on {} servers".format(instances_purged), 200
 
 
 @api.route("/resources/<name>/purge/bulk", methods=["POST"])
 def purge_bulk_location(name):
     purges = request.get_json()
-    result = []
     if not purges or not isinstance(purges, list):
         return 'missing required list of purges', 400
-
     for purge in purges:
-        path = purge.get("path")
-        preserve_path = purge.get("preserve_path", False)
-        try:
-            instances_purged = get_manager().purge_location(name, path, preserve_path)
-            result.append({"path": path, "instances_purged": instances_purged})
-        except storage.InstanceNotFoundError:
-            return "Instance not found", 404
-        except tasks.NotReadyError as e:
-            return "Instance not ready: {}".format(e), 412
+        if not isinstance(purge, dict) or not purge.get("path"):
+            return 'missing required path', 400
+        if not isinstance(purge["path"], basestring):
+            return 'path must be a string', 400
+    try:
+        if check_option_enable(request.args.get("async")):
+            task_id = get_manager().purge_locations_async(name, purges)
+            return Response(response=json.dumps({"task_id": task_id}), status=202,
+                            mimetype="application/json")
+        results = get_manager().purge_locations(name, purges)
+    except storage.InstanceNotFoundError:
+        return "Instance not found", 404
+    except tasks.NotReadyError as e:
+        return "Instance not ready: {}".format(e), 412
 
-    response = api.response_class(
-        response=json.dumps(result),
-        status=200,
-        mimetype='application/json'
-    )
-    return response
+    def stream():
+        try:
+            yield "["
+            for index, result in enumerate(results):
+                if index > 0:
+                    yield ","
+                yield json.dumps(result)
+            yield "]"
+        finally:
+            results.close()
+    return Response(response=stream(), status=200, mimetype='application/json')
+
+
+@api.route("/resources/<name>/purge/bulk/<task_id>", methods=["GET"])
+def purge_bulk_location_result(name, task_id):
+    try:
+        result = get_manager().purge_locations_result(name, task_id)
+    except tasks.TaskNotFoundError:
+        return "Purge task not found", 404
+    return Response(response=json.dumps(result), status=200, mimetype="application/json")
 
 
 @api.route("/resources/<name>/ssl", methods=["POST"])
@@ -444,8 +488,9 @@ def add_https(name):
     if not domain:
         return "missing domain name", 400
     plugin = request.form.get('plugin', 'default')
+    key_types = request.form.get('key_types')
     try:
-        get_manager().activate_ssl(name, domain, plugin)
+        get_manager().activate_ssl(name, domain, plugin, key_types)
         return "", 200
     except storage.InstanceNotFoundError:
         return "Instance not found", 404
@@ -2,8 +2,13 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-import consul
+import base64
+import json
 import os
+import random
+import time
+
+import consul
 
 from . import nginx
 from misc import host_from_destination
@@ -21,6 +26,8 @@ service "nginx" {{
 }}
 """
 
+CERTIFICATE_ALGORITHMS = ("rsa", "ecdsa")
+
 
 class InstanceAlreadySwappedError(Exception):
     pass
@@ -30,6 +37,14 @@ class CertificateNotFoundError(Exception):
     pass
 
 
+class TransactionError(Exception):
+    pass
+
+
+class NodeNotHealthyError(Exception):
+    pass
+
+
 class ConsulManager(object):
 
     def __init__(self, config):
@@ -39,6 +54,9 @@ class ConsulManager(object):
         self.client = consul.Consul(host=host, port=port, token=token)
         self.config_manager = nginx.ConfigManager(config)
         self.service_name = config.get("RPAAS_SERVICE_NAME", "rpaas")
+        self.cas_retries = max(1, int(config.get("CONSUL_CAS_RETRIES", 10)))
+        self.cas_backoff = float(config.get("CONSUL_CAS_BACKOFF", 0.05))
+        self.cas_max_backoff = float(config.get("CONSUL_CAS_MAX_BACKOFF", 1))
 
     def generate_token(self, instance_name):
         rules = ACL_TEMPLATE.format(service_name=self.service_name,
@@ -62,20 +80,54 @@ class ConsulManager(object):
         _, instances = self.client.health.service("nginx", tag=self.service_name)
         return instances
 
+    def watch_service_health(self, index=None, wait=60):
+        index, instances = self.client.health.service("nginx", index=index, wait="{}s".format(int(wait)),
+                                                      tag=self.service_name)
+        return index, instances
+
+    def wait_healthy(self, host, timeout=600):
+        deadline = time.time() + timeout
+        index = None
+        while True:
+            index, instances = self.client.health.service("nginx", index=index, passing=True,
+                                                          tag=self.service_name,
+                                                          wait="{}s".format(int(max(1, deadline - time.time()))))
+            if self._has_node(instances, host):
+                return
+            if time.time() >= deadline:
+                raise NodeNotHealthyError("nginx on {} not healthy in consul after {}s".format(host, timeout))
+
+    def is_healthy(self, host):
+        _, instances = self.client.health.service("nginx", passing=True, tag=self.service_name)
+        return self._has_node(instances, host)
+
+    def _has_node(self, instances, host):
+        for instance in instances:
+            if instance["Node"]["Address"] == host:
+                return True
+        return False
+
     def list_node(self):
         _, nodes = self.client.catalog.nodes()
         return nodes
 
     def remove_node(self, instance_name, server_name, host_id):
-        self.client.kv.delete(self._server_status_key(instance_name, server_name))
-        self.client.kv.delete(self._ssl_cert_path(instance_name, "", host_id), recurse=True)
+        self._txn([("delete", self._server_status_key(instance_name, server_name)),
+                   ("delete-tree", self._ssl_cert_path(instance_name, "", host_id))])
         self.client.agent.force_leave(server_name)
 
     def node_hostname(self, host):
+        return self.node_hostnames([host]).get(host)
+
+    def node_hostnames(self, hosts):
+        hosts = set(hosts)
+        hostnames = {}
+        if not hosts:
+            return hostnames
         for node in self.list_node():
-            if node['Address'] == host:
-                return node['Node']
-        return None
+            if node['Address'] in hosts:
+                hostnames.setdefault(node['Address'], node['Node'])
+        return hostnames
 
     def node_status(self, instance_name):
         node_status = self.client.kv.get(self._server_status_key(instance_name), recurse=True)
@@ -88,6 +140,7 @@ class ConsulManager(object):
 
     def write_location(self, instance_name, path, destination=None, content=None, router_mode=False,
                        bind_mode=False, https_only=False):
+        upstream_server = None
         if content:
             content = content.strip()
         else:
@@ -98,8 +151,14 @@ class ConsulManager(object):
             content = self.config_manager.generate_host_config(path, destination, upstream, router_mode, https_only)
             if router_mode:
                 upstream_server = None
-            self.add_server_upstream(instance_name, upstream, upstream_server)
-        self.client.kv.put(self._location_key(instance_name, path), content)
+        location_operation = ("set", self._location_key(instance_name, path), content)
+
+        def operations():
+            if upstream_server is None:
+                return [location_operation]
+            return self._add_server_upstream_operations(instance_name, upstream, upstream_server) + \
+                [location_operation]
+        self._txn_with_retry(operations)
 
     def remove_location(self, instance_name, path):
         self.client.kv.delete(self._location_key(instance_name, path))
@@ -167,66 +226,71 @@ class ConsulManager(object):
     def add_server_upstream(self, instance_name, upstream_name, server):
         if not server:
             return
-        servers = self.list_upstream(instance_name, upstream_name)
-        if isinstance(server, list):
-            for idx, _ in enumerate(server):
-                server[idx] = ":".join(map(str, filter(None, host_from_destination(server[idx]))))
-            servers |= set(server)
-        else:
-            server = ":".join(map(str, filter(None, host_from_destination(server))))
-            servers.add(server)
-        self._save_upstream(instance_name, upstream_name, servers)
+        self._txn_with_retry(lambda: self._add_server_upstream_operations(instance_name, upstream_name, server))
+
+    def _add_server_upstream_operations(self, instance_name, upstream_name, server):
+        if not server:
+            return []
+        servers, index = self._get_upstream(instance_name, upstream_name)
+        servers |= self._normalize_servers(server)
+        return [self._save_upstream_operation(instance_name, upstream_name, servers, index)]
 
     def remove_server_upstream(self, instance_name, upstream_name, server):
-        servers = self.list_upstream(instance_name, upstream_name)
-        if isinstance(server, list):
-            for idx, _ in enumerate(server):
-                server[idx] = ":".join(map(str, filter(None, host_from_destination(server[idx]))))
-            servers -= set(server)
-        else:
-            server = ":".join(map(str, filter(None, host_from_destination(server))))
-            if server in servers:
-                servers.remove(server)
-        if len(servers) < 1:
-            self._remove_upstream(instance_name, upstream_name)
-        else:
-            self._save_upstream(instance_name, upstream_name, servers)
+        def operations():
+            servers, index = self._get_upstream(instance_name, upstream_name)
+            servers -= self._normalize_servers(server)
+            return [self._save_upstream_operation(instance_name, upstream_name, servers, index)]
+        self._txn_with_retry(operations)
 
-    def _remove_upstream(self, instance_name, upstream_name):
-        content = self._set_header_footer(None, "upstream")
-        self.client.kv.put(self._upstream_key(instance_name, upstream_name), content)
+    def _normalize_servers(self, server):
+        if not isinstance(server, list):
+            server = [server]
+        return set(":".join(map(str, filter(None, host_from_destination(s)))) for s in server)
 
     def list_upstream(self, instance_name, upstream_name):
-        servers = self.client.kv.get(self._upstream_key(instance_name, upstream_name))[1]
-        if servers:
-            servers = self._set_header_footer(servers["Value"], "upstream", True)
-            if servers == "":
-                return set()
-            return set(servers.split(","))
-        return set()
-
-    def _save_upstream(self, instance_name, upstream_name, servers):
-        content = self._set_header_footer(",".join(servers), "upstream")
-        self.client.kv.put(self._upstream_key(instance_name, upstream_name), content)
+        servers, _ = self._get_upstream(instance_name, upstream_name)
+        return servers
+
+    def _get_upstream(self, instance_name, upstream_name):
+        item = self.client.kv.get(self._upstream_key(instance_name, upstream_name))[1]
+        if not item:
+            return set(), 0
+        servers = self._set_header_footer(item["Value"], "upstream", True)
+        if servers == "":
+            return set(), item["ModifyIndex"]
+        return set(servers.split(",")), item["ModifyIndex"]
+
+    def _save_upstream_operation(self, instance_name, upstream_name, servers, index):
+        content = self._set_header_footer(",".join(servers) or None, "upstream")
+        return ("cas", self._upstream_key(instance_name, upstream_name), content, index)
 
     def swap_instances(self, src_instance, dst_instance):
-        if not self.check_swap_state(src_instance, dst_instance):
+        src_status, dst_status = self._swap_status(src_instance, dst_instance)
+        if not self._valid_swap_state(src_instance, dst_instance, src_status, dst_status):
+            raise InstanceAlreadySwappedError()
+        src_key = self._key(src_instance, "swap")
+        dst_key = self._key(dst_instance, "swap")
+        if src_status and src_status['Value'] == dst_instance:
+            operations = [("delete-cas", src_key, None, src_status['ModifyIndex']),
+                          ("delete-cas", dst_key, None, dst_status['ModifyIndex'])]
+        else:
+            operations = [("cas", src_key, dst_instance, self._modify_index(src_status)),
+                          ("cas", dst_key, src_instance, self._modify_index(dst_status))]
+        try:
+            self._txn(operations)
+        except TransactionError:
             raise InstanceAlreadySwappedError()
-        src_instance_value = self.client.kv.get(self._key(src_instance, "swap"))[1]
-        if not src_instance_value:
-            self.client.kv.put(self._key(src_instance, "swap"), dst_instance)
-            self.client.kv.put(self._key(dst_instance, "swap"), src_instance)
-            return
-        if src_instance_value['Value'] == dst_instance:
-            self.client.kv.delete(self._key(src_instance, "swap"))
-            self.client.kv.delete(self._key(dst_instance, "swap"))
-            return
-        self.client.kv.put(self._key(src_instance, "swap"), dst_instance)
-        self.client.kv.put(self._key(dst_instance, "swap"), src_instance)
 
     def check_swap_state(self, src_instance, dst_instance):
+        src_status, dst_status = self._swap_status(src_instance, dst_instance)
+        return self._valid_swap_state(src_instance, dst_instance, src_status, dst_status)
+
+    def _swap_status(self, src_instance, dst_instance):
         src_instance_status = self.client.kv.get(self._key(src_instance, "swap"))[1]
         dst_instance_status = self.client.kv.get(self._key(dst_instance, "swap"))[1]
+        return src_instance_status, dst_instance_status
+
+    def _valid_swap_state(self, src_instance, dst_instance, src_instance_status, dst_instance_status):
         if not src_instance_status and not dst_instance_status:
             return True
         if not src_instance_status or not dst_instance_status:
@@ -235,6 +299,11 @@ class ConsulManager(object):
             return False
         return True
 
+    def _modify_index(self, item):
+        if not item:
+            return 0
+        return item['ModifyIndex']
+
     def find_acl_network(self, instance_name, src=None):
         src = self._normalize_acl_src(src)
         acls = self.client.kv.get(self._acl_key(instance_name, src), recurse=True)[1]
@@ -275,21 +344,121 @@ class ConsulManager(object):
             raise CertificateNotFoundError()
         return cert["Value"], key["Value"]
 
+    def get_algorithm_certificate(self, instance_name, algorithm):
+        cert = self.client.kv.get(self._ssl_algorithm_path(instance_name, algorithm, "cert"))[1]
+        key = self.client.kv.get(self._ssl_algorithm_path(instance_name, algorithm, "key"))[1]
+        if not cert or not key:
+            raise CertificateNotFoundError()
+        return cert["Value"], key["Value"]
+
     def set_certificate(self, instance_name, cert_data, key_data, host_id=None):
-        self.client.kv.put(self._ssl_cert_path(instance_name, "cert", host_id),
-                           cert_data.replace("\r\n", "\n"))
-        self.client.kv.put(self._ssl_cert_path(instance_name, "key", host_id),
-                           key_data.replace("\r\n", "\n"))
+        self._txn([("set", self._ssl_cert_path(instance_name, "cert", host_id), cert_data.replace("\r\n", "\n")),
+                   ("set", self._ssl_cert_path(instance_name, "key", host_id), key_data.replace("\r\n", "\n"))])
+
+    def set_certificates(self, instance_name, certificates):
+        """
+        Stores a list of (algorithm, cert, key) certificates for the instance
+        in one transaction. The first one is also written to the default
+        ssl/cert and ssl/key entries, every certificate with a known algorithm
+        goes to ssl/algorithms/<algorithm>/cert and .../key, so nginx can
+        serve RSA and ECDSA certificates side by side. Entries of algorithms
+        missing from the list are removed.
+
+        """
+        _, cert_data, key_data = certificates[0]
+        operations = [("set", self._ssl_cert_path(instance_name, "cert"), cert_data.replace("\r\n", "\n")),
+                      ("set", self._ssl_cert_path(instance_name, "key"), key_data.replace("\r\n", "\n"))]
+        algorithms = set()
+        for algorithm, cert_data, key_data in certificates:
+            if not algorithm or algorithm in algorithms:
+                continue
+            algorithms.add(algorithm)
+            operations.append(("set", self._ssl_algorithm_path(instance_name, algorithm, "cert"),
+                               cert_data.replace("\r\n", "\n")))
+            operations.append(("set", self._ssl_algorithm_path(instance_name, algorithm, "key"),
+                               key_data.replace("\r\n", "\n")))
+        for algorithm in CERTIFICATE_ALGORITHMS:
+            if algorithm not in algorithms:
+                operations.append(("delete", self._ssl_algorithm_path(instance_name, algorithm, "cert")))
+                operations.append(("delete", self._ssl_algorithm_path(instance_name, algorithm, "key")))
+        self._txn(operations)
+
+    def list_certificates(self):
+        prefix = "{}/".format(self.service_name)
+        items = self.client.kv.get(prefix, recurse=True)[1] or []
+        for item in items:
+            parts = item["Key"][len(prefix):].split("/")
+            if len(parts) != 3 or parts[1:] != ["ssl", "cert"]:
+                continue
+            if item["Value"]:
+                yield parts[0], item["Value"]
 
     def delete_certificate(self, instance_name):
-        self.client.kv.delete(self._ssl_cert_path(instance_name, "cert"))
-        self.client.kv.delete(self._ssl_cert_path(instance_name, "key"))
+        operations = [("delete", self._ssl_cert_path(instance_name, "cert")),
+                      ("delete", self._ssl_cert_path(instance_name, "key"))]
+        for algorithm in CERTIFICATE_ALGORITHMS:
+            operations.append(("delete", self._ssl_algorithm_path(instance_name, algorithm, "cert")))
+            operations.append(("delete", self._ssl_algorithm_path(instance_name, algorithm, "key")))
+        self._txn(operations)
+
+    def _txn(self, operations):
+        """
+        Applies a list of KV operations atomically through Consul's /v1/txn
+        endpoint. Each operation is a tuple of (verb, key[, value[, index]]).
+        Raises TransactionError when Consul rolls the transaction back.
+
+        """
+        payload = []
+        for operation in operations:
+            verb, key = operation[:2]
+            kv = {"Verb": verb, "Key": key}
+            value = operation[2] if len(operation) > 2 else None
+            if value is not None:
+                if isinstance(value, unicode):
+                    value = value.encode("utf-8")
+                kv["Value"] = base64.b64encode(value)
+            if len(operation) > 3:
+                kv["Index"] = operation[3]
+            payload.append({"KV": kv})
+        params = {}
+        if self.client.token:
+            params["token"] = self.client.token
+        return self.client.http.put(self._txn_callback, "/v1/txn", params=params, data=json.dumps(payload))
+
+    def _txn_with_retry(self, operations):
+        """
+        Runs _txn with the operations returned by the operations callable,
+        rebuilding and retrying them with exponential backoff while Consul
+        rejects the transaction (e.g. a cas operation lost to a concurrent
+        writer).
+
+        """
+        delay = self.cas_backoff
+        for attempt in range(self.cas_retries):
+            try:
+                return self._txn(operations())
+            except TransactionError:
+                if attempt == self.cas_retries - 1:
+                    raise
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, self.cas_max_backoff)
+
+    def _txn_callback(self, response):
+        if response.code == 409:
+            errors = json.loads(response.body).get("Errors") or []
+            raise TransactionError(", ".join(error.get("What", "") for error in errors))
+        if response.code != 200:
+            raise consul.ConsulException("%d %s" % (response.code, response.body))
+        return json.loads(response.body)
 
     def _ssl_cert_path(self, instance_name, key_type, host_id=None):
         if host_id:
             return os.path.join(self._key(instance_name, "ssl/{}".format(host_id)), key_type)
         return os.path.join(self._key(instance_name, "ssl"), key_type)
 
+    def _ssl_algorithm_path(self, instance_name, algorithm, key_type):
+        return os.path.join(self._key(instance_name, "ssl/algorithms/{}".format(algorithm)), key_type)
+
     def _location_key(self, instance_name, path):
         location_key = "ROOT"
         if path != "/":
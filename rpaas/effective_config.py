@@ -0,0 +1,71 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+import time
+
+MAX_CACHE_ENTRIES = 256
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def bump_version(kind, name):
+    with _versions_lock:
+        _versions[(kind, name)] = _versions.get((kind, name), 0) + 1
+
+
+def current_version(kind, name):
+    return _versions.get((kind, name), 0)
+
+
+class EffectiveConfigResolver(object):
+    """
+    EffectiveConfigResolver merges plan and flavor configs on top of a base
+    config. With a positive ttl, merged overlays are cached by (plan, flavor,
+    plan version, flavor version) for ttl seconds. Versions are bumped by
+    MongoDBStorage whenever a plan or flavor is updated or deleted, but only
+    in the process doing the update: other API and worker processes may
+    serve a stale overlay for up to ttl seconds, which is why caching is
+    disabled by default.
+
+    """
+
+    def __init__(self, storage, ttl=0):
+        self.storage = storage
+        self.ttl = ttl
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
+    def resolve(self, base_config, plan_name=None, flavor_name=None):
+        config = dict(base_config or {})
+        config.update(self._overlay(plan_name, flavor_name))
+        return config
+
+    def resolve_for_metadata(self, base_config, metadata, use_flavor=True):
+        metadata = metadata or {}
+        flavor_name = None
+        if use_flavor:
+            flavor_name = metadata.get("flavor_name")
+        return self.resolve(base_config, metadata.get("plan_name"), flavor_name)
+
+    def _overlay(self, plan_name, flavor_name):
+        key = (plan_name, flavor_name,
+               current_version("plan", plan_name), current_version("flavor", flavor_name))
+        now = time.time()
+        with self._cache_lock:
+            entry = self._cache.get(key)
+        if entry is not None and entry[0] >= now:
+            return entry[1]
+        overlay = {}
+        if plan_name:
+            overlay.update(self.storage.find_plan(plan_name).config or {})
+        if flavor_name:
+            overlay.update(self.storage.find_flavor(flavor_name).config or {})
+        if self.ttl > 0:
+            with self._cache_lock:
+                if len(self._cache) >= MAX_CACHE_ENTRIES:
+                    self._cache.clear()
+                self._cache[key] = (now + self.ttl, overlay)
+        return overlay
@@ -2,9 +2,22 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import logging
 import os
 import time
-from rpaas import scheduler, tasks
+import uuid
+from rpaas import consul_manager, scheduler, tasks
+
+TRY_LEAD_SCRIPT = """
+if redis.call("set", KEYS[1], ARGV[1], "NX", "EX", ARGV[2]) then
+    return 1
+end
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    redis.call("expire", KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
 
 
 class RestoreMachine(scheduler.JobScheduler):
@@ -46,3 +59,79 @@ class CheckMachine(scheduler.JobScheduler):
             if self.try_lock():
                 tasks.CheckMachineTask().delay(self.config)
             time.sleep(self.interval / 2)
+
+
+class HealthWatcher(scheduler.JobScheduler):
+    """
+    HealthWatcher follows the health of nginx nodes with Consul blocking
+    queries and sends only the nodes whose checks changed to
+    CheckMachineTask. Every HEALTH_WATCHER_FULL_SYNC_CYCLES watch cycles
+    the full node list is sent, so nodes that are still failing get
+    checked again. Only the process holding the watcher lock in Redis
+    watches; the others stand by to take over.
+
+    """
+
+    def __init__(self, config=None, *args, **kwargs):
+        super(HealthWatcher, self).__init__(config, *args, **kwargs)
+        self.config = config or dict(os.environ)
+        self.wait = int(self.config.get("HEALTH_WATCHER_WAIT", 60))
+        self.full_sync_cycles = max(1, int(self.config.get("HEALTH_WATCHER_FULL_SYNC_CYCLES", 10)))
+        self.lock_key = self.config.get("HEALTH_WATCHER_LOCK_KEY",
+                                        "health_watcher:{}:leader".format(self.service_name))
+        self.lock_id = uuid.uuid4().hex
+        self.consul_manager = consul_manager.ConsulManager(self.config)
+        self.index = None
+        self.nodes = {}
+        self.cycles = 0
+        self.lead_script = self.conn.register_script(TRY_LEAD_SCRIPT)
+
+    def run(self):
+        self.running = True
+        while self.running:
+            if not self.try_lead():
+                self.index = None
+                self.nodes = {}
+                time.sleep(min(self.wait, 10))
+                continue
+            try:
+                self.watch()
+            except Exception:
+                logging.exception("health_watcher: error watching nginx health")
+                self.index = None
+                self.nodes = {}
+                time.sleep(1)
+
+    def try_lead(self):
+        return bool(self.lead_script(keys=[self.lock_key], args=[self.lock_id, self.wait + 30]))
+
+    def watch(self):
+        index, instances = self.consul_manager.watch_service_health(self.index, self.wait)
+        self.cycles += 1
+        full_sync = self.cycles >= self.full_sync_cycles
+        if index == self.index and not full_sync:
+            return
+        if self.index is not None and int(index) < int(self.index):
+            self.nodes = {}
+        nodes, changed = self.changed_nodes(instances)
+        if full_sync:
+            changed = instances
+        if changed:
+            tasks.CheckMachineTask().delay(self.config, changed)
+        if full_sync:
+            self.cycles = 0
+        self.index = index
+        self.nodes = nodes
+
+    def changed_nodes(self, instances):
+        nodes = {}
+        changed = []
+        for instance in instances:
+            address = instance['Node']['Address']
+            state = (tuple(sorted(instance['Service']['Tags'])),
+                     tuple(sorted((check.get('CheckID', check.get('CheckId')), check['Status'])
+                                  for check in instance['Checks'])))
+            nodes[address] = state
+            if self.nodes.get(address) != state:
+                changed.append(instance)
+        return nodes, changed
@@ -0,0 +1,72 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+
+_request = threading.local()
+
+
+def begin_request():
+    _request.contexts = {}
+
+
+def end_request():
+    _request.contexts = None
+
+
+def _request_contexts():
+    return getattr(_request, "contexts", None)
+
+
+class InstanceContext(object):
+    """
+    InstanceContext holds everything resolved about an instance before an
+    operation runs on it: readiness, load balancer, hosts and metadata.
+
+    """
+
+    def __init__(self, name, lb, storage, ready=False):
+        self.name = name
+        self.lb = lb
+        self.ready = ready
+        self._storage = storage
+        self._metadata = None
+        self._metadata_loaded = False
+
+    @property
+    def hosts(self):
+        return self.lb.hosts
+
+    @property
+    def metadata(self):
+        if not self._metadata_loaded:
+            self._metadata = self._storage.find_instance_metadata(self.name)
+            self._metadata_loaded = True
+        return self._metadata
+
+
+class InstanceContextCache(object):
+    """
+    InstanceContextCache keeps resolved instance contexts for the lifetime of
+    the current request (see begin_request/end_request). Contexts are never
+    shared across requests: scales, restores and tasks may change readiness
+    and hosts from other processes at any time.
+
+    """
+
+    def get(self, name):
+        contexts = _request_contexts()
+        if contexts is None:
+            return None
+        return contexts.get(name)
+
+    def set(self, name, context):
+        contexts = _request_contexts()
+        if contexts is not None:
+            contexts[name] = context
+
+    def invalidate(self, name):
+        contexts = _request_contexts()
+        if contexts is not None:
+            contexts.pop(name, None)
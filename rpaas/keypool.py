@@ -0,0 +1,140 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import collections
+import logging
+import os
+import threading
+
+from concurrent import futures
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+from rpaas import sslutils
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _generate_pem(key_type):
+    return sslutils.generate_key(True, key_type)
+
+
+def _gevent_active():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+def _executor(workers):
+    # a process pool reads its result pipe from a blocking thread, which
+    # stalls the hub of a gevent worker (the API runs under gunicorn -k
+    # gevent), so gevent's native thread pool is used there instead
+    if _gevent_active():
+        from gevent.threadpool import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=workers)
+    return futures.ProcessPoolExecutor(max_workers=workers)
+
+
+def _generate_key(serialized, key_type):
+    if _gevent_active():
+        import gevent
+        return gevent.get_hub().threadpool.apply(sslutils.generate_key, (serialized, key_type))
+    return sslutils.generate_key(serialized, key_type)
+
+
+class KeyPool(object):
+    """
+    KeyPool keeps a bounded stock of pre-generated private keys for each key
+    type. Keys are generated in the background by an executor (a process
+    pool by default, gevent's thread pool under gevent) and callers only
+    pop a ready key, falling back to generating it inline when the stock of
+    that type is empty.
+
+    The pool is disabled unless KEY_POOL_SIZE is set; inline generation is
+    then moved off the gevent hub, so it only blocks the calling request.
+
+    """
+
+    def __init__(self, size=4, key_types=("rsa2048",), executor=None):
+        for key_type in key_types:
+            if key_type not in sslutils.KEY_TYPES:
+                raise ValueError("invalid key type {}, expected one of {}".format(
+                    key_type, ", ".join(sslutils.KEY_TYPES)))
+        self.size = size
+        self.key_types = tuple(key_types)
+        self.executor = executor or _executor(1)
+        self._keys = dict((key_type, collections.deque()) for key_type in self.key_types)
+        self._pending = dict((key_type, 0) for key_type in self.key_types)
+        self._lock = threading.Lock()
+
+    def start(self):
+        for key_type in self.key_types:
+            self._refill(key_type)
+        return self
+
+    def take(self, key_type="rsa2048"):
+        if key_type not in self._keys:
+            return None
+        with self._lock:
+            keys = self._keys[key_type]
+            key = keys.popleft() if keys else None
+        self._refill(key_type)
+        return key
+
+    def available(self, key_type="rsa2048"):
+        with self._lock:
+            return len(self._keys.get(key_type, ()))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def _refill(self, key_type):
+        with self._lock:
+            missing = self.size - len(self._keys[key_type]) - self._pending[key_type]
+            self._pending[key_type] += max(0, missing)
+        for _ in range(missing):
+            try:
+                job = self.executor.submit(_generate_pem, key_type)
+            except Exception:
+                logging.exception("key_pool: could not schedule {} key generation".format(key_type))
+                with self._lock:
+                    self._pending[key_type] -= 1
+                continue
+            job.add_done_callback(lambda job, key_type=key_type: self._generated(key_type, job))
+
+    def _generated(self, key_type, job):
+        with self._lock:
+            self._pending[key_type] -= 1
+            if job.cancelled() or job.exception() is not None:
+                return
+            self._keys[key_type].append(job.result())
+
+
+def get_pool(conf=None):
+    global _pool
+    if _pool is not None:
+        return _pool
+    conf = conf or dict(os.environ)
+    size = int(conf.get("KEY_POOL_SIZE", 0))
+    if size <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            key_types = [t.strip() for t in conf.get("KEY_POOL_TYPES", "rsa2048").split(",") if t.strip()]
+            workers = max(1, int(conf.get("KEY_POOL_WORKERS", 1)))
+            _pool = KeyPool(size, key_types, _executor(workers)).start()
+    return _pool
+
+
+def take_key(conf=None, serialized=False, key_type="rsa2048"):
+    pool = get_pool(conf)
+    key = pool.take(key_type) if pool else None
+    if key is None:
+        return _generate_key(serialized, key_type)
+    if serialized:
+        return key
+    return serialization.load_pem_private_key(key, password=None, backend=default_backend())
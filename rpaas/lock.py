@@ -2,36 +2,59 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import uuid
+from collections import OrderedDict
+
 
 class Lock(object):
 
     def __init__(self, redis_conn):
         self.redis_conn = redis_conn
-        self.redis_locks = []
+        self._locks = OrderedDict()
+
+    @property
+    def redis_locks(self):
+        return list(self._locks.values())
 
     def lock(self, lock_name, timeout):
-        position = self._find_lock_pos(lock_name)
-        if position is not None:
-            return self.redis_locks[position].acquire(blocking=False)
-        self.redis_locks.append(self.redis_conn.lock(name=lock_name, timeout=timeout, blocking_timeout=1))
-        position = self._find_lock_pos(lock_name)
-        return self.redis_locks[position].acquire(blocking=False)
+        redis_lock = self._locks.get(lock_name)
+        if redis_lock is None:
+            redis_lock = self._new_lock(lock_name, timeout)
+            self._locks[lock_name] = redis_lock
+        return redis_lock.acquire(blocking=False)
+
+    def lock_many(self, lock_names, timeout):
+        lock_names = [name for name in OrderedDict.fromkeys(lock_names)]
+        tokens = [uuid.uuid1().hex for _ in lock_names]
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            for lock_name, token in zip(lock_names, tokens):
+                pipe.set(lock_name, token, nx=True, px=int(timeout * 1000))
+            results = pipe.execute()
+        acquired = []
+        for lock_name, token, result in zip(lock_names, tokens, results):
+            if not result:
+                continue
+            redis_lock = self._locks.get(lock_name)
+            if redis_lock is None:
+                redis_lock = self._new_lock(lock_name, timeout)
+                self._locks[lock_name] = redis_lock
+            redis_lock.local.token = token
+            acquired.append(lock_name)
+        return acquired
 
     def unlock(self, lock_name):
-        position = self._find_lock_pos(lock_name)
-        if position is not None:
-            self.redis_locks[position].release()
-            del self.redis_locks[position]
+        redis_lock = self._locks.pop(lock_name, None)
+        if redis_lock is not None:
+            redis_lock.release()
+
+    def unlock_many(self, lock_names):
+        for lock_name in lock_names:
+            self.unlock(lock_name)
 
     def extend_lock(self, lock_name, extra_time):
-        position = self._find_lock_pos(lock_name)
-        if position is not None:
-            self.redis_locks[position].extend(extra_time)
-
-    def _find_lock_pos(self, lock_name):
-        if not self.redis_locks:
-            return None
-        position = [i for i, x in enumerate(self.redis_locks) if x.name == lock_name]
-        if position:
-            return position.pop()
-        return None
+        redis_lock = self._locks.get(lock_name)
+        if redis_lock is not None:
+            redis_lock.extend(extra_time)
+
+    def _new_lock(self, lock_name, timeout):
+        return self.redis_conn.lock(name=lock_name, timeout=timeout, blocking_timeout=1)
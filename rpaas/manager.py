@@ -4,7 +4,6 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-import copy
 import datetime
 import os
 import socket
@@ -15,9 +14,10 @@ import hm.managers.cloudstack  # NOQA
 import hm.lb_managers.networkapi_cloudstack  # NOQA
 from hm.model.load_balancer import LoadBalancer
 from celery.utils import uuid
+from concurrent import futures
 
 from rpaas import (consul_manager, nginx, sslutils, ssl_plugins,
-                   storage, tasks, acl, lock)
+                   storage, tasks, acl, lock, instance_context, effective_config, purge, keypool)
 from rpaas.misc import check_option_enable, host_from_destination
 
 PENDING = "pending"
@@ -36,14 +36,35 @@ class Manager(object):
         self.acl_manager = acl.Dumb(self.consul_manager)
         if check_option_enable(os.environ.get("CHECK_ACL_API", None)):
             self.acl_manager = acl.AclManager(config, self.consul_manager, lock.Lock(tasks.app.backend.client))
+        self.instance_cache = instance_context.InstanceContextCache()
+        config_ttl = int(config.get("RPAAS_EFFECTIVE_CONFIG_TTL", 0))
+        self.config_resolver = effective_config.EffectiveConfigResolver(self.storage, ttl=config_ttl)
+        self.purge_timeout = float(config.get("RPAAS_PURGE_TIMEOUT", 10))
+        self.purge_bulk_timeout = float(config.get("RPAAS_PURGE_BULK_TIMEOUT", 120))
+        purge_concurrency = int(config.get("RPAAS_PURGE_CONCURRENCY", 16))
+        self.purge_executor = futures.ThreadPoolExecutor(max_workers=max(1, purge_concurrency))
+        # bulk purges get their own pool so a large list can't starve
+        # single path purges
+        purge_bulk_concurrency = int(config.get("RPAAS_PURGE_BULK_CONCURRENCY", 4))
+        self.purge_bulk_executor = futures.ThreadPoolExecutor(max_workers=max(1, purge_bulk_concurrency))
+
+    def _instance_context(self, name, check_ready=True):
+        context = self.instance_cache.get(name)
+        if context is None:
+            if check_ready:
+                self.task_manager.ensure_ready(name)
+            lb = LoadBalancer.find(name)
+            if lb is None:
+                raise storage.InstanceNotFoundError()
+            context = instance_context.InstanceContext(name, lb, self.storage, ready=check_ready)
+            self.instance_cache.set(name, context)
+        elif check_ready and not context.ready:
+            self.task_manager.ensure_ready(name)
+            context.ready = True
+        return context
 
     def new_instance(self, name, team=None, plan_name=None, flavor_name=None):
-        plan = None
-        flavor = None
-        if plan_name:
-            plan = self.storage.find_plan(plan_name)
-        if flavor_name:
-            flavor = self.storage.find_flavor(flavor_name)
+        config = self.config_resolver.resolve(self.config, plan_name, flavor_name)
         used, quota = self.storage.find_team_quota(team)
         if len(used) >= quota:
             raise QuotaExceededError(len(used), quota)
@@ -53,13 +74,13 @@ class Manager(object):
         if lb is not None:
             raise storage.DuplicateError(name)
         self.task_manager.create(name)
-        config = copy.deepcopy(self.config)
+        self.instance_cache.invalidate(name)
         metadata = {}
-        if plan:
-            config.update(plan.config)
+        if team:
+            metadata["team"] = team
+        if plan_name:
             metadata["plan_name"] = plan_name
-        if flavor:
-            config.update(flavor.config)
+        if flavor_name:
             metadata["flavor_name"] = flavor_name
         metadata["consul_token"] = consul_token = self.consul_manager.generate_token(name)
         self.consul_manager.write_healthcheck(name)
@@ -82,22 +103,16 @@ class Manager(object):
         if not self.consul_manager.check_swap_state(name, None):
             raise consul_manager.InstanceAlreadySwappedError()
         self.task_manager.create(name)
+        self.instance_cache.invalidate(name)
         metadata = self.storage.find_instance_metadata(name)
-        config = copy.deepcopy(self.config)
-        if metadata and "plan_name" in metadata:
-            plan = self.storage.find_plan(metadata["plan_name"])
-            if plan:
-                config.update(plan.config)
-        if metadata and "flavor_name" in metadata:
-            flavor = self.storage.find_flavor(metadata["flavor_name"])
-            if flavor:
-                config.update(flavor.config)
+        config = self.config_resolver.resolve_for_metadata(self.config, metadata)
         if metadata and metadata.get("consul_token"):
             self.consul_manager.destroy_token(metadata["consul_token"])
-        self.storage.decrement_quota(name)
+        self.storage.decrement_quota(name, (metadata or {}).get("team"))
         self.storage.remove_task(name)
         self.storage.remove_binding(name)
         self.storage.remove_instance_metadata(name)
+        self.storage.remove_instance_certificate(name)
         tasks.RemoveInstanceTask().delay(config, name)
 
     def update_instance(self, name, plan_name=None, flavor_name=None):
@@ -105,16 +120,13 @@ class Manager(object):
             raise storage.PlanNotFoundError()
         if flavor_name and not self.storage.find_flavor(flavor_name):
             raise storage.FlavorNotFoundError()
-        self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
-        metadata = self.storage.find_instance_metadata(name)
+        metadata = self._instance_context(name).metadata
         if flavor_name:
             metadata['flavor_name'] = flavor_name
         if plan_name:
             metadata['plan_name'] = plan_name
         self.storage.store_instance_metadata(name, **metadata)
+        self.instance_cache.invalidate(name)
 
     def restore_machine_instance(self, name, machine, cancel_task=False):
         task_name = "restore_{}".format(machine)
@@ -131,18 +143,17 @@ class Manager(object):
         self.task_manager.create({"_id": task_name, "host": machine,
                                  "instance": name, "created": datetime.datetime.utcnow()})
 
-    def restore_instance(self, name):
+    def restore_instance(self, name, max_unavailable=None):
         self.task_manager.ensure_ready(name)
         self.task_manager.create(name)
-        config = copy.deepcopy(self.config)
+        self.instance_cache.invalidate(name)
         metadata = self.storage.find_instance_metadata(name)
-        if metadata and "plan_name" in metadata:
-            plan = self.storage.find_plan(metadata["plan_name"])
-            config.update(plan.config or {})
-        if metadata and "flavor_name" in metadata:
-            flavor = self.storage.find_flavor(metadata["flavor_name"])
-            config.update(flavor.config or {})
+        config = self.config_resolver.resolve_for_metadata(self.config, metadata)
         healthcheck_timeout = int(config.get("RPAAS_HEALTHCHECK_TIMEOUT", 600))
+        restore_delay = int(config.get("RPAAS_RESTORE_DELAY", 30))
+        if max_unavailable is None:
+            max_unavailable = int(config.get("RPAAS_RESTORE_MAX_UNAVAILABLE", 1))
+        min_healthy = int(config.get("RPAAS_RESTORE_MIN_HEALTHY", 0))
         tags = []
         extra_tags = config.get("INSTANCE_EXTRA_TAGS", "")
         if extra_tags:
@@ -153,42 +164,47 @@ class Manager(object):
             lb = LoadBalancer.find(name, config)
             if lb is None:
                 raise storage.InstanceNotFoundError()
-            length = len(lb.hosts)
-            for idx, host in enumerate(lb.hosts):
-                yield "Restoring host ({}/{}) {} ".format(idx + 1, length, host.id)
-                stop_host_job = JobWaiting(host.stop, 0)
-                stop_host_job.start()
-                while stop_host_job.is_alive():
-                    yield "."
-                    time.sleep(1)
-                if isinstance(stop_host_job.result, Exception):
-                    raise stop_host_job.result
-                scale_host_job = JobWaiting(host.scale, 0)
-                scale_host_job.start()
-                while scale_host_job.is_alive():
-                    yield "."
-                    time.sleep(1)
-                if isinstance(scale_host_job.result, Exception):
-                    raise scale_host_job.result
-                restore_host_job = JobWaiting(host.restore, 0, reset_template=True, reset_tags=True)
-                restore_host_job.start()
-                while restore_host_job.is_alive():
-                    yield "."
-                    time.sleep(1)
-                if isinstance(restore_host_job.result, Exception):
-                    raise restore_host_job.result
-                host.start()
-                nginx_waiting = self.nginx_manager.wait_healthcheck
-                restore_delay = int(config.get("RPAAS_RESTORE_DELAY", 30))
-                nginx_healthcheck_job = JobWaiting(nginx_waiting, restore_delay, host=host.dns_name,
-                                                   timeout=healthcheck_timeout, manage_healthcheck=False)
-                nginx_healthcheck_job.start()
-                while nginx_healthcheck_job.is_alive():
-                    yield "."
-                    time.sleep(1)
-                if isinstance(nginx_healthcheck_job.result, Exception):
-                    raise nginx_healthcheck_job.result
-                yield ": successfully restored\n"
+            hosts = lb.hosts
+            length = len(hosts)
+            batch_size = max(1, min(max_unavailable, length - min_healthy))
+            for start in xrange(0, length, batch_size):
+                batch = hosts[start:start + batch_size]
+                if len(batch) == 1:
+                    yield "Restoring host ({}/{}) {} ".format(start + 1, length, batch[0].id)
+                else:
+                    yield "Restoring hosts ({}-{}/{}) {}\n".format(start + 1, start + len(batch), length,
+                                                                 ", ".join(str(host.id) for host in batch))
+                jobs = []
+                for host in batch:
+                    job = JobWaiting(self._restore_host, 0, host=host, healthcheck_timeout=healthcheck_timeout,
+                                     restore_delay=restore_delay)
+                    job.start()
+                    jobs.append((host, job))
+                failures = 0
+                dotted = False
+                while jobs:
+                    for host, job in [(h, j) for h, j in jobs if not j.is_alive()]:
+                        jobs.remove((host, job))
+                        if len(batch) == 1:
+                            if isinstance(job.result, Exception):
+                                raise job.result
+                            yield ": successfully restored\n"
+                            continue
+                        if dotted:
+                            yield "\n"
+                            dotted = False
+                        if isinstance(job.result, Exception):
+                            failures += 1
+                            yield "{}: failed to restore - {}\n".format(host.id, repr(job.result.message))
+                        else:
+                            yield "{}: successfully restored\n".format(host.id)
+                    if jobs:
+                        yield "."
+                        dotted = True
+                        time.sleep(1)
+                if failures:
+                    yield "restore aborted: {} host(s) failed to restore\n".format(failures)
+                    return
         except storage.InstanceNotFoundError:
             yield "instance {} not found\n".format(name)
         except Exception as e:
@@ -196,11 +212,17 @@ class Manager(object):
         finally:
             self.task_manager.remove(name)
 
+    def _restore_host(self, host, healthcheck_timeout, restore_delay):
+        host.stop()
+        host.scale()
+        host.restore(reset_template=True, reset_tags=True)
+        host.start()
+        self.nginx_manager.wait_healthcheck(host=host.dns_name, timeout=healthcheck_timeout,
+                                            manage_healthcheck=False)
+        time.sleep(restore_delay)
+
     def bind(self, name, app_host, router_mode=False):
-        self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name)
         binding_data = self.storage.find_binding(name)
         if binding_data:
             bound_host = binding_data.get("app_host")
@@ -220,10 +242,7 @@ class Manager(object):
         self.storage.store_binding(name, app_host)
 
     def unbind(self, name):
-        self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name)
         binding_data = self.storage.find_binding(name)
         if not binding_data:
             return
@@ -254,10 +273,11 @@ class Manager(object):
                     routes_data.append("destination = {}".format(dst))
                 if content:
                     routes_data.append("content = {}".format(content.encode("utf-8")))
-        lb = LoadBalancer.find(name)
         host_count = 0
-        if lb:
-            host_count = len(lb.hosts)
+        try:
+            host_count = len(self._instance_context(name, check_ready=False).hosts)
+        except storage.InstanceNotFoundError:
+            pass
         data = [
             {
                 "label": "Address",
@@ -275,6 +295,11 @@ class Manager(object):
         metadata = self.storage.find_instance_metadata(name)
         if metadata and "plan_name" in metadata:
             data.append({"label": "Plan", "value": metadata["plan_name"]})
+        for task in self.storage.find_task(name):
+            progress = task.get("progress")
+            if progress:
+                data.append({"label": "Scale progress",
+                             "value": "{added}/{total} hosts added, {failed} failed".format(**progress)})
         return data
 
     def status(self, name):
@@ -290,17 +315,14 @@ class Manager(object):
         self.consul_manager.swap_instances(src_instance, dst_instance)
 
     def node_status(self, name):
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        lb = self._instance_context(name, check_ready=False).lb
         hostnames = {}
         node_status_return = {}
         if len(lb.hosts) == 0:
             return node_status_return
-        for host in lb.hosts:
-            hostname = self.consul_manager.node_hostname(host.dns_name)
-            if hostname is not None:
-                hostnames[hostname] = host.dns_name
+        node_names = self.consul_manager.node_hostnames([host.dns_name for host in lb.hosts])
+        for address, hostname in node_names.iteritems():
+            hostnames[hostname] = address
         for node, status in self.consul_manager.node_status(name).iteritems():
             node_status_return[node] = {'status': status}
             if node in hostnames:
@@ -308,31 +330,28 @@ class Manager(object):
         return node_status_return
 
     def get_certificate(self, name):
-        self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name)
         return self.consul_manager.get_certificate(name)
 
     def update_certificate(self, name, cert, key):
-        self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
-        self.consul_manager.set_certificate(name, cert, key)
+        self._instance_context(name)
+        self.consul_manager.set_certificates(name, [(sslutils.key_algorithm(key), cert, key)])
+        self.storage.store_instance_certificate(name, sslutils.certificate_expiry(cert), source="upload")
 
     def delete_certificate(self, name):
-        self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name)
         self.consul_manager.delete_certificate(name)
+        self.storage.remove_instance_certificate(name)
+
+    def sync_certificates_expiry(self):
+        synced = 0
+        for name, cert in self.consul_manager.list_certificates():
+            self.storage.store_instance_certificate(name, sslutils.certificate_expiry(cert))
+            synced += 1
+        return synced
 
     def add_upstream(self, name, upstream_name, servers, acl=False):
-        self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        lb = self._instance_context(name).lb
         if acl:
             for host in lb.hosts:
                 if not isinstance(servers, list):
@@ -343,17 +362,11 @@ class Manager(object):
         self.consul_manager.add_server_upstream(name, upstream_name, servers)
 
     def remove_upstream(self, name, upstream_name, servers):
-        self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name)
         self.consul_manager.remove_server_upstream(name, upstream_name, servers)
 
     def list_upstreams(self, name, upstream_name):
-        self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name)
         return self.consul_manager.list_upstream(name, upstream_name)
 
     def _get_address(self, name):
@@ -363,50 +376,36 @@ class Manager(object):
             if result.status in ["FAILURE", "REVOKED"]:
                 return FAILURE
             return PENDING
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
-        return lb.address
+        return self._instance_context(name, check_ready=False).lb.address
 
     def scale_instance(self, name, quantity):
         self.task_manager.ensure_ready(name)
         if quantity < 0:
             raise ScaleError("Can't have negative instances")
         self.task_manager.create(name)
-        config = copy.deepcopy(self.config)
+        self.instance_cache.invalidate(name)
         metadata = self.storage.find_instance_metadata(name)
         if not metadata or "consul_token" not in metadata:
             metadata = metadata or {}
             metadata["consul_token"] = self.consul_manager.generate_token(name)
             self.storage.store_instance_metadata(name, **metadata)
-        if "plan_name" in metadata:
-            plan = self.storage.find_plan(metadata["plan_name"])
-            config.update(plan.config or {})
-        if "flavor_name" in metadata:
-            flavor = self.storage.find_flavor(metadata["flavor_name"])
-            config.update(flavor.config or {})
+        config = self.config_resolver.resolve_for_metadata(self.config, metadata)
         self._add_tags(name, config, metadata["consul_token"])
         task = tasks.ScaleInstanceTask().delay(config, name, quantity)
         self.task_manager.update(name, task.task_id)
 
     def add_route(self, name, path, destination, content, https_only):
-        self.task_manager.ensure_ready(name)
         path = path.strip()
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name)
         self.storage.replace_binding_path(name, path, destination, content, https_only)
         self.consul_manager.write_location(name, path, destination=destination,
                                            content=content, https_only=https_only)
 
     def delete_route(self, name, path):
-        self.task_manager.ensure_ready(name)
         path = path.strip()
         if path == "/":
             raise RouteError("You cannot remove a route for / location, unbind the app.")
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name)
         routes = self.list_routes(name)
         destination_count = 0
         if not routes:
@@ -431,60 +430,59 @@ class Manager(object):
         return self.storage.list_healings(quantity)
 
     def purge_location(self, name, path, preserve_path=False):
-        self.task_manager.ensure_ready(name)
-        if not preserve_path:
-            path = path.strip()
-        lb = LoadBalancer.find(name)
-        purged_hosts = 0
-        if lb is None:
-            raise storage.InstanceNotFoundError()
-        for host in lb.hosts:
-            if self.nginx_manager.purge_location(host.dns_name, path, preserve_path):
-                purged_hosts += 1
-        return purged_hosts
+        hosts = self.purge_location_hosts(name, path, preserve_path)
+        return len([host for host in hosts.values() if host["purged"]])
+
+    def purge_location_hosts(self, name, path, preserve_path=False):
+        lb = self._instance_context(name).lb
+        purges = [{"path": path, "preserve_path": preserve_path}]
+        bulk_purge = purge.BulkPurge(self.nginx_manager, self.purge_executor)
+        results = bulk_purge.run([host.dns_name for host in lb.hosts], purges, self.purge_timeout)
+        return next(results)["hosts"]
+
+    def purge_locations(self, name, purges):
+        lb = self._instance_context(name).lb
+        bulk_purge = purge.BulkPurge(self.nginx_manager, self.purge_bulk_executor)
+        return bulk_purge.run([host.dns_name for host in lb.hosts], purges, self.purge_bulk_timeout)
+
+    def purge_locations_async(self, name, purges):
+        self._instance_context(name)
+        task_id = tasks.PurgeLocationsTask().delay(self.config, name, purges).id
+        self.storage.store_purge_task(name, task_id)
+        return task_id
+
+    def purge_locations_result(self, name, task_id):
+        if self.storage.find_purge_task(name, task_id) is None:
+            raise tasks.TaskNotFoundError("Purge task {} not found".format(task_id))
+        result = tasks.PurgeLocationsTask().AsyncResult(task_id)
+        if result.successful():
+            return {"status": result.status, "results": result.result["results"]}
+        return {"status": result.status, "results": None}
 
     def add_block(self, name, block_name, content):
-        self.task_manager.ensure_ready(name)
         block_name = block_name.strip()
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name)
         self.consul_manager.write_block(name, block_name, content)
 
     def delete_block(self, name, block_name):
-        self.task_manager.ensure_ready(name)
         block_name = block_name.strip()
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name)
         self.consul_manager.remove_block(name, block_name)
 
     def list_blocks(self, name):
-        self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name)
         return self.consul_manager.list_blocks(name)
 
     def add_lua(self, name, lua_module_name, lua_module_type, content):
-        self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            storage.InstanceNotFoundError()
+        self._instance_context(name)
         self.consul_manager.write_lua(name, lua_module_name, lua_module_type, content)
 
     def list_lua(self, name):
-        self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name)
         return self.consul_manager.list_lua_modules(name)
 
     def delete_lua(self, name, lua_module_name, lua_module_type):
-        self.task_manager.ensure_ready(name)
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name)
         self.consul_manager.remove_lua(name, lua_module_name, lua_module_type)
 
     def _check_dns(self, name, domain):
@@ -510,42 +508,68 @@ class Manager(object):
 
         return True
 
-    def activate_ssl(self, name, domain, plugin='default'):
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+    def activate_ssl(self, name, domain, plugin='default', key_types=None):
+        context = self._instance_context(name, check_ready=False)
 
         if not self._check_dns(name, domain):
             raise SslError('rpaas IP is not registered for this DNS name')
 
-        key = sslutils.generate_key(True)
+        metadata = context.metadata or {}
+        if key_types:
+            metadata = dict(metadata, ssl_key_types=key_types)
+        try:
+            types = sslutils.key_types(self.config_resolver.resolve_for_metadata(self.config, metadata), metadata)
+        except ValueError as e:
+            raise SslError(str(e))
+        if key_types:
+            metadata["ssl_key_types"] = ",".join(types)
+            self.storage.store_instance_metadata(name, **metadata)
+            self.instance_cache.invalidate(name)
+
+        key = keypool.take_key(self.config, serialized=True, key_type=types[0])
         csr = sslutils.generate_csr(key, domain)
 
         if plugin == 'le':
             try:
                 self.task_manager.create(name)
-                task = tasks.DownloadCertTask().delay(self.config, name, plugin, csr, key, domain)
+                self.instance_cache.invalidate(name)
+                config = dict(self.config, SSL_KEY_TYPES=",".join(types))
+                task = tasks.DownloadCertTask().delay(config, name, plugin, csr, key, domain)
                 self.task_manager.update(name, task.task_id)
                 return ''
             except Exception:
                 raise SslError('rpaas IP is not registered for this DNS name')
 
         else:
-            p_ssl = ssl_plugins.default.Default(domain)
-            cert = p_ssl.download_crt(key=key)
-            self.update_certificate(name, cert, key)
+            certificates = []
+            for key_type in types:
+                if key_type != types[0]:
+                    key = keypool.take_key(self.config, serialized=True, key_type=key_type)
+                p_ssl = ssl_plugins.default.Default(domain)
+                certificates.append((sslutils.key_type_algorithm(key_type), p_ssl.download_crt(key=key), key))
+            self._instance_context(name)
+            self.consul_manager.set_certificates(name, certificates)
+            self.storage.store_instance_certificate(name, sslutils.certificates_expiry(certificates),
+                                                    source=plugin, domain=domain)
             return ''
 
     def revoke_ssl(self, name, plugin='default'):
-        lb = LoadBalancer.find(name)
-        if lb is None:
-            raise storage.InstanceNotFoundError()
+        self._instance_context(name, check_ready=False)
 
         if plugin.isalpha() and plugin in ssl_plugins.__all__ and \
            plugin not in ['default', '__init__']:
 
+            try:
+                _, key = self.consul_manager.get_certificate(name)
+            except consul_manager.CertificateNotFoundError:
+                key = None
+            algorithm = key and sslutils.key_algorithm(key)
+            if algorithm and algorithm != "rsa":
+                raise SslError("revoking {} certificates is not supported".format(algorithm))
+
             try:
                 self.task_manager.create(name)
+                self.instance_cache.invalidate(name)
                 task = tasks.RevokeCertTask().delay(self.config, name, plugin)
                 self.task_manager.update(name, task.task_id)
                 return ''
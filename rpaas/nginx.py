@@ -5,6 +5,9 @@
 import time
 import datetime
 import os
+import random
+import threading
+from collections import OrderedDict
 
 import requests
 
@@ -55,6 +58,28 @@ class NginxError(Exception):
     pass
 
 
+class RetryPolicy(object):
+    """
+    RetryPolicy describes the delays between attempts of a retried request:
+    the first delay is initial_delay and each following one is multiplied by
+    multiplier, capped at max_delay. Each delay is randomly shortened by up
+    to jitter (a fraction between 0 and 1) of its value.
+
+    """
+
+    def __init__(self, initial_delay=1, multiplier=1, jitter=0, max_delay=10):
+        self.initial_delay = initial_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_delay = max_delay
+
+    def delays(self):
+        delay = self.initial_delay
+        while True:
+            yield delay * (1 - random.uniform(0, self.jitter))
+            delay = min(delay * self.multiplier, self.max_delay)
+
+
 def retry_request(f):
     def f_retry(self, *args, **kwargs):
         timeout = kwargs.get("timeout")
@@ -62,6 +87,7 @@ def retry_request(f):
             timeout = 30
         t0 = datetime.datetime.now()
         timeout = datetime.timedelta(seconds=timeout)
+        delays = getattr(self, "retry_policy", RetryPolicy()).delays()
         while True:
             try:
                 f(self, *args, **kwargs)
@@ -70,7 +96,7 @@ def retry_request(f):
                 now = datetime.datetime.now()
             if now > t0 + timeout:
                 raise
-            time.sleep(1)
+            time.sleep(next(delays))
     return f_retry
 
 
@@ -132,32 +158,52 @@ class Nginx(object):
                                                                 'WORKING', conf)
         self.ca_cert = config.get_config('CA_CERT', None, conf)
         self.ca_path = "/tmp/rpaas_ca.pem"
+        self.request_timeout = float(config.get_config('NGINX_REQUEST_TIMEOUT', 2, conf))
+        self.pool_maxsize = int(config.get_config('NGINX_POOL_MAXSIZE', 4, conf))
+        self.max_sessions = int(config.get_config('NGINX_MAX_SESSIONS', 256, conf))
+        self.retry_policy = RetryPolicy(
+            initial_delay=float(config.get_config('NGINX_RETRY_INITIAL_DELAY', 1, conf)),
+            multiplier=float(config.get_config('NGINX_RETRY_MULTIPLIER', 1, conf)),
+            jitter=float(config.get_config('NGINX_RETRY_JITTER', 0, conf)),
+            max_delay=float(config.get_config('NGINX_RETRY_MAX_DELAY', 10, conf)))
         self.config_manager = ConfigManager(conf)
+        self._sessions = OrderedDict()
+        self._sessions_lock = threading.Lock()
 
     def purge_location(self, host, path, preserve_path=False):
-        purge_path = self.nginx_purge_path.lstrip('/')
         purged = False
+        for variant in self.purge_variants(path, preserve_path):
+            if self.purge_variant(host, variant):
+                purged = True
+        return purged
+
+    def purge_variants(self, path, preserve_path=False):
+        purge_path = self.nginx_purge_path.lstrip('/')
+        variants = []
         if preserve_path:
             for encoding in ['gzip', 'identity']:
-                try:
-                    self._nginx_request(host, "{}/{}".format(purge_path, path),
-                                        {'Accept-Encoding': encoding})
-                    purged = True
-                except:
-                    pass
-            return purged
+                variants.append((encoding, "{}/{}".format(purge_path, path),
+                                 {'Accept-Encoding': encoding}))
+            return variants
         for scheme in ['http', 'https']:
             for encoding in ['gzip', 'identity']:
-                try:
-                    self._nginx_request(host, "{}/{}{}".format(purge_path, scheme, path),
-                                        {'Accept-Encoding': encoding})
-                    purged = True
-                except:
-                    pass
-        return purged
+                variants.append(("{} {}".format(scheme, encoding), "{}/{}{}".format(purge_path, scheme, path),
+                                 {'Accept-Encoding': encoding}))
+        return variants
+
+    def purge_variant(self, host, variant):
+        _, purge_path, headers = variant
+        try:
+            self._nginx_request(host, purge_path, headers)
+            return True
+        except:
+            return False
 
     @retry_request
     def wait_healthcheck(self, host, timeout=30, manage_healthcheck=True):
+        self.healthcheck(host, manage_healthcheck)
+
+    def healthcheck(self, host, manage_healthcheck=True):
         if manage_healthcheck:
             healthcheck_path = self.nginx_healthcheck_path.lstrip('/')
             expected_response = self.nginx_expected_healthcheck
@@ -193,11 +239,34 @@ class Nginx(object):
             params['headers'] = headers
         if data:
             params['data'] = data
-        rsp = requests.request(method.lower(), url, timeout=2, **params)
+        rsp = self._session(host).request(method.lower(), url, timeout=self.request_timeout, **params)
         if rsp.status_code != 200 or (expected_response and expected_response not in rsp.text):
             raise NginxError(
                 "Error trying to access admin path in nginx: {}: {}".format(url, rsp.text))
 
+    def _session(self, host):
+        with self._sessions_lock:
+            session = self._sessions.pop(host, None)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+            self._sessions[host] = session
+            evicted = []
+            while len(self._sessions) > self.max_sessions:
+                evicted.append(self._sessions.popitem(last=False)[1])
+        for old_session in evicted:
+            old_session.close()
+        return session
+
+    def close(self):
+        with self._sessions_lock:
+            sessions = self._sessions.values()
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
     def _ensure_ca_cert_file(self):
         if not self.ca_cert:
             raise NginxError("CA_CERT should be set for nginx https internal requests")
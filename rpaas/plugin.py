@@ -321,6 +321,8 @@ def get_ssl_args(args):
     parser.add_argument("-i", "--instance", required=True, help="Service instance name")
     parser.add_argument("-d", "--domain", required=True, help="Registered domain name")
     parser.add_argument("-p", "--plugin", required=False, help="Authorization plugin")
+    parser.add_argument("-t", "--key-types", required=False,
+                        help="Comma separated key types, e.g. ecdsa-p256,rsa2048 (the first one is the default)")
     parsed = parser.parse_args(args)
     return parsed
 
@@ -341,6 +343,8 @@ def ssl(args):
     params = {}
     params['domain'] = args.domain
     params['plugin'] = args.plugin if 'plugin' in args else 'default'
+    if args.key_types:
+        params['key_types'] = args.key_types
     try:
         body = urllib.urlencode(params)
     except AttributeError:
@@ -0,0 +1,89 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import time
+
+from concurrent import futures
+
+
+class BulkPurge(object):
+    """
+    BulkPurge purges a list of paths on a set of hosts. Every (host, path,
+    cache variant) combination becomes one job on the given executor, and
+    results are yielded per path as soon as all jobs for that path finish.
+    Jobs still pending when the deadline expires are cancelled and reported
+    as timed out, and so are the ones left when the generator is closed.
+
+    """
+
+    def __init__(self, nginx_manager, executor):
+        self.nginx_manager = nginx_manager
+        self.executor = executor
+
+    def run(self, hosts, purges, timeout):
+        deadline = time.time() + timeout
+        jobs = {}
+        try:
+            results, remaining = self._submit(hosts, purges, jobs)
+            for result in self._results(results, remaining, jobs, deadline):
+                yield result
+        finally:
+            # the consumer is gone (e.g. the client disconnected), nobody
+            # will read what is still pending
+            for job in jobs:
+                job.cancel()
+
+    def _submit(self, hosts, purges, jobs):
+        results = []
+        remaining = []
+        for index, purge in enumerate(purges):
+            path = purge.get("path")
+            preserve_path = purge.get("preserve_path", False)
+            if not preserve_path:
+                path = path.strip()
+            variants = self.nginx_manager.purge_variants(path, preserve_path)
+            result = {"path": purge.get("path"), "hosts": {},
+                      "order": dict((variant[0], i) for i, variant in enumerate(variants))}
+            for host in hosts:
+                result["hosts"][host] = {"purged": False, "variants": [], "failed": [], "timed_out": []}
+                for variant in variants:
+                    job = self.executor.submit(self.nginx_manager.purge_variant, host, variant)
+                    jobs[job] = (index, host, variant[0])
+            results.append(result)
+            remaining.append(len(hosts) * len(variants))
+        return results, remaining
+
+    def _results(self, results, remaining, jobs, deadline):
+        for index, count in enumerate(remaining):
+            if count == 0:
+                yield self._summary(results[index])
+        try:
+            for job in futures.as_completed(jobs, timeout=max(0, deadline - time.time())):
+                index, host, label = jobs.pop(job)
+                host_result = results[index]["hosts"][host]
+                if job.exception() is None and job.result():
+                    host_result["variants"].append(label)
+                    host_result["purged"] = True
+                else:
+                    host_result["failed"].append(label)
+                remaining[index] -= 1
+                if remaining[index] == 0:
+                    yield self._summary(results[index])
+        except futures.TimeoutError:
+            pass
+        timed_out = set()
+        for job, (index, host, label) in jobs.items():
+            job.cancel()
+            results[index]["hosts"][host]["timed_out"].append(label)
+            timed_out.add(index)
+        for index in sorted(timed_out):
+            yield self._summary(results[index])
+
+    def _summary(self, result):
+        order = result.pop("order")
+        for host_result in result["hosts"].values():
+            for key in ("variants", "failed", "timed_out"):
+                host_result[key].sort(key=lambda label: order.get(label))
+        result["instances_purged"] = len([h for h in result["hosts"].values() if h["purged"]])
+        return result
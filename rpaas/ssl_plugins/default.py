@@ -45,7 +45,7 @@ class Default(BaseSSLPlugin):
             x509.NameAttribute(NameOID.COMMON_NAME, self.domain),
         ]))
         builder = builder.not_valid_before(datetime.datetime.today() - one_day)
-        builder = builder.not_valid_after(datetime.datetime(2018, 8, 2))
+        builder = builder.not_valid_after(datetime.datetime.today() + datetime.timedelta(days=365))
         builder = builder.serial_number(int(uuid.uuid4()))
         builder = builder.public_key(public_key)
         builder = builder.add_extension(
@@ -2,18 +2,20 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
 import json
 import logging
 import OpenSSL
 import os
+import pytz
 
 import acme.client as acme_client
 
-from certbot.client import Client, register
+from certbot.client import Client, acme_from_config_key, register
 from certbot.configuration import NamespaceConfig
-from certbot.account import AccountMemoryStorage
-from certbot import crypto_util
-from acme import jose
+from certbot.account import Account, AccountMemoryStorage
+from certbot import crypto_util, errors, interfaces, util
+from acme import jose, messages
 from acme.jose.jwk import JWKRSA
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
@@ -28,19 +30,22 @@ logger = logging.getLogger(__name__)
 
 class LE(BaseSSLPlugin):
 
-    def __init__(self, domain, email, instance_name, consul_manager=None):
+    def __init__(self, domain, email, instance_name, consul_manager=None, storage=None):
         self.domain = str(domain)
         self.email = str(email)
         self.instance_name = str(instance_name)
         self.consul_manager = consul_manager
+        self.storage = storage
+        self.csr = None
 
     def upload_csr(self, csr=None):
+        self.csr = csr
         return None
 
     def download_crt(self, id=None):
         try:
             crt, chain, key = _main([self.domain], self.email, self.instance_name,
-                                    consul_manager=self.consul_manager)
+                                    consul_manager=self.consul_manager, csr=self.csr, storage=self.storage)
             return json.dumps({'crt': crt, 'chain': chain, 'key': key})
         finally:
             self.consul_manager.remove_location(self.instance_name, "/acme-validate")
@@ -50,6 +55,42 @@ class LE(BaseSSLPlugin):
         return _revoke(key, cert)
 
 
+class MongoAccountStorage(interfaces.AccountStorage):
+    """
+    MongoAccountStorage keeps one ACME account per (server, email) in
+    MongoDB, so every issuance reuses the same registration instead of
+    creating a new account.
+
+    """
+
+    def __init__(self, storage, server, email):
+        self.storage = storage
+        self.server = server
+        self.email = email
+
+    def find_all(self):
+        doc = self.storage.find_le_account(self.server, self.email)
+        if not doc:
+            return []
+        return [Account(messages.RegistrationResource.json_loads(doc["regr"]),
+                        jose.JWK.json_loads(doc["key"]),
+                        Account.Meta.json_loads(doc["meta"]))]
+
+    def load(self, account_id):
+        for account in self.find_all():
+            if account.id == account_id:
+                return account
+        raise errors.AccountNotFound(account_id)
+
+    def save(self, account):
+        self.storage.store_le_account(self.server, self.email, {
+            "account_id": account.id,
+            "regr": account.regr.json_dumps(),
+            "key": account.key.json_dumps(),
+            "meta": account.meta.json_dumps(),
+        })
+
+
 class ConfigNamespace(object):
     def __init__(self, email, domains):
         self.server = os.environ.get("RPAAS_PLUGIN_LE_URL",
@@ -60,7 +101,7 @@ class ConfigNamespace(object):
         self.tls_sni_01_port = 5001
         self.email = email
         self.domains = domains
-        self.rsa_key_size = 2048
+        self.rsa_key_size = int(os.environ.get("RPAAS_PLUGIN_LE_RSA_KEY_SIZE", 2048))
         self.no_verify_ssl = False
         self.key_dir = './le/key'
         self.accounts_dir = './le/account'
@@ -77,26 +118,79 @@ class ConfigNamespace(object):
         self.must_staple = False
 
 
-def _main(domains=[], email=None, instance_name="", consul_manager=None):
+def _main(domains=[], email=None, instance_name="", consul_manager=None, csr=None, storage=None):
     ns = ConfigNamespace(email, domains)
     config = NamespaceConfig(ns)
     zope.component.provideUtility(config)
 
-    ams = AccountMemoryStorage()
-    acc, acme = register(config, ams)
+    if storage is None:
+        acc, acme = register(config, AccountMemoryStorage())
+    else:
+        acc, acme = _account(config, MongoAccountStorage(storage, ns.server, email))
 
     authenticator = RpaasLeAuthenticator(instance_name, config=config, name='',
                                          consul_manager=consul_manager)
     installer = None
     lec = Client(config, acc, authenticator, installer, acme)
-    certr, chain, key, _ = lec.obtain_certificate(domains)
+    if csr:
+        # the key stays with the caller, which may be RSA or ECDSA
+        csr = util.CSR(file=None, data=csr, form="pem")
+        authzr = _cached_authorizations(storage, ns.server, acc, domains)
+        try:
+            certr, chain = lec.obtain_certificate_from_csr(
+                domains, csr, typ=OpenSSL.crypto.FILETYPE_PEM,
+                authzr=authzr or _new_authorizations(lec, storage, ns.server, acc, domains))
+        except messages.Error:
+            if not authzr:
+                raise
+            logger.info("cached authorizations for {} were refused, validating again".format(domains))
+            storage.remove_le_authorizations(ns.server, acc.id, domains)
+            certr, chain = lec.obtain_certificate_from_csr(
+                domains, csr, typ=OpenSSL.crypto.FILETYPE_PEM,
+                authzr=_new_authorizations(lec, storage, ns.server, acc, domains))
+        key_pem = None
+    else:
+        certr, chain, key, _ = lec.obtain_certificate(domains)
+        key_pem = key.pem
     return (
         OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, certr.body),
         crypto_util.dump_pyopenssl_chain(chain),
-        key.pem,
+        key_pem,
     )
 
 
+def _account(config, account_storage):
+    accounts = account_storage.find_all()
+    if accounts:
+        return accounts[0], acme_from_config_key(config, accounts[0].key)
+    return register(config, account_storage)
+
+
+def _cached_authorizations(storage, server, account, domains):
+    if storage is None:
+        return None
+    min_ttl = int(os.environ.get("RPAAS_PLUGIN_LE_AUTHZ_MIN_TTL", 3600))
+    valid_until = datetime.datetime.utcnow() + datetime.timedelta(seconds=min_ttl)
+    cached = storage.find_le_authorizations(server, account.id, domains, valid_until)
+    if set(cached) != set(domains):
+        return None
+    return [messages.AuthorizationResource.json_loads(cached[domain]) for domain in domains]
+
+
+def _new_authorizations(lec, storage, server, account, domains):
+    authzr = lec.auth_handler.get_authorizations(domains)
+    if storage is not None:
+        for authorization in authzr:
+            expires = authorization.body.expires
+            if expires is None:
+                continue
+            if expires.tzinfo is not None:
+                expires = expires.astimezone(pytz.UTC).replace(tzinfo=None)
+            storage.store_le_authorization(server, account.id, authorization.body.identifier.value,
+                                           authorization.json_dumps(), expires)
+    return authzr
+
+
 def _revoke(rawkey, rawcert):
     ns = ConfigNamespace(None)
     acme = acme_client.Client(ns.server, key=JWKRSA(
@@ -20,7 +20,7 @@ class LeRenewer(scheduler.JobScheduler):
     def __init__(self, config=None, *args, **kwargs):
         super(LeRenewer, self).__init__(config, *args, **kwargs)
         self.config = config or dict(os.environ)
-        self.interval = int(self.config.get("LE_RENEWER_RUN_INTERVAL", 86400))
+        self.interval = int(self.config.get("LE_RENEWER_RUN_INTERVAL", 3600))
         self.last_run_key = self.get_last_run_key("LE_RENEWER")
 
     def run(self):
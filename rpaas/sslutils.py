@@ -11,7 +11,7 @@ import base64
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 from cryptography.x509.oid import NameOID
 from hm.model.load_balancer import LoadBalancer
 
@@ -23,12 +23,20 @@ def generate_session_ticket(length=48):
     return base64.b64encode(os.urandom(length))
 
 
-def generate_key(serialized=False):
-    key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=2048,
-        backend=default_backend()
-    )
+KEY_TYPES = ("rsa2048", "rsa4096", "ecdsa-p256", "ecdsa-p384")
+
+
+def generate_key(serialized=False, key_type="rsa2048"):
+    if key_type == "rsa2048":
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    elif key_type == "rsa4096":
+        key = rsa.generate_private_key(public_exponent=65537, key_size=4096, backend=default_backend())
+    elif key_type == "ecdsa-p256":
+        key = ec.generate_private_key(ec.SECP256R1(), backend=default_backend())
+    elif key_type == "ecdsa-p384":
+        key = ec.generate_private_key(ec.SECP384R1(), backend=default_backend())
+    else:
+        raise ValueError("invalid key type {}, expected one of {}".format(key_type, ", ".join(KEY_TYPES)))
     if serialized:
         return key.private_bytes(
             encoding=serialization.Encoding.PEM,
@@ -38,6 +46,50 @@ def generate_key(serialized=False):
     return key
 
 
+def key_types(config, metadata=None):
+    value = (metadata or {}).get("ssl_key_types") or config.get("SSL_KEY_TYPES") or "rsa2048"
+    types = []
+    for key_type in value.split(","):
+        key_type = key_type.strip()
+        if key_type not in KEY_TYPES:
+            raise ValueError("invalid key type {}, expected one of {}".format(key_type, ", ".join(KEY_TYPES)))
+        if key_type_algorithm(key_type) in [key_type_algorithm(t) for t in types]:
+            raise ValueError("only one key type per algorithm is allowed, got {}".format(value))
+        types.append(key_type)
+    return types
+
+
+def key_type_algorithm(key_type):
+    if key_type.startswith("ecdsa"):
+        return "ecdsa"
+    return "rsa"
+
+
+def key_algorithm(key):
+    try:
+        private_key = serialization.load_pem_private_key(str(key), password=None, backend=default_backend())
+    except (TypeError, ValueError):
+        return None
+    if isinstance(private_key, ec.EllipticCurvePrivateKey):
+        return "ecdsa"
+    if isinstance(private_key, rsa.RSAPrivateKey):
+        return "rsa"
+    return None
+
+
+def certificate_expiry(cert):
+    try:
+        return x509.load_pem_x509_certificate(str(cert), backend=default_backend()).not_valid_after
+    except (TypeError, ValueError):
+        return None
+
+
+def certificates_expiry(certificates):
+    expiries = [certificate_expiry(cert) for _, cert, _ in certificates]
+    expiries = [expiry for expiry in expiries if expiry is not None]
+    return min(expiries) if expiries else None
+
+
 def generate_csr(key, domainname):
     private_key = serialization.load_pem_private_key(key, password=None,
                                                      backend=default_backend())
@@ -63,36 +115,46 @@ def generate_crt(config, name, plugin, csr, key, domain):
     strg = storage.MongoDBStorage(config)
     consul_mngr = consul_manager.ConsulManager(config)
 
-    crt = None
-
     plugin_class = ssl_plugins.get(plugin)
     if not plugin_class:
         raise Exception("Invalid plugin {}".format(plugin))
-    plugin_obj = plugin_class(domain, os.environ.get('RPAAS_PLUGIN_LE_EMAIL', 'admin@'+domain),
-                              name, consul_manager=consul_mngr)
 
-    #  Upload csr and get an Id
-    plugin_id = plugin_obj.upload_csr(csr)
-    crt = plugin_obj.download_crt(id=str(plugin_id))
-
-    #  Download the certificate and update nginx with it
-    if crt:
+    #  The caller's key is the primary one, additional algorithms (e.g. an
+    #  ECDSA certificate next to the RSA one) get their keys generated here
+    orders = [(csr, key)]
+    for key_type in key_types(config)[1:]:
+        extra_key = generate_key(True, key_type)
+        orders.append((generate_csr(extra_key, domain), extra_key))
+
+    certificates = []
+    for csr, key in orders:
+        plugin_obj = plugin_class(domain, os.environ.get('RPAAS_PLUGIN_LE_EMAIL', 'admin@'+domain),
+                                  name, consul_manager=consul_mngr, storage=strg)
+
+        #  Upload csr and get an Id
+        plugin_id = plugin_obj.upload_csr(csr)
+        crt = plugin_obj.download_crt(id=str(plugin_id))
+        if not crt:
+            raise Exception('Could not download certificate')
         try:
             js_crt = json.loads(crt)
             cert = js_crt['crt']
             cert = cert+js_crt['chain'] if 'chain' in js_crt else cert
-            key = js_crt['key'] if 'key' in js_crt else key
+            key = js_crt.get('key') or key
         except:
             cert = crt
+        certificates.append((key_algorithm(key), cert, key))
 
-        consul_mngr.set_certificate(name, cert, key)
-        strg.store_le_certificate(name, domain)
-    else:
-        raise Exception('Could not download certificate')
+    #  Update nginx with the downloaded certificates
+    consul_mngr.set_certificates(name, certificates)
+    expires = certificates_expiry(certificates)
+    strg.store_le_certificate(name, domain, expires)
+    strg.store_instance_certificate(name, expires, source=plugin, domain=domain)
 
 
-def generate_admin_crt(config, host):
-    private_key = generate_key()
+def generate_admin_crt(config, host, private_key=None):
+    if private_key is None:
+        private_key = generate_key()
     public_key = private_key.public_key()
     one_day = datetime.timedelta(1, 0, 0)
     ca_cert = config.get("CA_CERT", None)
@@ -4,11 +4,12 @@
 
 import datetime
 
+import pymongo
 import pymongo.errors
 
-from hm import storage
+from hm import config, storage
 
-from rpaas import plan, flavor
+from rpaas import plan, flavor, effective_config
 
 
 class InstanceNotFoundError(Exception):
@@ -36,7 +37,110 @@ class MongoDBStorage(storage.MongoDBStorage):
     instance_metadata_collection = "instance_metadata"
     quota_collection = "quota"
     le_certificates_collection = "le_certificates"
+    le_accounts_collection = "le_accounts"
+    le_authorizations_collection = "le_authorizations"
+    instance_certificates_collection = "instance_certificates"
     healing_collection = "healing"
+    purge_tasks_collection = "purge_tasks"
+
+    indexes = [
+        (tasks_collection, [("created", pymongo.ASCENDING)]),
+        (tasks_collection, [("last_attempt", pymongo.ASCENDING)]),
+        (healing_collection, [("start_time", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]),
+        (healing_collection, [("instance", pymongo.ASCENDING), ("start_time", pymongo.DESCENDING),
+                              ("_id", pymongo.DESCENDING)]),
+        (le_certificates_collection, [("created", pymongo.ASCENDING)]),
+        (le_certificates_collection, [("expires", pymongo.ASCENDING)]),
+        (le_certificates_collection, [("renewal.status", pymongo.ASCENDING),
+                                      ("renewal.scheduled_at", pymongo.ASCENDING)]),
+        (le_authorizations_collection, [("server", pymongo.ASCENDING), ("account_id", pymongo.ASCENDING),
+                                        ("domain", pymongo.ASCENDING)]),
+        (instance_certificates_collection, [("expires", pymongo.ASCENDING)]),
+        (storage.MongoDBStorage.hosts_collection, [("dns_name", pymongo.ASCENDING)]),
+        (quota_collection, [("used", pymongo.ASCENDING)]),
+    ]
+
+    def ensure_indexes(self):
+        created = []
+        for collection, keys in self.indexes:
+            name = self.db[collection].create_index(keys, background=True)
+            created.append({"collection": collection, "index": name})
+        # healings (and purge task records below) only expire once these TTL
+        # indexes exist, i.e. after ensure_indexes ran (POST /admin/indexes).
+        # Healings expire by start_time: a healing whose worker died never
+        # gets an end_time and would otherwise be kept forever.
+        ttl = int(config.get_config("RPAAS_HEALING_TTL", 30 * 24 * 3600, self.config))
+        if "end_time_1" in self.db[self.healing_collection].index_information():
+            self.db[self.healing_collection].drop_index("end_time_1")
+        if ttl > 0:
+            created.append({"collection": self.healing_collection,
+                            "index": self._ensure_ttl_index(self.healing_collection, "start_time", ttl)})
+        created.append({"collection": self.le_authorizations_collection,
+                        "index": self._ensure_ttl_index(self.le_authorizations_collection, "expires", 0)})
+        purge_ttl = int(config.get_config("RPAAS_PURGE_TASK_TTL", 24 * 3600, self.config))
+        created.append({"collection": self.purge_tasks_collection,
+                        "index": self._ensure_ttl_index(self.purge_tasks_collection, "created", purge_ttl)})
+        return created
+
+    def _ensure_ttl_index(self, collection, field, ttl):
+        try:
+            return self.db[collection].create_index([(field, pymongo.ASCENDING)], background=True,
+                                                    expireAfterSeconds=ttl)
+        except pymongo.errors.OperationFailure as e:
+            if e.code != 85:
+                raise
+            self.db.command("collMod", collection, index={"keyPattern": {field: pymongo.ASCENDING},
+                                                          "expireAfterSeconds": ttl})
+            return "{}_1".format(field)
+
+    def index_queries(self, now=None):
+        now = now or datetime.datetime.utcnow()
+        return [
+            ("restore tasks", self.tasks_collection,
+             {"_id": {"$regex": "^restore_.+"}, "created": {"$lte": now}}, None),
+            ("failed restore tasks", self.tasks_collection,
+             {"_id": {"$regex": "^restore_.+"}, "last_attempt": {"$ne": None}}, None),
+            ("healing history", self.healing_collection, {},
+             [("start_time", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]),
+            ("instance healing history", self.healing_collection,
+             {"instance": "", "start_time": {"$lt": now}},
+             [("start_time", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]),
+            ("expiring certificates", self.le_certificates_collection, {"created": {"$lte": now}}, None),
+            ("expiring le certificates", self.le_certificates_collection, {"expires": {"$lte": now}}, None),
+            ("expiring instance certificates", self.instance_certificates_collection,
+             {"expires": {"$lte": now}}, [("expires", pymongo.ASCENDING)]),
+            ("renewals in flight", self.le_certificates_collection,
+             {"renewal.status": "scheduled", "renewal.scheduled_at": {"$gt": now}}, None),
+            ("cached acme authorizations", self.le_authorizations_collection,
+             {"server": "", "account_id": "", "domain": {"$in": [""]}, "expires": {"$gt": now}}, None),
+            ("host by dns name", self.hosts_collection, {"dns_name": ""}, None),
+            ("quota owner", self.quota_collection, {"used": ""}, None),
+        ]
+
+    def index_report(self):
+        report = []
+        for description, collection, query, sort in self.index_queries():
+            cursor = self.db[collection].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            stages, indexes = self._plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+            report.append({"query": description, "collection": collection, "stages": stages,
+                           "indexes": indexes, "indexed": bool(indexes) and "COLLSCAN" not in stages})
+        return report
+
+    def _plan_stages(self, plan):
+        stages = []
+        indexes = []
+        pending = [plan]
+        while pending:
+            stage = pending.pop()
+            stages.append(stage.get("stage"))
+            if stage.get("indexName"):
+                indexes.append(stage["indexName"])
+            if "inputStage" in stage:
+                pending.append(stage["inputStage"])
+            pending.extend(stage.get("inputStages", []))
+        return stages, indexes
 
     def store_hc(self, hc):
         self.db[self.hcs_collections].update({"_id": hc["_id"]}, hc, upsert=True)
@@ -56,9 +160,27 @@ class MongoDBStorage(storage.MongoDBStorage):
                                                 {"$set": {"status": status,
                                                           "end_time": datetime.datetime.utcnow()}})
 
-    def list_healings(self, quantity):
+    def list_healings(self, quantity, instance=None, machine=None, status=None, since=None, until=None,
+                      before=None, before_id=None):
+        query = {}
+        for field, value in (("instance", instance), ("machine", machine), ("status", status)):
+            if value is not None:
+                query[field] = value
+        start_time = {}
+        if since is not None:
+            start_time["$gte"] = since
+        if until is not None:
+            start_time["$lte"] = until
+        if before is not None and before_id is None:
+            start_time["$lt"] = before
+        if start_time:
+            query["start_time"] = start_time
+        if before is not None and before_id is not None:
+            # healings started at the same time are told apart by _id
+            query["$or"] = [{"start_time": {"$lt": before}},
+                            {"start_time": before, "_id": {"$lt": before_id}}]
         coll = self.healing_collection
-        healings = self.db[coll].find({}, {'_id': 0}).sort("start_time", -1).limit(quantity)
+        healings = self.db[coll].find(query).sort([("start_time", -1), ("_id", -1)]).limit(quantity)
         return [healing for healing in healings]
 
     def store_task(self, name):
@@ -70,6 +192,13 @@ class MongoDBStorage(storage.MongoDBStorage):
         except pymongo.errors.DuplicateKeyError:
             raise DuplicateError(name)
 
+    def store_tasks(self, tasks):
+        try:
+            self.db[self.tasks_collection].insert_many(tasks, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+
     def remove_task(self, query):
         self.db[self.tasks_collection].remove(query)
 
@@ -79,12 +208,24 @@ class MongoDBStorage(storage.MongoDBStorage):
         else:
             self.db[self.tasks_collection].update({'_id': name}, {'$set': {'task_id': task_id_or_spec}})
 
+    def increment_task_progress(self, name, field):
+        return self.db[self.tasks_collection].find_one_and_update(
+            {'_id': name}, {'$inc': {'progress.{}'.format(field): 1}},
+            return_document=pymongo.ReturnDocument.AFTER)
+
     def find_task(self, query):
         if isinstance(query, dict):
             return self.db[self.tasks_collection].find(query)
         else:
             return self.db[self.tasks_collection].find({"_id": query})
 
+    def store_purge_task(self, name, task_id):
+        self.db[self.purge_tasks_collection].insert({"_id": task_id, "instance": name,
+                                                     "created": datetime.datetime.utcnow()})
+
+    def find_purge_task(self, name, task_id):
+        return self.db[self.purge_tasks_collection].find_one({"_id": task_id, "instance": name})
+
     def store_instance_metadata(self, instance_name, **data):
         data['_id'] = instance_name
         self.db[self.instance_metadata_collection].update({'_id': instance_name},
@@ -93,9 +234,17 @@ class MongoDBStorage(storage.MongoDBStorage):
     def find_instance_metadata(self, instance_name):
         return self.db[self.instance_metadata_collection].find_one({'_id': instance_name})
 
+    def find_instances_metadata(self, instance_names):
+        docs = self.db[self.instance_metadata_collection].find({'_id': {'$in': list(instance_names)}})
+        return dict((doc['_id'], doc) for doc in docs)
+
     def find_host_id(self, name):
         return self.db[self.hosts_collection].find_one({'dns_name': name})
 
+    def find_host_dns_names(self, names):
+        hosts = self.db[self.hosts_collection].find({'dns_name': {'$in': list(names)}}, {'dns_name': 1})
+        return set(host['dns_name'] for host in hosts)
+
     def remove_instance_metadata(self, instance_name):
         self.db[self.instance_metadata_collection].remove({'_id': instance_name})
 
@@ -120,11 +269,13 @@ class MongoDBStorage(storage.MongoDBStorage):
                                                            {"$set": update})
             if not result.get("updatedExisting"):
                 raise PlanNotFoundError()
+            effective_config.bump_version("plan", name)
 
     def delete_plan(self, name):
         result = self.db[self.plans_collection].remove({"_id": name})
         if result.get("n", 0) < 1:
             raise PlanNotFoundError()
+        effective_config.bump_version("plan", name)
 
     def find_plan(self, name):
         plan_dict = self.db[self.plans_collection].find_one({'_id': name})
@@ -162,11 +313,13 @@ class MongoDBStorage(storage.MongoDBStorage):
                                                              {"$set": update})
             if not result.get("updatedExisting"):
                 raise FlavorNotFoundError()
+            effective_config.bump_version("flavor", name)
 
     def delete_flavor(self, name):
         result = self.db[self.flavors_collection].remove({"_id": name})
         if result.get("n", 0) < 1:
             raise FlavorNotFoundError()
+        effective_config.bump_version("flavor", name)
 
     def find_flavor(self, name):
         flavor_dict = self.db[self.flavors_collection].find_one({'_id': name})
@@ -263,23 +416,98 @@ class MongoDBStorage(storage.MongoDBStorage):
             {'$addToSet': {'used': servicename}})
         return result['n'] == 1
 
-    def decrement_quota(self, servicename):
-        self.db[self.quota_collection].update({}, {'$pull': {'used': servicename}}, multi=True)
+    def decrement_quota(self, servicename, teamname=None):
+        if teamname is not None:
+            self.db[self.quota_collection].update({'_id': teamname}, {'$pull': {'used': servicename}})
+        else:
+            self.db[self.quota_collection].update({'used': servicename}, {'$pull': {'used': servicename}},
+                                                  multi=True)
 
-    def store_le_certificate(self, name, domain):
+    def store_le_certificate(self, name, domain, expires=None):
         doc = {"_id": name, "domain": domain,
                "created": datetime.datetime.utcnow()}
+        if expires is not None:
+            doc["expires"] = expires
         self.db[self.le_certificates_collection].update({"_id": name}, doc,
                                                         upsert=True)
 
     def remove_le_certificate(self, name, domain):
         self.db[self.le_certificates_collection].remove({"_id": name, "domain": domain})
 
-    def find_le_certificates(self, query):
+    def store_le_account(self, server, email, account):
+        doc = dict(account, server=server, email=email, created=datetime.datetime.utcnow())
+        doc["_id"] = "{} {}".format(server, email)
+        self.db[self.le_accounts_collection].update({"_id": doc["_id"]}, doc, upsert=True)
+
+    def find_le_account(self, server, email):
+        return self.db[self.le_accounts_collection].find_one({"_id": "{} {}".format(server, email)})
+
+    def store_le_authorization(self, server, account_id, domain, authorization, expires):
+        query = {"server": server, "account_id": account_id, "domain": domain}
+        doc = dict(query, authorization=authorization, expires=expires)
+        self.db[self.le_authorizations_collection].update(query, doc, upsert=True)
+
+    def find_le_authorizations(self, server, account_id, domains, valid_until):
+        query = {"server": server, "account_id": account_id, "domain": {"$in": list(domains)},
+                 "expires": {"$gt": valid_until}}
+        return dict((doc["domain"], doc["authorization"])
+                    for doc in self.db[self.le_authorizations_collection].find(query))
+
+    def remove_le_authorizations(self, server, account_id, domains):
+        self.db[self.le_authorizations_collection].remove({"server": server, "account_id": account_id,
+                                                           "domain": {"$in": list(domains)}})
+
+    def count_le_renewals_in_flight(self, since):
+        return self.db[self.le_certificates_collection].find({"renewal.status": "scheduled",
+                                                              "renewal.scheduled_at": {"$gt": since}}).count()
+
+    def schedule_le_renewals(self, names):
+        self.db[self.le_certificates_collection].update_many(
+            {"_id": {"$in": list(names)}},
+            {"$set": {"renewal.status": "scheduled", "renewal.scheduled_at": datetime.datetime.utcnow()}})
+
+    def fail_le_renewal(self, name, error):
+        backoff = int(config.get_config("LE_RENEWAL_RETRY_BACKOFF", 3600, self.config))
+        max_backoff = int(config.get_config("LE_RENEWAL_MAX_RETRY_BACKOFF", 86400, self.config))
+        now = datetime.datetime.utcnow()
+        certificate = self.db[self.le_certificates_collection].find_one_and_update(
+            {"_id": name},
+            {"$set": {"renewal.status": "failed", "renewal.error": error, "renewal.failed_at": now},
+             "$inc": {"renewal.attempts": 1}},
+            return_document=pymongo.ReturnDocument.AFTER)
+        if certificate is None:
+            return None
+        attempts = certificate["renewal"]["attempts"]
+        delay = min(backoff * 2 ** (attempts - 1), max_backoff)
+        next_attempt = now + datetime.timedelta(seconds=delay)
+        self.db[self.le_certificates_collection].update({"_id": name},
+                                                        {"$set": {"renewal.next_attempt": next_attempt}})
+        return next_attempt
+
+    def store_instance_certificate(self, name, expires, source=None, domain=None):
+        doc = {"expires": expires, "updated": datetime.datetime.utcnow()}
+        if source:
+            doc["source"] = source
+        if domain:
+            doc["domain"] = domain
+        self.db[self.instance_certificates_collection].update({"_id": name}, {"$set": doc}, upsert=True)
+
+    def remove_instance_certificate(self, name):
+        self.db[self.instance_certificates_collection].remove({"_id": name})
+
+    def find_expiring_certificates(self, until):
+        certificates = self.db[self.instance_certificates_collection].find({"expires": {"$lte": until}})
+        for certificate in certificates.sort("expires", pymongo.ASCENDING):
+            certificate["instance"] = certificate.pop("_id")
+            yield certificate
+
+    def find_le_certificates(self, query, sort=None, limit=0):
         if "name" in query:
             query["_id"] = query["name"]
             del query["name"]
-        certificates = self.db[self.le_certificates_collection].find(query)
+        certificates = self.db[self.le_certificates_collection].find(query, limit=limit)
+        if sort:
+            certificates = certificates.sort(sort)
         for certificate in certificates:
             certificate["name"] = certificate["_id"]
             del certificate["_id"]
@@ -6,10 +6,15 @@ import copy
 import datetime
 import logging
 import os
+import random
 import sys
+import threading
+import time
+from collections import OrderedDict
 from urlparse import urlparse
 
 from celery import Celery, Task
+from concurrent import futures
 import hm.managers.cloudstack  # NOQA
 import hm.lb_managers.cloudstack  # NOQA
 import hm.lb_managers.networkapi_cloudstack  # NOQA
@@ -19,7 +24,7 @@ from hm.model.host import Host
 from hm.model.load_balancer import LoadBalancer
 
 from rpaas import (consul_manager, hc, nginx, sslutils, ssl_plugins,
-                   storage, celery_sentinel, acl, lock)
+                   storage, celery_sentinel, acl, lock, effective_config, purge, keypool)
 from rpaas.misc import check_option_enable
 
 possible_redis_envs = ['SENTINEL_ENDPOINT', 'DBAAS_SENTINEL_ENDPOINT', 'REDIS_ENDPOINT']
@@ -131,6 +136,9 @@ class BaseManagerTask(Task):
         self.lock_manager = lock.Lock(app.backend.client)
         self.hc = hc.Dumb()
         self.storage = storage.MongoDBStorage(config)
+        self.lb_lock = threading.Lock()
+        self.config_resolver = effective_config.EffectiveConfigResolver(
+            self.storage, ttl=int(self._get_conf("RPAAS_EFFECTIVE_CONFIG_TTL", 0)))
         self.acl_manager = acl.Dumb(self.consul_manager)
         if check_option_enable(self._get_conf("CHECK_ACL_API", None)):
             self.acl_manager = acl.AclManager(config, self.consul_manager, lock.Lock(app.backend.client))
@@ -145,9 +153,10 @@ class BaseManagerTask(Task):
     def _get_conf(self, key, default=config.undefined):
         return config.get_config(key, default, self.config)
 
-    def _add_host(self, name, lb=None):
+    def _add_host(self, name, lb=None, remove_task=True):
         healthcheck_timeout = int(self._get_conf("RPAAS_HEALTHCHECK_TIMEOUT", 600))
         created_lb = None
+        host = None
         try:
             if not lb:
                 lb = created_lb = LoadBalancer.create(self.lb_manager_name, name, self.config)
@@ -156,52 +165,127 @@ class BaseManagerTask(Task):
             if hasattr(lb, 'dsr') and lb.dsr:
                 config["HOST_TAGS"] = config["HOST_TAGS"] + ",dsr_ip:{}".format(lb.address)
             host = Host.create(self.host_manager_name, name, config)
-            lb.add_host(host)
-            self.nginx_manager.wait_healthcheck(host.dns_name, timeout=healthcheck_timeout)
-            acls = self.consul_manager.find_acl_network(name)
-            if acls:
-                acl_host = acls.pop()
-                for dst in acl_host['destination']:
-                    self.acl_manager.add_acl(name, host.dns_name, dst)
-            self.hc.add_url(name, host.dns_name)
+            with self.lb_lock:
+                lb.add_host(host)
+            if self._async_healthcheck():
+                WaitHealthyTask().delay(self.config, name, host.id, host.dns_name,
+                                        time.time() + healthcheck_timeout, created_lb is not None,
+                                        not remove_task)
+                remove_task = False
+                return
+            self._wait_healthy(host.dns_name, healthcheck_timeout)
+            self._finish_host(name, host.dns_name)
         except:
             exc_info = sys.exc_info()
-            rollback = self._get_conf("RPAAS_ROLLBACK_ON_ERROR", "0") in ("True", "true", "1")
-            if not rollback:
+            if not self._rollback_enabled():
                 raise
-            try:
-                if created_lb is not None:
-                    created_lb.destroy()
-            except Exception as e:
-                logging.error("Error in rollback trying to destroy load balancer: {}".format(e))
-            try:
-                if created_lb is not None:
-                    self._delete_host(name, host)
-                else:
-                    self._delete_host(name, host, lb)
-            except Exception as e:
-                logging.error("Error in rollback trying to destroy host: {}".format(e))
-            try:
-                if lb and len(lb.hosts) == 0:
-                    self.hc.destroy(name)
-            except Exception as e:
-                logging.error("Error in rollback trying to remove healthcheck: {}".format(e))
+            self._rollback_host(name, host, lb, created_lb is not None, remove_task=False)
             raise exc_info[0], exc_info[1], exc_info[2]
         finally:
-            self.storage.remove_task(name)
+            if remove_task:
+                self.storage.remove_task(name)
+
+    def _finish_host(self, name, dns_name):
+        acls = self.consul_manager.find_acl_network(name)
+        if acls:
+            acl_host = acls.pop()
+            for dst in acl_host['destination']:
+                self.acl_manager.add_acl(name, dns_name, dst)
+        self.hc.add_url(name, dns_name)
 
-    def _delete_host(self, name, host, lb=None):
+    def _rollback_enabled(self):
+        return self._get_conf("RPAAS_ROLLBACK_ON_ERROR", "0") in ("True", "true", "1")
+
+    def _rollback_host(self, name, host, lb, created_lb, remove_task=True):
+        try:
+            if created_lb:
+                lb.destroy()
+        except Exception as e:
+            logging.error("Error in rollback trying to destroy load balancer: {}".format(e))
+        try:
+            if host is None:
+                pass
+            elif created_lb:
+                self._delete_host(name, host, remove_task=remove_task)
+            else:
+                self._delete_host(name, host, lb, remove_task=remove_task)
+        except Exception as e:
+            logging.error("Error in rollback trying to destroy host: {}".format(e))
+        try:
+            if lb and len(lb.hosts) == 0:
+                self.hc.destroy(name)
+        except Exception as e:
+            logging.error("Error in rollback trying to remove healthcheck: {}".format(e))
+
+    def _async_healthcheck(self):
+        return check_option_enable(self._get_conf("RPAAS_HEALTHCHECK_ASYNC", None))
+
+    def _host_done(self, name, result, track_progress):
+        if track_progress:
+            task = self.storage.increment_task_progress(name, result)
+            if task is not None:
+                progress = task["progress"]
+                if progress.get("added", 0) + progress.get("failed", 0) < progress["total"]:
+                    return
+        self.storage.remove_task(name)
+
+    def _wait_healthy(self, host, timeout):
+        if self._get_conf("RPAAS_HEALTHCHECK_WAIT_MODE", "http") == "consul":
+            self.consul_manager.wait_healthy(host, timeout=timeout)
+        else:
+            self.nginx_manager.wait_healthcheck(host, timeout=timeout)
+
+    def _check_healthy(self, host):
+        if self._get_conf("RPAAS_HEALTHCHECK_WAIT_MODE", "http") == "consul":
+            if not self.consul_manager.is_healthy(host):
+                raise consul_manager.NodeNotHealthyError("nginx on {} not healthy in consul".format(host))
+        else:
+            self.nginx_manager.healthcheck(host)
+
+    def _delete_host(self, name, host, lb=None, node_names=None, remove_task=True):
         try:
-            node_name = self.consul_manager.node_hostname(host.dns_name)
+            if node_names is None:
+                node_name = self.consul_manager.node_hostname(host.dns_name)
+            else:
+                node_name = node_names.get(host.dns_name)
             host.destroy()
             if lb is not None:
-                lb.remove_host(host)
+                with self.lb_lock:
+                    lb.remove_host(host)
             if node_name is not None:
                 self.consul_manager.remove_node(name, node_name, host.id)
             self.acl_manager.remove_acl(name, host.dns_name)
             self.hc.remove_url(name, host.dns_name)
         finally:
-            self.storage.remove_task(name)
+            if remove_task:
+                self.storage.remove_task(name)
+
+
+class WaitHealthyTask(BaseManagerTask):
+
+    def run(self, config, name, host_id, dns_name, deadline, created_lb=False, track_progress=False):
+        self.init_config(config)
+        try:
+            try:
+                self._check_healthy(dns_name)
+            except Exception:
+                if time.time() < deadline:
+                    interval = float(self._get_conf("RPAAS_HEALTHCHECK_ASYNC_INTERVAL", 5))
+                    self.apply_async(args=[config, name, host_id, dns_name, deadline, created_lb, track_progress],
+                                     countdown=interval)
+                    return
+                raise
+            self._finish_host(name, dns_name)
+        except:
+            exc_info = sys.exc_info()
+            logging.error("Host {} of {} did not become healthy: {}".format(dns_name, name, exc_info[1]))
+            if self._rollback_enabled():
+                lb = LoadBalancer.find(name, self.config)
+                hosts = [host for host in (lb.hosts if lb else []) if host.id == host_id]
+                self._rollback_host(name, hosts[0] if hosts else None, lb, created_lb, remove_task=False)
+            self._host_done(name, "failed", track_progress)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._host_done(name, "added", track_progress)
 
 
 class NewInstanceTask(BaseManagerTask):
@@ -222,8 +306,10 @@ class RemoveInstanceTask(BaseManagerTask):
         lb = LoadBalancer.find(name, self.config)
         if lb is None:
             raise storage.InstanceNotFoundError()
-        for host in lb.hosts:
-            self._delete_host(name, host, lb)
+        hosts = list(lb.hosts)
+        node_names = self.consul_manager.node_hostnames([host.dns_name for host in hosts])
+        for host in hosts:
+            self._delete_host(name, host, lb, node_names)
         self.consul_manager.destroy_instance(name)
         if self._should_destroy_lb():
             lb.destroy()
@@ -237,6 +323,7 @@ class RemoveInstanceTask(BaseManagerTask):
 class ScaleInstanceTask(BaseManagerTask):
 
     def run(self, config, name, quantity):
+        keep_task = False
         try:
             self.init_config(config)
             lb = LoadBalancer.find(name, self.config)
@@ -245,13 +332,76 @@ class ScaleInstanceTask(BaseManagerTask):
             diff = int(quantity) - len(lb.hosts)
             if diff == 0:
                 return
-            for i in xrange(abs(diff)):
-                if diff > 0:
-                    self._add_host(name, lb=lb)
-                else:
-                    self._delete_host(name, lb.hosts[i], lb)
+            if diff > 0:
+                progress = {"total": diff, "added": 0, "failed": 0}
+                try:
+                    self._add_hosts(name, lb, progress)
+                finally:
+                    # hosts handed to WaitHealthyTask release the task
+                    # once the last of them is done
+                    keep_task = self._async_healthcheck() and progress["added"] > 0
+                return
+            hosts = lb.hosts[:abs(diff)]
+            node_names = self.consul_manager.node_hostnames([host.dns_name for host in hosts])
+            for host in hosts:
+                self._delete_host(name, host, lb, node_names, remove_task=False)
         finally:
-            self.storage.remove_task(name)
+            if not keep_task:
+                self.storage.remove_task(name)
+
+    def _add_hosts(self, name, lb, progress):
+        # hosts are created a few at a time by default; set
+        # RPAAS_SCALE_CONCURRENCY=1 to add them one after the other
+        concurrency = max(1, int(self._get_conf("RPAAS_SCALE_CONCURRENCY", 4)))
+        quantity = progress["total"]
+        self.storage.update_task(name, {"progress": progress})
+        # with async healthchecks hosts are only counted as added by
+        # WaitHealthyTask, so progress is incremented in place instead of
+        # being overwritten from here.
+        async_healthcheck = self._async_healthcheck()
+        first_error = None
+        with futures.ThreadPoolExecutor(max_workers=min(concurrency, quantity)) as executor:
+            jobs = [executor.submit(self._add_host, name, lb, False) for _ in xrange(quantity)]
+            for job in futures.as_completed(jobs):
+                if job.cancelled():
+                    if async_healthcheck:
+                        self._host_done(name, "failed", True)
+                    continue
+                try:
+                    job.result()
+                    progress["added"] += 1
+                except Exception:
+                    progress["failed"] += 1
+                    if async_healthcheck:
+                        self._host_done(name, "failed", True)
+                    if first_error is None:
+                        first_error = sys.exc_info()
+                        for pending in jobs:
+                            pending.cancel()
+                if not async_healthcheck:
+                    self.storage.update_task(name, {"progress": progress})
+        if first_error is not None:
+            logging.error("Scale of {} stopped after {} of {} hosts added".format(name, progress["added"], quantity))
+            raise first_error[0], first_error[1], first_error[2]
+
+
+class PurgeLocationsTask(BaseManagerTask):
+    ignore_result = False
+
+    def run(self, config, name, purges):
+        self.init_config(config)
+        lb = LoadBalancer.find(name, self.config)
+        if lb is None:
+            raise storage.InstanceNotFoundError()
+        concurrency = max(1, int(self._get_conf("RPAAS_PURGE_CONCURRENCY", 16)))
+        timeout = float(self._get_conf("RPAAS_PURGE_BULK_TIMEOUT", 120))
+        executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            bulk_purge = purge.BulkPurge(self.nginx_manager, executor)
+            results = list(bulk_purge.run([host.dns_name for host in lb.hosts], purges, timeout))
+        finally:
+            executor.shutdown(wait=False)
+        return {"name": name, "results": results}
 
 
 class RestoreMachineTask(BaseManagerTask):
@@ -261,42 +411,96 @@ class RestoreMachineTask(BaseManagerTask):
         lock_name = self.config.get("RESTORE_LOCK_NAME", "restore_lock")
         healthcheck_timeout = int(self._get_conf("RPAAS_HEALTHCHECK_TIMEOUT", 600))
         restore_delay = int(self.config.get("RESTORE_MACHINE_DELAY", 5))
+        concurrency = max(1, int(self.config.get("RESTORE_MACHINE_CONCURRENCY", 1)))
         created_in = datetime.datetime.utcnow() - datetime.timedelta(minutes=restore_delay)
-        restore_query = {"_id": {"$regex": "restore_.+"}, "created": {"$lte": created_in}}
+        restore_query = {"_id": {"$regex": "^restore_.+"}, "created": {"$lte": created_in}}
         if self.lock_manager.lock(lock_name, timeout=(healthcheck_timeout + 60)):
-            for task in self.storage.find_task(restore_query):
-                try:
-                    start_time = datetime.datetime.utcnow()
-                    self._restore_machine(task, config, healthcheck_timeout)
-                    elapsed_time = datetime.datetime.utcnow() - start_time
-                    self.lock_manager.extend_lock(lock_name, extra_time=elapsed_time.seconds)
-                except Exception as e:
-                    self.storage.update_task(task['_id'], {"last_attempt": datetime.datetime.utcnow()})
-                    self.lock_manager.unlock(lock_name)
-                    raise e
-            self.lock_manager.unlock(lock_name)
+            try:
+                restore_tasks = self._pending_restores(restore_query)
+                if concurrency == 1:
+                    self._restore_serial(restore_tasks, config, healthcheck_timeout, lock_name)
+                else:
+                    self._restore_parallel(restore_tasks, config, healthcheck_timeout, lock_name, concurrency)
+            finally:
+                self.lock_manager.unlock(lock_name)
 
-    def _restore_machine(self, task, config, healthcheck_timeout):
+    def _pending_restores(self, restore_query):
         retry_failure_delay = int(self.config.get("RESTORE_MACHINE_FAILURE_DELAY", 5))
+        retry_failure_query = {"_id": {"$regex": "^restore_.+"}, "last_attempt": {"$ne": None}}
+        failure_instances = self._failure_instances(retry_failure_query, retry_failure_delay)
+        return [task for task in self.storage.find_task(restore_query)
+                if task['instance'] not in failure_instances]
+
+    def _restore_serial(self, restore_tasks, config, healthcheck_timeout, lock_name):
+        for task in restore_tasks:
+            try:
+                start_time = datetime.datetime.utcnow()
+                self._restore_machine(task, config, healthcheck_timeout)
+                elapsed_time = datetime.datetime.utcnow() - start_time
+                self.lock_manager.extend_lock(lock_name, extra_time=elapsed_time.seconds)
+            except Exception:
+                self.storage.update_task(task['_id'], {"last_attempt": datetime.datetime.utcnow()})
+                raise
+
+    def _restore_parallel(self, restore_tasks, config, healthcheck_timeout, lock_name, concurrency):
+        # bounds how many hosts of the same instance may be down for restore at once
+        instance_concurrency = max(1, int(self.config.get("RESTORE_MACHINE_INSTANCE_CONCURRENCY", 1)))
+        pending = list(restore_tasks)
+        running = {}
+        running_by_instance = {}
+        failed_instances = set()
+        errors = []
+        last_extension = datetime.datetime.utcnow()
+        executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            while pending or running:
+                for task in list(pending):
+                    if len(running) >= concurrency:
+                        break
+                    instance = task['instance']
+                    if instance in failed_instances:
+                        pending.remove(task)
+                    elif running_by_instance.get(instance, 0) < instance_concurrency:
+                        pending.remove(task)
+                        running_by_instance[instance] = running_by_instance.get(instance, 0) + 1
+                        job = executor.submit(self._restore_machine, task, config, healthcheck_timeout)
+                        running[job] = task
+                if not running:
+                    break
+                done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                for job in done:
+                    task = running.pop(job)
+                    running_by_instance[task['instance']] -= 1
+                    if job.exception() is not None:
+                        self.storage.update_task(task['_id'], {"last_attempt": datetime.datetime.utcnow()})
+                        failed_instances.add(task['instance'])
+                        errors.append(job.exception())
+                now = datetime.datetime.utcnow()
+                self.lock_manager.extend_lock(lock_name, extra_time=(now - last_extension).seconds)
+                last_extension = now
+        finally:
+            executor.shutdown(wait=True)
+        if errors:
+            raise errors[0]
+
+    def _restore_machine(self, task, config, healthcheck_timeout):
         restore_dry_mode = self.config.get("RESTORE_MACHINE_DRY_MODE", False) in ("True", "true", "1")
-        retry_failure_query = {"_id": {"$regex": "restore_.+"}, "last_attempt": {"$ne": None}}
-        if task['instance'] not in self._failure_instances(retry_failure_query, retry_failure_delay):
-            host = self.storage.find_host_id(task['host'])
-            if not restore_dry_mode:
-                healing_id = self.storage.store_healing(task['instance'], task['host'])
-                try:
-                    Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
-                                    "manager": host['manager']}, conf=config).stop(forced=True)
-                    Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
-                                    "manager": host['manager']}, conf=config).restore()
-                    Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
-                                    "manager": host['manager']}, conf=config).start()
-                    self.nginx_manager.wait_healthcheck(task['host'], timeout=healthcheck_timeout)
-                    self.storage.update_healing(healing_id, "success")
-                except Exception as e:
-                    self.storage.update_healing(healing_id, str(e.message))
-                    raise e
-            self.storage.remove_task({"_id": task['_id']})
+        host = self.storage.find_host_id(task['host'])
+        if not restore_dry_mode:
+            healing_id = self.storage.store_healing(task['instance'], task['host'])
+            try:
+                Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
+                                "manager": host['manager']}, conf=config).stop(forced=True)
+                Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
+                                "manager": host['manager']}, conf=config).restore()
+                Host.from_dict({"_id": host['_id'], "dns_name": task['host'],
+                                "manager": host['manager']}, conf=config).start()
+                self._wait_healthy(task['host'], healthcheck_timeout)
+                self.storage.update_healing(healing_id, "success")
+            except Exception as e:
+                self.storage.update_healing(healing_id, str(e.message))
+                raise e
+        self.storage.remove_task({"_id": task['_id']})
 
     def _failure_instances(self, retry_failure_query, retry_failure_delay):
         failure_instances = set()
@@ -309,12 +513,20 @@ class RestoreMachineTask(BaseManagerTask):
 
 class CheckMachineTask(BaseManagerTask):
 
-    def run(self, config):
+    def run(self, config, nodes=None):
         self.init_config(config)
-        for node in self.consul_manager.service_healthcheck():
+        if nodes is None:
+            nodes = self.consul_manager.service_healthcheck()
+        addresses = [node['Node']['Address'] for node in nodes]
+        known_hosts = self.storage.find_host_dns_names(addresses)
+        task_names = ["restore_{}".format(address) for address in addresses]
+        restore_tasks = set(task['_id'] for task in self.storage.find_task({"_id": {"$in": task_names}}))
+        new_tasks = []
+        recovered_tasks = []
+        for node in nodes:
             node_fail = False
             address = node['Node']['Address']
-            if not self._check_machine_exists(address):
+            if address not in known_hosts:
                 logging.error("check_machine: machine {} not found".format(address))
                 continue
             service_instance = self.config['RPAAS_SERVICE_NAME']
@@ -327,33 +539,28 @@ class CheckMachineTask(BaseManagerTask):
                     node_fail = True
                     break
             task_name = "restore_{}".format(address)
-            if node_fail:
-                try:
-                    self.task_manager.ensure_ready(task_name)
-                    self.task_manager.create({"_id": task_name, "host": address,
-                                              "instance": service_instance,
-                                              "created": datetime.datetime.utcnow()})
-                except:
-                    pass
-            else:
-                try:
-                    self.task_manager.remove(task_name)
-                except:
-                    pass
-
-    def _check_machine_exists(self, address):
-        machine_data = self.storage.find_host_id(address)
-        if machine_data is None:
-            return False
-        return True
+            if node_fail and task_name not in restore_tasks:
+                restore_tasks.add(task_name)
+                new_tasks.append({"_id": task_name, "host": address, "instance": service_instance,
+                                  "created": datetime.datetime.utcnow()})
+            elif not node_fail and task_name in restore_tasks:
+                recovered_tasks.append(task_name)
+        if new_tasks:
+            self.storage.store_tasks(new_tasks)
+        if recovered_tasks:
+            self.storage.remove_task({"_id": {"$in": recovered_tasks}})
 
 
 class DownloadCertTask(BaseManagerTask):
 
-    def run(self, config, name, plugin, csr, key, domain):
+    def run(self, config, name, plugin, csr, key, domain, renewal=False):
         try:
             self.init_config(config)
             sslutils.generate_crt(self.config, name, plugin, csr, key, domain)
+        except Exception as e:
+            if renewal:
+                self.storage.fail_le_renewal(name, repr(e))
+            raise
         finally:
             self.storage.remove_task(name)
 
@@ -384,24 +591,54 @@ class RenewCertsTask(BaseManagerTask):
     def run(self, config):
         self.init_config(config)
         expires_in = int(self.config.get("LE_CERTIFICATE_EXPIRATION_DAYS", 90))
-        limit = datetime.datetime.utcnow() - datetime.timedelta(days=expires_in - 3)
-        query = {"created": {"$lte": limit}}
-        for cert in self.storage.find_le_certificates(query):
-            metadata = self.storage.find_instance_metadata(cert["name"])
-            config = copy.deepcopy(self.config)
-            if metadata and "plan_name" in metadata:
-                plan = self.storage.find_plan(metadata["plan_name"])
-                config.update(plan.config)
-            self.renew(cert, config)
+        max_orders = int(self.config.get("LE_RENEWAL_MAX_ORDERS", 10))
+        # a countdown task stays unacknowledged in the broker, anything delayed
+        # past the redis visibility timeout would be delivered twice
+        visibility_timeout = int((app.conf.BROKER_TRANSPORT_OPTIONS or {}).get("visibility_timeout", 3600))
+        jitter = min(int(self.config.get("LE_RENEWAL_JITTER", 600)), visibility_timeout / 2)
+        timeout = int(self.config.get("LE_RENEWAL_TIMEOUT", 6 * 3600))
+        now = datetime.datetime.utcnow()
+        stale = now - datetime.timedelta(seconds=timeout)
+        available = max_orders - self.storage.count_le_renewals_in_flight(stale)
+        if available <= 0:
+            logging.info("renew certificates: {} orders already in flight".format(max_orders))
+            return
+        limit = now - datetime.timedelta(days=expires_in - 3)
+        query = {"$and": [
+            {"$or": [{"expires": {"$lte": now + datetime.timedelta(days=3)}},
+                     {"expires": {"$exists": False}, "created": {"$lte": limit}}]},
+            {"$or": [{"renewal": {"$exists": False}},
+                     {"renewal.status": "failed", "renewal.next_attempt": {"$lte": now}},
+                     {"renewal.status": "scheduled", "renewal.scheduled_at": {"$lte": stale}}]},
+        ]}
+        certs = list(self.storage.find_le_certificates(query, sort=[("expires", 1), ("created", 1)],
+                                                       limit=available))
+        if not certs:
+            return
+        names = [cert["name"] for cert in certs]
+        self.storage.schedule_le_renewals(names)
+        metadatas = self.storage.find_instances_metadata(names)
+        for cert in certs:
+            metadata = metadatas.get(cert["name"])
+            config = self.config_resolver.resolve_for_metadata(self.config, metadata, use_flavor=False)
+            if metadata and metadata.get("ssl_key_types"):
+                config["SSL_KEY_TYPES"] = metadata["ssl_key_types"]
+            try:
+                self.renew(cert, config, random.uniform(0, jitter))
+            except Exception as e:
+                logging.error("Error scheduling certificate renewal for {}: {}".format(cert["name"], repr(e)))
+                self.storage.fail_le_renewal(cert["name"], repr(e))
 
-    def renew(self, cert, config):
-        key = sslutils.generate_key(True)
+    def renew(self, cert, config, countdown=0):
+        key = sslutils.generate_key(True, sslutils.key_types(config)[0])
         csr = sslutils.generate_csr(key, cert["domain"])
-        DownloadCertTask().delay(config=config, name=cert["name"], plugin="le",
-                                 csr=csr, key=key, domain=cert["domain"])
+        DownloadCertTask().apply_async(kwargs=dict(config=config, name=cert["name"], plugin="le",
+                                                   csr=csr, key=key, domain=cert["domain"], renewal=True),
+                                       countdown=countdown)
 
 
 class SessionResumptionTask(BaseManagerTask):
+    ignore_result = False
 
     def run(self, config):
         self.init_config(config)
@@ -413,22 +650,64 @@ class SessionResumptionTask(BaseManagerTask):
         if instances_to_rotate:
             instances_to_rotate = instances_to_rotate.split(",")
         lb_data = LoadBalancer.list(conf=self.config)
+        lbs = OrderedDict()
         for lb in lb_data:
             if instances_to_rotate and lb.name not in instances_to_rotate:
                 continue
-            lock_name = "{}:{}".format(instance_lock, lb.name)
-            if self.lock_manager.lock(lock_name, session_resumption_rotate):
+            lbs["{}:{}".format(instance_lock, lb.name)] = lb
+        locked = self.lock_manager.lock_many(lbs.keys(), session_resumption_rotate)
+        report = None
+        try:
+            report = self.rotate_session_tickets([lbs[lock_name] for lock_name in locked])
+            return report
+        finally:
+            # pushes that timed out may still be running, so their instances
+            # stay locked until the lock expires
+            self.lock_manager.unlock_many([lock_name for lock_name in locked
+                                           if report is None or not report[lbs[lock_name].name]["timed_out"]])
+
+    def rotate_session_tickets(self, lbs):
+        concurrency = max(1, int(self.config.get("SESSION_RESUMPTION_CONCURRENCY", 8)))
+        deadline = time.time() + float(self.config.get("SESSION_RESUMPTION_DEADLINE", 300))
+        report = {}
+        jobs = {}
+        executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            for lb in lbs:
+                report[lb.name] = {"rotated": [], "failed": [], "timed_out": []}
                 try:
-                    self.rotate_session_ticket(lb.hosts)
+                    for host, job in self.rotate_session_ticket(executor, lb.hosts):
+                        jobs[job] = (lb.name, host)
                 except Exception as e:
                     logging.error("Error renewing session ticket for {}: {}".format(lb.name, repr(e)))
-                finally:
-                    self.lock_manager.unlock(lock_name)
-
-    def rotate_session_ticket(self, hosts):
+                    report[lb.name]["failed"].extend(self._host_label(host) for host in lb.hosts)
+            try:
+                for job in futures.as_completed(jobs, timeout=max(0, deadline - time.time())):
+                    name, host = jobs.pop(job)
+                    if job.exception() is None:
+                        report[name]["rotated"].append(self._host_label(host))
+                    else:
+                        logging.error("Error renewing session ticket for {}: {}".format(name, repr(job.exception())))
+                        report[name]["failed"].append(self._host_label(host))
+            except futures.TimeoutError:
+                pass
+            for job, (name, host) in jobs.items():
+                job.cancel()
+                report[name]["timed_out"].append(self._host_label(host))
+        finally:
+            executor.shutdown(wait=False)
+        for name, result in report.items():
+            if result["failed"] or result["timed_out"]:
+                logging.warning("Hosts of {} missed the new session ticket: {}".format(
+                    name, ", ".join(result["failed"] + result["timed_out"])))
+        return report
+
+    def rotate_session_ticket(self, executor, hosts):
         session_ticket = sslutils.generate_session_ticket()
-        for host in hosts:
-            self.add_session_ticket(host, session_ticket)
+        return [(host, executor.submit(self.add_session_ticket, host, session_ticket)) for host in hosts]
+
+    def _host_label(self, host):
+        return getattr(host, "dns_name", None) or str(host.id)
 
     def add_session_ticket(self, host, session_ticket):
         ticket_timeout = int(self.config.get("SESSION_RESUMPTION_TICKET_TIMEOUT", 30))
@@ -437,11 +716,12 @@ class SessionResumptionTask(BaseManagerTask):
             self.consul_manager.get_certificate(host.group, host.id)
         except consul_manager.CertificateNotFoundError:
             try:
-                certificate_key, certificate_crt = sslutils.generate_admin_crt(self.config, unicode(host.dns_name))
+                certificate_key, certificate_crt = sslutils.generate_admin_crt(
+                    self.config, unicode(host.dns_name), private_key=keypool.take_key(self.config))
                 self.consul_manager.set_certificate(host.group, certificate_crt, certificate_key, host.id)
             except:
                 exc_info = sys.exc_info()
         finally:
             if isinstance(exc_info, tuple) and exc_info[0]:
                 raise exc_info[0], exc_info[1], exc_info[2]
-            self.nginx_manager.add_session_ticket(host.dns_name, session_ticket, ticket_timeout)
+            self.nginx_manager.add_session_ticket(host.dns_name, session_ticket, timeout=ticket_timeout)
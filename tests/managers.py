@@ -4,7 +4,7 @@
 
 from collections import defaultdict
 
-from rpaas import storage, manager, consul_manager
+from rpaas import storage, manager, consul_manager, tasks
 
 
 class FakeInstance(object):
@@ -23,6 +23,7 @@ class FakeInstance(object):
         self.upstreams = defaultdict(set)
         self.cert = None
         self.key = None
+        self.ssl = None
 
 
 class FakeManager(object):
@@ -113,6 +114,20 @@ class FakeManager(object):
         instance.cert = cert
         instance.key = key
 
+    def activate_ssl(self, name, domain, plugin='default', key_types=None):
+        index, instance = self.find_instance(name)
+        if index < 0:
+            raise storage.InstanceNotFoundError()
+        instance.ssl = {"domain": domain, "plugin": plugin, "key_types": key_types}
+
+    def sync_certificates_expiry(self):
+        synced = 0
+        for instance in self.instances:
+            if instance.cert:
+                self.storage.store_instance_certificate(instance.name, None)
+                synced += 1
+        return synced
+
     def get_certificate(self, name):
         index, instance = self.find_instance(name)
         if index < 0:
@@ -164,6 +179,30 @@ class FakeManager(object):
             return 3
         return 4
 
+    def purge_location_hosts(self, name, path, preserve_path):
+        purged = self.purge_location(name, path, preserve_path)
+        hosts = {}
+        for i in range(purged):
+            hosts["10.0.0.{}".format(i + 1)] = {"purged": True, "variants": ["gzip", "identity"],
+                                                 "failed": [], "timed_out": []}
+        hosts["10.0.0.99"] = {"purged": False, "variants": [], "failed": [], "timed_out": ["gzip", "identity"]}
+        return hosts
+
+    def purge_locations(self, name, purges):
+        results = []
+        for purge in purges:
+            purged = self.purge_location(name, purge["path"], purge.get("preserve_path", False))
+            results.append({"path": purge["path"], "instances_purged": purged, "hosts": {}})
+        return (result for result in results)
+
+    def purge_locations_async(self, name, purges):
+        return "purge-task-id"
+
+    def purge_locations_result(self, name, task_id):
+        if task_id != "purge-task-id":
+            raise tasks.TaskNotFoundError()
+        return {"status": "SUCCESS", "results": [{"path": "/somewhere", "instances_purged": 3, "hosts": {}}]}
+
     def reset(self):
         self.instances = []
 
@@ -174,10 +213,12 @@ class FakeManager(object):
         if machine != 'foo':
             raise manager.InstanceMachineNotFoundError()
 
-    def restore_instance(self, name):
+    def restore_instance(self, name, max_unavailable=None):
         if name in "invalid":
             yield "instance {} not found".format(name)
             return
+        if max_unavailable:
+            yield "restoring {} hosts at a time ".format(max_unavailable)
         for machine in ["a", "b"]:
             yield "host {} restored".format(machine)
         if name in "error":
@@ -38,8 +38,8 @@ class AdminAPITestCase(unittest.TestCase):
         for x in range(1, 30):
             data = {"instance": "myinstance", "machine": "10.10.1.{}".format(x),
                     "start_time": loop_time, "end_time": loop_time, "status": "success"}
-            healing_list.append(json.loads(json.dumps(data, default=json_util.default)))
             self.storage.db[self.storage.healing_collection].insert(data)
+            healing_list.append(json.loads(json.dumps(data, default=json_util.default)))
             loop_time = loop_time + datetime.timedelta(minutes=5)
         healing_list.reverse()
         resp = self.api.get("/admin/healings")
@@ -52,6 +52,79 @@ class AdminAPITestCase(unittest.TestCase):
         self.assertEqual(200, resp.status_code)
         self.assertListEqual(healing_list[:20], json.loads(resp.data))
 
+    def test_list_indexes(self):
+        resp = self.api.get("/admin/indexes")
+        self.assertEqual(200, resp.status_code)
+        report = json.loads(resp.data)
+        self.assertEqual([query[0] for query in self.storage.index_queries()],
+                         [query["query"] for query in report])
+        self.assertFalse(all(query["indexed"] for query in report))
+
+    def test_ensure_indexes(self):
+        resp = self.api.post("/admin/indexes")
+        self.assertEqual(200, resp.status_code)
+        report = json.loads(resp.data)
+        self.assertTrue(all(query["indexed"] for query in report))
+        self.assertIn("dns_name_1", self.storage.db[self.storage.hosts_collection].index_information())
+        indexes = dict((query["query"], query["indexes"]) for query in report)
+        self.assertEqual(["server_1_account_id_1_domain_1"], indexes["cached acme authorizations"])
+        self.assertEqual(["renewal.status_1_renewal.scheduled_at_1"], indexes["renewals in flight"])
+
+    def test_expiring_certificates(self):
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        self.storage.store_instance_certificate("inst1", now + datetime.timedelta(days=40), source="le",
+                                                domain="i1.tsuru.io")
+        self.storage.store_instance_certificate("inst2", now + datetime.timedelta(days=5), source="upload")
+        self.storage.store_instance_certificate("inst3", now + datetime.timedelta(days=20))
+        self.storage.store_instance_certificate("inst4", None)
+        resp = self.api.get("/admin/certificates")
+        self.assertEqual(200, resp.status_code)
+        certificates = json.loads(resp.data, object_hook=json_util.object_hook)
+        self.assertEqual(["inst2", "inst3"], [c["instance"] for c in certificates])
+        self.assertEqual("upload", certificates[0]["source"])
+        resp = self.api.get("/admin/certificates?days=60")
+        self.assertEqual(["inst2", "inst3", "inst1"], [c["instance"] for c in json.loads(resp.data)])
+        resp = self.api.get("/admin/certificates?days=1")
+        self.assertEqual([], json.loads(resp.data))
+        for days in ("-1", "abc", ""):
+            resp = self.api.get("/admin/certificates?days=" + days)
+            self.assertEqual(400, resp.status_code)
+            self.assertEqual("invalid days, use a non-negative integer", resp.data)
+
+    def test_sync_certificates(self):
+        self.manager.new_instance("inst1")
+        self.manager.update_certificate("inst1", "cert", "key")
+        self.manager.new_instance("inst2")
+        resp = self.api.post("/admin/certificates")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({"synced": 1}, json.loads(resp.data))
+
+    def test_list_healings_filters(self):
+        start_time = datetime.datetime(2016, 8, 2, 10, 53, 0)
+        for x in range(4):
+            self.storage.db[self.storage.healing_collection].insert(
+                {"instance": "instance{}".format(x % 2), "machine": "10.10.1.{}".format(x),
+                 "start_time": start_time + datetime.timedelta(minutes=x), "status": "success"})
+        resp = self.api.get("/admin/healings?instance=instance0&status=success")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(["10.10.1.2", "10.10.1.0"], [h["machine"] for h in json.loads(resp.data)])
+        resp = self.api.get("/admin/healings?quantity=2&before=2016-08-02T10:55:00.000000")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(["10.10.1.1", "10.10.1.0"], [h["machine"] for h in json.loads(resp.data)])
+        resp = self.api.get("/admin/healings?since=2016-08-02T10:54:00&until=2016-08-02T10:55:00")
+        self.assertEqual(["10.10.1.2", "10.10.1.1"], [h["machine"] for h in json.loads(resp.data)])
+        healing = self.storage.db[self.storage.healing_collection].find_one({"machine": "10.10.1.2"})
+        resp = self.api.get("/admin/healings?before=2016-08-02T10:55:00&before_id={}".format(healing["_id"]))
+        self.assertEqual(["10.10.1.1", "10.10.1.0"], [h["machine"] for h in json.loads(resp.data)])
+        resp = self.api.get("/admin/healings?before=2016-08-02T10:55:00&before_id=xyz")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("invalid before_id", resp.data)
+
+    def test_list_healings_invalid_time(self):
+        resp = self.api.get("/admin/healings?since=yesterday")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("invalid since time, use YYYY-MM-DDTHH:MM:SS", resp.data)
+
     def test_list_plans(self):
         resp = self.api.get("/admin/plans")
         self.assertEqual(200, resp.status_code)
@@ -379,6 +452,17 @@ class AdminAPITestCase(unittest.TestCase):
         response = ["host a restored", "host b restored"]
         self.assertEqual("".join(response), resp.data)
 
+    def test_restore_instance_with_max_unavailable(self):
+        resp = self.api.post("/admin/restore", data={"instance_name": "blah", "max_unavailable": "2"})
+        self.assertEqual(200, resp.status_code)
+        response = ["restoring 2 hosts at a time ", "host a restored", "host b restored"]
+        self.assertEqual("".join(response), resp.data)
+
+    def test_restore_instance_invalid_max_unavailable(self):
+        resp = self.api.post("/admin/restore", data={"instance_name": "blah", "max_unavailable": "0"})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual("max_unavailable must be an integer value greather than 0", resp.data)
+
     def test_restore_invalid_instance_name(self):
         resp = self.api.post("/admin/restore", data={"instance_name": "invalid"})
         self.assertEqual(200, resp.status_code)
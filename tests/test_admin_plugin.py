@@ -16,6 +16,7 @@ import mock
 
 from rpaas import admin_plugin
 from bson import json_util
+from bson.objectid import ObjectId
 
 
 class CommandNotFoundErrorTestCase(unittest.TestCase):
@@ -750,6 +751,37 @@ Config:
         expected_output = "ERROR: invalid json response - No JSON object could be decoded\n"
         self.assertEqual(expected_output, "".join(lines))
 
+    @mock.patch("urllib2.urlopen")
+    @mock.patch("urllib2.Request")
+    @mock.patch("sys.stdout")
+    def test_list_healings_filters_and_pagination(self, stdout, Request, urlopen):
+        lines = []
+        stdout.write.side_effect = lambda data, **kw: lines.append(data)
+        request = mock.Mock()
+        Request.return_value = request
+        result = mock.Mock()
+        result.getcode.return_value = 200
+        urlopen.return_value = result
+        healing_list = [{"_id": ObjectId("57a07a0c0000000000000001"), "instance": "myinstance",
+                         "machine": "10.10.1.1", "status": "success",
+                         "start_time": datetime.datetime(2016, 8, 2, 10, 53, 0, 120000), "end_time": None}]
+        result.read.return_value = json.dumps(healing_list, default=json_util.default)
+        args = ['-s', self.service_name, '-n', '1', '-i', 'myinstance', '--status', 'some error',
+                '--since', '2016-08-01T00:00:00']
+        admin_plugin.list_healings(args)
+        Request.assert_called_with(self.target +
+                                   "services/proxy/service/rpaas?" +
+                                   "callback=/admin/healings?quantity=1%26instance=myinstance%26"
+                                   "status=some%2520error%26since=2016-08-01T00:00:00")
+        self.assertEqual("More healings available, use --before 2016-08-02T10:53:00.120000 "
+                         "--before-id 57a07a0c0000000000000001\n", lines[-1])
+        admin_plugin.list_healings(['-s', self.service_name, '-n', '1', '--before', '2016-08-02T10:53:00.120000',
+                                    '--before-id', '57a07a0c0000000000000001'])
+        Request.assert_called_with(self.target +
+                                   "services/proxy/service/rpaas?" +
+                                   "callback=/admin/healings?quantity=1%26before=2016-08-02T10:53:00.120000%26"
+                                   "before_id=57a07a0c0000000000000001")
+
     @mock.patch("urllib2.urlopen")
     @mock.patch("urllib2.Request")
     @mock.patch("sys.stdout")
@@ -765,6 +797,19 @@ Config:
             call_list.append(mock.call(char))
         stdout.write.assert_has_calls(call_list)
 
+    @mock.patch("urllib2.urlopen")
+    @mock.patch("urllib2.Request")
+    @mock.patch("sys.stdout")
+    def test_restore_instance_with_max_unavailable(self, stdout, Request, urlopen):
+        request = mock.Mock()
+        Request.return_value = request
+        urlopen.return_value = FakeURLopenResponse("Restoring hosts (1-2/2) x, y\n")
+        args = ['-s', self.service_name, '-i', 'x', '-m', '2']
+        admin_plugin.restore_instance(args)
+        raw_params = request.add_data.call_args[0][0]
+        parsed_params = urlparse.parse_qs(raw_params)
+        self.assertEqual({"instance_name": ["x"], "max_unavailable": ["2"]}, parsed_params)
+
     @mock.patch("urllib2.urlopen")
     @mock.patch("urllib2.Request")
     @mock.patch("sys.stderr")
@@ -777,3 +822,94 @@ Config:
         with self.assertRaises(SystemExit):
             admin_plugin.restore_instance(args)
         stderr.write.assert_has_calls([mock.call("ERROR: fail\n")])
+
+    @mock.patch("urllib2.urlopen")
+    @mock.patch("urllib2.Request")
+    @mock.patch("sys.stdout")
+    def test_indexes(self, stdout, Request, urlopen):
+        lines = []
+        stdout.write.side_effect = lambda data, **kw: lines.append(data)
+        request = mock.Mock()
+        Request.return_value = request
+        result = mock.Mock()
+        result.getcode.return_value = 200
+        urlopen.return_value = result
+        report = [{"query": "healing history", "collection": "healing", "stages": ["FETCH", "IXSCAN"],
+                   "indexes": ["start_time_-1"], "indexed": True},
+                  {"query": "quota owner", "collection": "quota", "stages": ["COLLSCAN"],
+                   "indexes": [], "indexed": False}]
+        result.read.return_value = json.dumps(report)
+        args = ['-s', self.service_name]
+        admin_plugin.indexes(args)
+        Request.assert_called_with(self.target + "services/proxy/service/rpaas?callback=/admin/indexes")
+        self.assertEqual("GET", request.get_method())
+        expected_output = u"""
++------------+-----------------+---------+---------------+
+| Collection | Query           | Indexed | Plan          |
++------------+-----------------+---------+---------------+
+| healing    | healing history | yes     | start_time_-1 |
++------------+-----------------+---------+---------------+
+| quota      | quota owner     | no      | COLLSCAN      |
++------------+-----------------+---------+---------------+
+"""
+        self.assertEqual(expected_output, "".join(lines))
+
+    @mock.patch("urllib2.urlopen")
+    @mock.patch("urllib2.Request")
+    @mock.patch("sys.stdout")
+    def test_indexes_ensure(self, stdout, Request, urlopen):
+        request = mock.Mock()
+        Request.return_value = request
+        result = mock.Mock()
+        result.getcode.return_value = 200
+        urlopen.return_value = result
+        result.read.return_value = "[]"
+        admin_plugin.indexes(['-s', self.service_name, '--ensure'])
+        self.assertEqual("POST", request.get_method())
+
+    @mock.patch("urllib2.urlopen")
+    @mock.patch("urllib2.Request")
+    @mock.patch("sys.stdout")
+    def test_expiring_certificates(self, stdout, Request, urlopen):
+        lines = []
+        stdout.write.side_effect = lambda data, **kw: lines.append(data)
+        request = mock.Mock()
+        Request.return_value = request
+        result = mock.Mock()
+        result.getcode.return_value = 200
+        urlopen.return_value = result
+        certificates = [{"instance": "inst1", "domain": "i1.tsuru.io", "source": "le",
+                         "expires": datetime.datetime(2016, 8, 2, 10, 53, 0)}]
+        result.read.return_value = json.dumps(certificates, default=json_util.default)
+        admin_plugin.expiring_certificates(['-s', self.service_name, '-d', '10'])
+        Request.assert_called_with(self.target +
+                                   "services/proxy/service/rpaas?callback=/admin/certificates?days=10")
+        self.assertEqual("GET", request.get_method())
+        expected_output = u"""
++----------+-------------+--------+---------------------+
+| Instance | Domain      | Source | Expires             |
++----------+-------------+--------+---------------------+
+| inst1    | i1.tsuru.io | le     | 2016-08-02 10:53:00 |
++----------+-------------+--------+---------------------+
+"""
+        self.assertEqual(expected_output, "".join(lines))
+
+    @mock.patch("urllib2.urlopen")
+    @mock.patch("urllib2.Request")
+    @mock.patch("sys.stdout")
+    def test_expiring_certificates_sync(self, stdout, Request, urlopen):
+        lines = []
+        stdout.write.side_effect = lambda data, **kw: lines.append(data)
+        request = mock.Mock()
+        Request.return_value = request
+        sync_result = mock.Mock()
+        sync_result.getcode.return_value = 200
+        sync_result.read.return_value = '{"synced": 3}'
+        list_result = mock.Mock()
+        list_result.getcode.return_value = 200
+        list_result.read.return_value = "[]"
+        urlopen.side_effect = [sync_result, list_result]
+        admin_plugin.expiring_certificates(['-s', self.service_name, '--sync'])
+        self.assertEqual("Synced expiry of 3 certificates\n", lines[0])
+        Request.assert_called_with(self.target +
+                                   "services/proxy/service/rpaas?callback=/admin/certificates?days=30")
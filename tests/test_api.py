@@ -608,6 +608,22 @@ class APITestCase(unittest.TestCase):
         self.assertEqual('cert content', instance.cert)
         self.assertEqual('key content', instance.key)
 
+    def test_add_https(self):
+        self.manager.new_instance("someapp")
+        resp = self.api.post("/resources/someapp/ssl", data={
+            'domain': 'someapp.tsuru.io',
+            'plugin': 'le',
+            'key_types': 'ecdsa-p256,rsa2048',
+        })
+        self.assertEqual(200, resp.status_code)
+        _, instance = self.manager.find_instance("someapp")
+        self.assertEqual({"domain": "someapp.tsuru.io", "plugin": "le", "key_types": "ecdsa-p256,rsa2048"},
+                         instance.ssl)
+        resp = self.api.post("/resources/someapp/ssl", data={'domain': 'someapp.tsuru.io'})
+        self.assertEqual(200, resp.status_code)
+        _, instance = self.manager.find_instance("someapp")
+        self.assertEqual({"domain": "someapp.tsuru.io", "plugin": "default", "key_types": None}, instance.ssl)
+
     def test_add_route(self):
         self.manager.new_instance("someapp")
         resp = self.api.post("/resources/someapp/route", data={
@@ -696,6 +712,19 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(200, resp.status_code)
         self.assertEqual('Path found and purged on 4 servers', resp.data)
 
+    def test_purge_location_json_report(self):
+        resp = self.api.post("/resources/someapp/purge", data={
+            'path': '/somewhere', 'preserve_path': True
+        }, headers={'Content-Type': 'application/x-www-form-urlencoded', 'Accept': 'application/json'})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.mimetype)
+        data = json.loads(resp.data)
+        self.assertEqual("/somewhere", data["path"])
+        self.assertEqual(3, data["instances_purged"])
+        self.assertEqual(4, len(data["hosts"]))
+        self.assertEqual({"purged": False, "variants": [], "failed": [], "timed_out": ["gzip", "identity"]},
+                         data["hosts"]["10.0.0.99"])
+
     def test_purge_bulk_location(self):
         resp = self.api.post("/resources/someapp/purge/bulk", data=json.dumps([
             {'path': '/somewhere', 'preserve_path': True},
@@ -703,8 +732,8 @@ class APITestCase(unittest.TestCase):
         ]), headers={'Content-Type': 'application/json'})
         self.assertEqual(200, resp.status_code)
         self.assertEqual([
-            {"path": "/somewhere", "instances_purged": 3},
-            {"path": "/otherpath", "instances_purged": 4}
+            {"path": "/somewhere", "instances_purged": 3, "hosts": {}},
+            {"path": "/otherpath", "instances_purged": 4, "hosts": {}}
         ], json.loads(resp.data))
 
         resp = self.api.post("/resources/someapp/purge/bulk", data=json.dumps({
@@ -713,6 +742,34 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(400, resp.status_code)
         self.assertEqual('missing required list of purges', resp.data)
 
+    def test_purge_bulk_location_missing_path(self):
+        resp = self.api.post("/resources/someapp/purge/bulk", data=json.dumps([
+            {'path': '/somewhere'}, {'preserve_path': True},
+        ]), headers={'Content-Type': 'application/json'})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual('missing required path', resp.data)
+        for path in (42, None, ["/somewhere"]):
+            resp = self.api.post("/resources/someapp/purge/bulk", data=json.dumps([{'path': path}]),
+                                 headers={'Content-Type': 'application/json'})
+            self.assertEqual(400, resp.status_code)
+        resp = self.api.post("/resources/someapp/purge/bulk", data=json.dumps([{'path': 42}]),
+                             headers={'Content-Type': 'application/json'})
+        self.assertEqual('path must be a string', resp.data)
+
+    def test_purge_bulk_location_async(self):
+        resp = self.api.post("/resources/someapp/purge/bulk?async=true", data=json.dumps([
+            {'path': '/somewhere', 'preserve_path': True},
+        ]), headers={'Content-Type': 'application/json'})
+        self.assertEqual(202, resp.status_code)
+        self.assertEqual({"task_id": "purge-task-id"}, json.loads(resp.data))
+        resp = self.api.get("/resources/someapp/purge/bulk/purge-task-id")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({"status": "SUCCESS",
+                          "results": [{"path": "/somewhere", "instances_purged": 3, "hosts": {}}]},
+                         json.loads(resp.data))
+        resp = self.api.get("/resources/someapp/purge/bulk/other-id")
+        self.assertEqual(404, resp.status_code)
+
     def open_with_auth(self, url, method, user, password, data=None, headers=None):
         encoded = base64.b64encode(user + ":" + password)
         if not headers:
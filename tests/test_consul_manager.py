@@ -4,7 +4,9 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import json
 import os
+import threading
 import unittest
 import mock
 
@@ -92,6 +94,43 @@ class ConsulManagerTestCase(unittest.TestCase):
         node_hostname = self.manager.node_hostname(host)
         self.assertEqual(None, node_hostname)
 
+    def test_node_hostnames_fetches_catalog_once(self):
+        with mock.patch.object(self.manager, "list_node", wraps=self.manager.list_node) as list_node:
+            hostnames = self.manager.node_hostnames(['127.0.0.1', '10.0.0.1', '10.0.0.2'])
+        self.assertEqual({'127.0.0.1': 'rpaas-test'}, hostnames)
+        list_node.assert_called_once_with()
+
+    def test_node_hostnames_empty_hosts(self):
+        with mock.patch.object(self.manager, "list_node") as list_node:
+            self.assertEqual({}, self.manager.node_hostnames([]))
+        list_node.assert_not_called()
+
+    def test_wait_healthy(self):
+        unhealthy = [{"Node": {"Address": "10.0.0.2"}}]
+        healthy = unhealthy + [{"Node": {"Address": "10.0.0.1"}}]
+        with mock.patch.object(self.manager.client.health, "service",
+                               side_effect=[(10, unhealthy), (12, healthy)]) as service:
+            self.manager.wait_healthy("10.0.0.1", timeout=30)
+        self.assertEqual(2, service.call_count)
+        self.assertIsNone(service.call_args_list[0][1]["index"])
+        self.assertEqual(10, service.call_args_list[1][1]["index"])
+        self.assertTrue(service.call_args_list[1][1]["passing"])
+        self.assertEqual("test-suite-rpaas", service.call_args_list[1][1]["tag"])
+
+    def test_watch_service_health(self):
+        nodes = [{"Node": {"Address": "10.0.0.1"}}]
+        with mock.patch.object(self.manager.client.health, "service", return_value=("12", nodes)) as service:
+            self.assertEqual(("12", nodes), self.manager.watch_service_health("10", 30))
+        service.assert_called_once_with("nginx", index="10", wait="30s", tag="test-suite-rpaas")
+
+    @mock.patch("rpaas.consul_manager.time")
+    def test_wait_healthy_timeout(self, time):
+        time.time.side_effect = [0, 1, 20, 29, 31]
+        with mock.patch.object(self.manager.client.health, "service", return_value=(10, [])) as service:
+            with self.assertRaises(consul_manager.NodeNotHealthyError):
+                self.manager.wait_healthy("10.0.0.1", timeout=30)
+        self.assertEqual(2, service.call_count)
+
     def test_node_status(self):
         self.consul.kv.put("test-suite-rpaas/myrpaas/status/my-server-1", "service OK")
         self.consul.kv.put("test-suite-rpaas/myrpaas/status/my-server-2", "service DEAD")
@@ -154,6 +193,16 @@ class ConsulManagerTestCase(unittest.TestCase):
         item = self.consul.kv.get("test-suite-rpaas/myrpaas/upstream/router-myrpaas")
         self.assertEqual(None, item[1])
 
+    def test_write_location_writes_upstream_and_location_in_one_transaction(self):
+        with mock.patch.object(self.manager.client.http, "put",
+                               wraps=self.manager.client.http.put) as put:
+            self.manager.write_location("myrpaas", "/", destination="http://myapp.tsuru.io")
+        self.assertEqual(1, put.call_count)
+        operations = json.loads(put.call_args[1]["data"])
+        self.assertEqual(["test-suite-rpaas/myrpaas/upstream/myapp.tsuru.io",
+                          "test-suite-rpaas/myrpaas/locations/ROOT"],
+                         [op["KV"]["Key"] for op in operations])
+
     def test_write_location_non_root(self):
         self.manager.write_location("myrpaas", "/admin/app_sites/",
                                     destination="http://myapp.tsuru.io")
@@ -267,6 +316,66 @@ class ConsulManagerTestCase(unittest.TestCase):
         key_item = self.consul.kv.get("test-suite-rpaas/myrpaas/ssl/key")
         self.assertEqual("key\nvalid\n\n", key_item[1]["Value"])
 
+    def test_set_certificate_uses_single_transaction(self):
+        with mock.patch.object(self.manager.client.http, "put",
+                               wraps=self.manager.client.http.put) as put:
+            self.manager.set_certificate("myrpaas", "certificate", "key")
+        self.assertEqual(1, put.call_count)
+        self.assertEqual("/v1/txn", put.call_args[0][1])
+        operations = json.loads(put.call_args[1]["data"])
+        self.assertEqual(["test-suite-rpaas/myrpaas/ssl/cert", "test-suite-rpaas/myrpaas/ssl/key"],
+                         [op["KV"]["Key"] for op in operations])
+
+    def test_set_certificates(self):
+        self.manager.set_certificates("myrpaas", [("ecdsa", "ec-cert", "ec-key"), ("rsa", "rsa-cert\r\n", "rsa-key")])
+        self.assertEqual(("ec-cert", "ec-key"), self.manager.get_certificate("myrpaas"))
+        self.assertEqual(("ec-cert", "ec-key"), self.manager.get_algorithm_certificate("myrpaas", "ecdsa"))
+        self.assertEqual(("rsa-cert\n", "rsa-key"), self.manager.get_algorithm_certificate("myrpaas", "rsa"))
+        item = self.consul.kv.get("test-suite-rpaas/myrpaas/ssl/algorithms/rsa/cert")[1]
+        self.assertEqual("rsa-cert\n", item["Value"])
+
+    def test_set_certificates_keeps_host_certificates(self):
+        self.manager.set_certificate("myrpaas", "host-cert", "host-key", "rsa")
+        self.manager.set_certificates("myrpaas", [("rsa", "rsa-cert", "rsa-key")])
+        self.assertEqual(("host-cert", "host-key"), self.manager.get_certificate("myrpaas", "rsa"))
+        self.manager.delete_certificate("myrpaas")
+        self.assertEqual(("host-cert", "host-key"), self.manager.get_certificate("myrpaas", "rsa"))
+
+    def test_set_certificates_removes_stale_algorithms(self):
+        self.manager.set_certificates("myrpaas", [("rsa", "rsa-cert", "rsa-key"), ("ecdsa", "ec-cert", "ec-key")])
+        self.manager.set_certificates("myrpaas", [(None, "cert", "key")])
+        self.assertEqual(("cert", "key"), self.manager.get_certificate("myrpaas"))
+        with self.assertRaises(consul_manager.CertificateNotFoundError):
+            self.manager.get_algorithm_certificate("myrpaas", "ecdsa")
+        with self.assertRaises(consul_manager.CertificateNotFoundError):
+            self.manager.get_algorithm_certificate("myrpaas", "rsa")
+
+    def test_list_certificates(self):
+        self.manager.set_certificate("myrpaas", "cert1", "key1")
+        self.manager.set_certificate("otherrpaas", "cert2", "key2")
+        self.manager.set_certificate("otherrpaas", "host-cert", "host-key", "host-a")
+        self.manager.write_location("myrpaas", "/", destination="app.host.com")
+        with mock.patch.object(self.manager.client.kv, "get", wraps=self.manager.client.kv.get) as get:
+            certificates = sorted(self.manager.list_certificates())
+        self.assertEqual([("myrpaas", "cert1"), ("otherrpaas", "cert2")], certificates)
+        get.assert_called_once_with("test-suite-rpaas/", recurse=True)
+
+    def test_delete_certificate_with_algorithms(self):
+        self.manager.set_certificates("myrpaas", [("rsa", "rsa-cert", "rsa-key"), ("ecdsa", "ec-cert", "ec-key")])
+        self.manager.delete_certificate("myrpaas")
+        for algorithm in consul_manager.CERTIFICATE_ALGORITHMS:
+            with self.assertRaises(consul_manager.CertificateNotFoundError):
+                self.manager.get_algorithm_certificate("myrpaas", algorithm)
+
+    def test_txn_rollback_raises_transaction_error(self):
+        self.consul.kv.put("test-suite-rpaas/myrpaas/ssl/cert", "old-cert")
+        with self.assertRaises(consul_manager.TransactionError):
+            self.manager._txn([("set", "test-suite-rpaas/myrpaas/ssl/key", "new-key"),
+                               ("cas", "test-suite-rpaas/myrpaas/ssl/cert", "new-cert", 0)])
+        self.assertIsNone(self.consul.kv.get("test-suite-rpaas/myrpaas/ssl/key")[1])
+        cert_item = self.consul.kv.get("test-suite-rpaas/myrpaas/ssl/cert")
+        self.assertEqual("old-cert", cert_item[1]["Value"])
+
     def test_remove_location_root(self):
         self.manager.write_location("myrpaas", "/",
                                     destination="http://myapp.tsuru.io",
@@ -441,6 +550,44 @@ class ConsulManagerTestCase(unittest.TestCase):
         servers = self.manager.list_upstream("myrpaas", "upstream1")
         self.assertEqual(set(["server1:123"]), servers)
 
+    def test_upstream_concurrent_adds_keep_every_server(self):
+        servers = ["server{}".format(i) for i in range(10)]
+        threads = [threading.Thread(target=self.manager.add_server_upstream,
+                                    args=("myrpaas", "upstream1", server)) for server in servers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(set(servers), self.manager.list_upstream("myrpaas", "upstream1"))
+
+    def test_upstream_add_retries_when_upstream_changes_concurrently(self):
+        self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
+        original_get_upstream = self.manager._get_upstream
+        calls = []
+
+        def get_upstream(instance_name, upstream_name):
+            result = original_get_upstream(instance_name, upstream_name)
+            if not calls:
+                self.consul.kv.put("test-suite-rpaas/myrpaas/upstream/upstream1",
+                                   self.manager._set_header_footer("server1,server2", "upstream"))
+            calls.append(result)
+            return result
+        with mock.patch.object(self.manager, "_get_upstream", side_effect=get_upstream):
+            self.manager.add_server_upstream("myrpaas", "upstream1", "server3")
+        self.assertEqual(2, len(calls))
+        servers = self.manager.list_upstream("myrpaas", "upstream1")
+        self.assertEqual(set(["server1", "server2", "server3"]), servers)
+
+    @mock.patch("rpaas.consul_manager.time")
+    def test_upstream_add_gives_up_after_cas_retries(self, time):
+        self.manager.cas_retries = 3
+        with mock.patch.object(self.manager, "_txn",
+                               side_effect=consul_manager.TransactionError("index mismatch")) as txn:
+            with self.assertRaises(consul_manager.TransactionError):
+                self.manager.add_server_upstream("myrpaas", "upstream1", "server1")
+        self.assertEqual(3, txn.call_count)
+        self.assertEqual(2, time.sleep.call_count)
+
     def test_find_acl_networks_return_empty(self):
         acls = self.manager.find_acl_network("myrpaas", "10.0.0.1/32")
         self.assertEqual([], acls)
@@ -529,6 +676,20 @@ class ConsulManagerTestCase(unittest.TestCase):
         self.assertIsNone(myrpaas_1_swap)
         self.assertIsNone(myrpaas_2_swap)
 
+    def test_swap_concurrent_change_fail(self):
+        self.consul.kv.put("test-suite-rpaas/myrpaas-1/swap", "myrpaas-2")
+        self.consul.kv.put("test-suite-rpaas/myrpaas-2/swap", "myrpaas-1")
+        original_swap_status = self.manager._swap_status
+
+        def swap_status(src, dst):
+            status = original_swap_status(src, dst)
+            self.consul.kv.put("test-suite-rpaas/myrpaas-1/swap", "myrpaas-2")
+            return status
+        with mock.patch.object(self.manager, "_swap_status", side_effect=swap_status):
+            with self.assertRaises(consul_manager.InstanceAlreadySwappedError):
+                self.manager.swap_instances("myrpaas-1", "myrpaas-2")
+        self.assertEqual("myrpaas-1", self.consul.kv.get("test-suite-rpaas/myrpaas-2/swap")[1]['Value'])
+
     def test_swap_already_swapped_instance_fail(self):
         self.manager.swap_instances("myrpaas-1", "myrpaas-2")
         with self.assertRaises(consul_manager.InstanceAlreadySwappedError):
@@ -0,0 +1,84 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from rpaas import effective_config, plan, flavor, storage
+
+
+class EffectiveConfigResolverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = mock.Mock()
+        self.storage.find_plan.return_value = plan.Plan("small", "small plan",
+                                                        {"serviceofferingid": "abc", "A": "plan"})
+        self.storage.find_flavor.return_value = flavor.Flavor("vanilla", "nginx 1.10",
+                                                              {"nginx_version": "1.10", "A": "flavor"})
+        self.base = {"RPAAS_SERVICE_NAME": "rpaas", "A": "base"}
+
+    def test_resolve_merges_plan_and_flavor(self):
+        resolver = effective_config.EffectiveConfigResolver(self.storage)
+        config = resolver.resolve(self.base, "small", "vanilla")
+        self.assertEqual(config, {"RPAAS_SERVICE_NAME": "rpaas", "A": "flavor",
+                                  "serviceofferingid": "abc", "nginx_version": "1.10"})
+        self.assertEqual(self.base, {"RPAAS_SERVICE_NAME": "rpaas", "A": "base"})
+
+    def test_resolve_without_plan_and_flavor(self):
+        resolver = effective_config.EffectiveConfigResolver(self.storage)
+        config = resolver.resolve(self.base)
+        self.assertEqual(config, self.base)
+        self.assertIsNot(config, self.base)
+        self.storage.find_plan.assert_not_called()
+        self.storage.find_flavor.assert_not_called()
+
+    def test_resolve_for_metadata(self):
+        resolver = effective_config.EffectiveConfigResolver(self.storage)
+        metadata = {"plan_name": "small", "flavor_name": "vanilla"}
+        config = resolver.resolve_for_metadata(self.base, metadata, use_flavor=False)
+        self.assertEqual(config["A"], "plan")
+        self.storage.find_flavor.assert_not_called()
+        config = resolver.resolve_for_metadata(self.base, None)
+        self.assertEqual(config, self.base)
+
+    def test_resolve_caches_overlay(self):
+        resolver = effective_config.EffectiveConfigResolver(self.storage, ttl=30)
+        config = resolver.resolve(self.base, "small", "vanilla")
+        config["HOST_TAGS"] = "a:b"
+        config = resolver.resolve(self.base, "small", "vanilla")
+        self.assertNotIn("HOST_TAGS", config)
+        self.storage.find_plan.assert_called_once_with("small")
+        self.storage.find_flavor.assert_called_once_with("vanilla")
+
+    def test_resolve_without_ttl_does_not_cache(self):
+        resolver = effective_config.EffectiveConfigResolver(self.storage)
+        resolver.resolve(self.base, "small")
+        resolver.resolve(self.base, "small")
+        self.assertEqual(self.storage.find_plan.call_count, 2)
+
+    @mock.patch("rpaas.effective_config.time")
+    def test_resolve_cache_expires(self, time):
+        time.time.return_value = 100
+        resolver = effective_config.EffectiveConfigResolver(self.storage, ttl=10)
+        resolver.resolve(self.base, "small")
+        time.time.return_value = 111
+        resolver.resolve(self.base, "small")
+        self.assertEqual(self.storage.find_plan.call_count, 2)
+
+    def test_bump_version_invalidates_cache(self):
+        resolver = effective_config.EffectiveConfigResolver(self.storage, ttl=30)
+        resolver.resolve(self.base, "small", "vanilla")
+        effective_config.bump_version("plan", "small")
+        resolver.resolve(self.base, "small", "vanilla")
+        self.assertEqual(self.storage.find_plan.call_count, 2)
+        effective_config.bump_version("flavor", "vanilla")
+        resolver.resolve(self.base, "small", "vanilla")
+        self.assertEqual(self.storage.find_flavor.call_count, 3)
+
+    def test_resolve_plan_not_found(self):
+        self.storage.find_plan.side_effect = storage.PlanNotFoundError()
+        resolver = effective_config.EffectiveConfigResolver(self.storage)
+        with self.assertRaises(storage.PlanNotFoundError):
+            resolver.resolve(self.base, "small")
@@ -3,6 +3,7 @@
 # license that can be found in the LICENSE file.
 
 import datetime
+import threading
 import time
 import unittest
 import redis
@@ -27,6 +28,10 @@ class FakeManager(managers.BaseManager):
     host_id = 0
     hosts = []
     fail_ids = []
+    restore_time = 0
+    restoring = set()
+    restoring_log = []
+    restoring_lock = threading.Lock()
 
     def __init__(self, config=None):
         super(FakeManager, self).__init__(config)
@@ -37,9 +42,17 @@ class FakeManager(managers.BaseManager):
         return Host(id=id, dns_name=FakeManager.hosts.pop(0), alternative_id=alternative_id)
 
     def restore_host(self, id, reset_template=False, reset_tags=False):
-        if id in self.fail_ids:
-            raise RestoreHostError(ConnectionError("iaas restore error"))
-        log.logging.info("Machine {} restored".format(id))
+        with self.restoring_lock:
+            FakeManager.restoring.add(id)
+            FakeManager.restoring_log.append(set(FakeManager.restoring))
+        try:
+            time.sleep(self.restore_time)
+            if id in self.fail_ids:
+                raise RestoreHostError(ConnectionError("iaas restore error"))
+            log.logging.info("Machine {} restored".format(id))
+        finally:
+            with self.restoring_lock:
+                FakeManager.restoring.discard(id)
 
     def start_host(self, id):
         pass
@@ -94,6 +107,8 @@ class RestoreMachineTestCase(unittest.TestCase):
 
     def tearDown(self):
         FakeManager.fail_ids = []
+        FakeManager.restore_time = 0
+        FakeManager.restoring_log = []
 
     @patch("rpaas.tasks.nginx")
     @patch("hm.log.logging")
@@ -295,6 +310,57 @@ class RestoreMachineTestCase(unittest.TestCase):
             self.assertListEqual(bar_instances_healings, expected_healings)
 
 
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_parallel(self, log, nginx):
+        self.config['RESTORE_MACHINE_CONCURRENCY'] = "4"
+        FakeManager.restore_time = 0.1
+        nginx_manager = nginx.Nginx.return_value
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        self.assertItemsEqual([call("Machine 0 restored"), call("Machine 2 restored"),
+                               call("Machine 3 restored"), call("Machine 4 restored")], log.info.call_args_list)
+        self.assertItemsEqual([call('10.1.1.1', timeout=600), call('10.3.3.3', timeout=600),
+                               call('10.4.4.4', timeout=600), call('10.5.5.5', timeout=600)],
+                              nginx_manager.wait_healthcheck.call_args_list)
+        foo_ids = set([0, 2, 3])
+        self.assertEqual(1, max(len(restoring & foo_ids) for restoring in FakeManager.restoring_log))
+        self.assertEqual(2, max(len(restoring) for restoring in FakeManager.restoring_log))
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, ['restore_10.2.2.2'])
+
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_parallel_instance_concurrency(self, log, nginx):
+        self.config['RESTORE_MACHINE_CONCURRENCY'] = "4"
+        self.config['RESTORE_MACHINE_INSTANCE_CONCURRENCY'] = "2"
+        FakeManager.restore_time = 0.1
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        foo_ids = set([0, 2, 3])
+        self.assertEqual(2, max(len(restoring & foo_ids) for restoring in FakeManager.restoring_log))
+        self.assertEqual(3, max(len(restoring) for restoring in FakeManager.restoring_log))
+
+    @patch("rpaas.tasks.nginx")
+    @patch("hm.log.logging")
+    def test_restore_machine_parallel_failure(self, log, nginx):
+        self.config['RESTORE_MACHINE_CONCURRENCY'] = "4"
+        FakeManager.fail_ids = [2]
+        restorer = healing.RestoreMachine(self.config)
+        restorer.start()
+        time.sleep(1)
+        restorer.stop()
+        self.assertItemsEqual([call("Machine 0 restored"), call("Machine 4 restored")], log.info.call_args_list)
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(['restore_10.2.2.2', 'restore_10.3.3.3', 'restore_10.4.4.4'], tasks)
+        failed = self.storage.find_task({"_id": "restore_10.3.3.3"})[0]
+        self.assertIsNotNone(failed.get("last_attempt"))
+
+
 class CheckMachineTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -359,6 +425,32 @@ class CheckMachineTestCase(unittest.TestCase):
         tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
         self.assertListEqual(tasks, ['restore_10.1.1.1', 'restore_10.3.3.3'])
 
+    @patch.object(storage.MongoDBStorage, "find_host_id")
+    @patch.object(consul_manager.ConsulManager, "service_healthcheck")
+    def test_check_machine_diff_existing_tasks(self, service_healthcheck, find_host_id):
+        created = datetime.datetime(2016, 2, 3, 11, 0, 0)
+        self.storage.store_task({"_id": "restore_10.1.1.1", "host": "10.1.1.1", "instance": "rpaas_01",
+                                 "created": created})
+        self.storage.store_task({"_id": "restore_10.2.2.2", "host": "10.2.2.2", "instance": "rpaas_02",
+                                 "created": created})
+        healthcheck = [{'Node': {'Address': '10.1.1.1'},
+                        'Checks': [{'CheckId': 1, 'Status': 'critical'}],
+                        'Service': {'Service': 'nginx', 'Tags': ['test_rpaas_check_machine', 'rpaas_01']}},
+                       {'Node': {'Address': '10.2.2.2'},
+                        'Checks': [{'CheckId': 1, 'Status': 'passing'}],
+                        'Service': {'Service': 'nginx', 'Tags': ['test_rpaas_check_machine', 'rpaas_02']}},
+                       {'Node': {'Address': '10.3.3.3'},
+                        'Checks': [{'CheckId': 1, 'Status': 'critical'}],
+                        'Service': {'Service': 'nginx', 'Tags': ['test_rpaas_check_machine', 'rpaas_02']}}]
+        service_healthcheck.return_value = healthcheck
+        tasks.CheckMachineTask().delay(self.config)
+        restore_tasks = list(self.storage.find_task({"_id": {"$regex": "restore_.+"}}))
+        self.assertEqual(['restore_10.1.1.1', 'restore_10.3.3.3'], [task['_id'] for task in restore_tasks])
+        self.assertEqual(created, restore_tasks[0]['created'])
+        self.assertEqual({"_id": "restore_10.3.3.3", "host": "10.3.3.3", "instance": "rpaas_02"},
+                         dict((k, v) for k, v in restore_tasks[1].items() if k != "created"))
+        find_host_id.assert_not_called()
+
     def test_check_machine_empty_healthcheck(self):
         checker = healing.CheckMachine(self.config)
         checker.start()
@@ -366,3 +458,89 @@ class CheckMachineTestCase(unittest.TestCase):
         checker.stop()
         tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
         self.assertListEqual(tasks, [])
+
+    def _node(self, address, status, instance):
+        return {'Node': {'Address': address},
+                'Checks': [{'CheckID': 'nginx', 'Status': status}],
+                'Service': {'Service': 'nginx', 'Tags': ['test_rpaas_check_machine', instance]}}
+
+    @patch("rpaas.healing.tasks.CheckMachineTask")
+    @patch.object(consul_manager.ConsulManager, "watch_service_health")
+    def test_health_watcher_sends_only_changed_nodes(self, watch_service_health, CheckMachineTask):
+        passing = [self._node('10.1.1.1', 'passing', 'rpaas_01'), self._node('10.2.2.2', 'passing', 'rpaas_02')]
+        failing = [self._node('10.1.1.1', 'critical', 'rpaas_01'), self._node('10.2.2.2', 'passing', 'rpaas_02')]
+        watch_service_health.side_effect = [("5", passing), ("5", passing), ("7", failing)]
+        watcher = healing.HealthWatcher(self.config)
+        watcher.watch()
+        CheckMachineTask.return_value.delay.assert_called_once_with(self.config, passing)
+        watcher.watch()
+        self.assertEqual(1, CheckMachineTask.return_value.delay.call_count)
+        watcher.watch()
+        CheckMachineTask.return_value.delay.assert_called_with(self.config, [failing[0]])
+        self.assertEqual([call(None, 60), call("5", 60), call("5", 60)], watch_service_health.call_args_list)
+
+    @patch("rpaas.healing.tasks.CheckMachineTask")
+    @patch.object(consul_manager.ConsulManager, "watch_service_health")
+    def test_health_watcher_index_reset(self, watch_service_health, CheckMachineTask):
+        nodes = [self._node('10.1.1.1', 'passing', 'rpaas_01')]
+        watch_service_health.side_effect = [("10", nodes), ("3", nodes)]
+        watcher = healing.HealthWatcher(self.config)
+        watcher.watch()
+        watcher.watch()
+        self.assertEqual("3", watcher.index)
+        self.assertEqual([call(self.config, nodes), call(self.config, nodes)],
+                         CheckMachineTask.return_value.delay.call_args_list)
+
+    @patch("rpaas.healing.tasks.CheckMachineTask")
+    @patch.object(consul_manager.ConsulManager, "watch_service_health")
+    def test_health_watcher_resends_changes_after_enqueue_failure(self, watch_service_health, CheckMachineTask):
+        passing = [self._node('10.1.1.1', 'passing', 'rpaas_01')]
+        failing = [self._node('10.1.1.1', 'critical', 'rpaas_01')]
+        watch_service_health.side_effect = [("5", passing), ("7", failing), ("7", failing)]
+        watcher = healing.HealthWatcher(self.config)
+        watcher.watch()
+        CheckMachineTask.return_value.delay.side_effect = Exception("broker is down")
+        with self.assertRaises(Exception):
+            watcher.watch()
+        self.assertEqual("5", watcher.index)
+        CheckMachineTask.return_value.delay.side_effect = None
+        watcher.watch()
+        CheckMachineTask.return_value.delay.assert_called_with(self.config, failing)
+        self.assertEqual("7", watcher.index)
+
+    @patch("rpaas.healing.tasks.CheckMachineTask")
+    @patch.object(consul_manager.ConsulManager, "watch_service_health")
+    def test_health_watcher_full_sync(self, watch_service_health, CheckMachineTask):
+        failing = [self._node('10.1.1.1', 'critical', 'rpaas_01'), self._node('10.2.2.2', 'passing', 'rpaas_02')]
+        watch_service_health.return_value = ("5", failing)
+        watcher = healing.HealthWatcher(dict(self.config, HEALTH_WATCHER_FULL_SYNC_CYCLES=3))
+        for _ in range(6):
+            watcher.watch()
+        self.assertEqual([call(watcher.config, failing)] * 3, CheckMachineTask.return_value.delay.call_args_list)
+
+    @patch.object(consul_manager.ConsulManager, "service_healthcheck")
+    @patch.object(consul_manager.ConsulManager, "watch_service_health")
+    def test_health_watcher_creates_restore_tasks(self, watch_service_health, service_healthcheck):
+        redis.StrictRedis().delete("health_watcher:test_rpaas_check_machine:leader")
+        states = [("5", [self._node('10.1.1.1', 'passing', 'rpaas_01'),
+                         self._node('10.3.3.3', 'passing', 'rpaas_02')]),
+                  ("6", [self._node('10.1.1.1', 'critical', 'rpaas_01'),
+                         self._node('10.3.3.3', 'passing', 'rpaas_02')])]
+
+        def watch(index, wait):
+            if states:
+                return states.pop(0)
+            time.sleep(0.05)
+            return index, []
+        watch_service_health.side_effect = watch
+        watcher = healing.HealthWatcher(self.config)
+        watcher.start()
+        time.sleep(1)
+        watcher.stop()
+        tasks = [task['_id'] for task in self.storage.find_task({"_id": {"$regex": "restore_.+"}})]
+        self.assertListEqual(tasks, ['restore_10.1.1.1'])
+        service_healthcheck.assert_not_called()
+        other_watcher = healing.HealthWatcher(self.config)
+        self.assertFalse(other_watcher.try_lead())
+        self.assertTrue(watcher.try_lead())
+        redis.StrictRedis().delete("health_watcher:test_rpaas_check_machine:leader")
@@ -0,0 +1,49 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from rpaas import instance_context
+
+
+class InstanceContextTestCase(unittest.TestCase):
+
+    def test_metadata_is_loaded_once(self):
+        storage = mock.Mock()
+        storage.find_instance_metadata.return_value = {"plan_name": "small"}
+        lb = mock.Mock(hosts=["host1"])
+        context = instance_context.InstanceContext("inst", lb, storage)
+        self.assertEqual(context.hosts, ["host1"])
+        self.assertEqual(context.metadata, {"plan_name": "small"})
+        self.assertEqual(context.metadata, {"plan_name": "small"})
+        storage.find_instance_metadata.assert_called_once_with("inst")
+
+
+class InstanceContextCacheTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        instance_context.end_request()
+
+    def test_no_cache_outside_request(self):
+        cache = instance_context.InstanceContextCache()
+        cache.set("inst", mock.Mock())
+        self.assertIsNone(cache.get("inst"))
+
+    def test_cache_within_request(self):
+        cache = instance_context.InstanceContextCache()
+        context = mock.Mock()
+        instance_context.begin_request()
+        cache.set("inst", context)
+        self.assertIs(cache.get("inst"), context)
+        instance_context.end_request()
+        self.assertIsNone(cache.get("inst"))
+
+    def test_invalidate_within_request(self):
+        cache = instance_context.InstanceContextCache()
+        instance_context.begin_request()
+        cache.set("inst", mock.Mock())
+        cache.invalidate("inst")
+        self.assertIsNone(cache.get("inst"))
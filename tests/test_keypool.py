@@ -0,0 +1,139 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import sys
+import time
+import types
+import unittest
+
+import mock
+from concurrent import futures
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from rpaas import keypool, sslutils
+
+
+class KeyPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = futures.ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(self.executor.shutdown)
+
+    def wait_available(self, pool, key_type, quantity):
+        for _ in range(200):
+            if pool.available(key_type) >= quantity:
+                return
+            time.sleep(0.05)
+        self.fail("key pool did not reach {} {} keys".format(quantity, key_type))
+
+    def test_start_fills_pool(self):
+        pool = keypool.KeyPool(2, ["rsa2048", "ecdsa-p256"], self.executor).start()
+        self.wait_available(pool, "rsa2048", 2)
+        self.wait_available(pool, "ecdsa-p256", 2)
+        key = pool.take("ecdsa-p256")
+        self.assertIn("BEGIN EC PRIVATE KEY", key)
+        self.assertIn("BEGIN RSA PRIVATE KEY", pool.take("rsa2048"))
+        self.wait_available(pool, "ecdsa-p256", 2)
+        self.assertNotEqual(key, pool.take("ecdsa-p256"))
+
+    def test_take_empty_or_unknown_type(self):
+        executor = mock.Mock()
+        pool = keypool.KeyPool(1, ["rsa2048"], executor)
+        self.assertIsNone(pool.take("rsa2048"))
+        self.assertEqual(1, executor.submit.call_count)
+        self.assertIsNone(pool.take("rsa2048"))
+        self.assertEqual(1, executor.submit.call_count)
+        self.assertIsNone(pool.take("rsa4096"))
+
+    def test_failed_generation_is_retried(self):
+        executor = mock.Mock()
+        job = futures.Future()
+        executor.submit.return_value = job
+        pool = keypool.KeyPool(1, ["rsa2048"], executor).start()
+        job.set_exception(Exception("boom"))
+        self.assertEqual(0, pool.available("rsa2048"))
+        pool.take("rsa2048")
+        self.assertEqual(2, executor.submit.call_count)
+
+    def test_invalid_key_type(self):
+        with self.assertRaises(ValueError):
+            keypool.KeyPool(1, ["dsa"], self.executor)
+
+    def test_process_pool(self):
+        pool = keypool.KeyPool(1, ["ecdsa-p256"]).start()
+        self.addCleanup(pool.shutdown)
+        self.wait_available(pool, "ecdsa-p256", 1)
+        self.assertIn("BEGIN EC PRIVATE KEY", pool.take("ecdsa-p256"))
+
+
+class TakeKeyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        keypool._pool = None
+        self.addCleanup(setattr, keypool, "_pool", None)
+
+    @mock.patch("rpaas.keypool.sslutils.generate_key")
+    def test_take_key_without_pool(self, generate_key):
+        generate_key.return_value = "inline-key"
+        self.assertEqual("inline-key", keypool.take_key({}, serialized=True))
+        generate_key.assert_called_once_with(True, "rsa2048")
+        self.assertIsNone(keypool._pool)
+
+    def test_take_key_from_pool(self):
+        keypool._pool = keypool.KeyPool(1, ["rsa2048", "ecdsa-p256"], mock.Mock())
+        ec_key = sslutils.generate_key(True, "ecdsa-p256")
+        keypool._pool._keys["ecdsa-p256"].append(ec_key)
+        keypool._pool._keys["rsa2048"].append(sslutils.generate_key(True))
+        with mock.patch("rpaas.keypool.sslutils.generate_key") as generate_key:
+            self.assertEqual(ec_key, keypool.take_key(serialized=True, key_type="ecdsa-p256"))
+            self.assertIsInstance(keypool.take_key(), rsa.RSAPrivateKey)
+        generate_key.assert_not_called()
+
+    @mock.patch("rpaas.keypool.KeyPool")
+    def test_get_pool_from_config(self, KeyPool):
+        pool = keypool.get_pool({"KEY_POOL_SIZE": "3", "KEY_POOL_TYPES": "rsa2048, ecdsa-p256"})
+        self.assertEqual(KeyPool.return_value.start.return_value, pool)
+        self.assertEqual((3, ["rsa2048", "ecdsa-p256"]), KeyPool.call_args[0][:2])
+        self.assertIs(pool, keypool.get_pool({}))
+
+
+    def test_gevent_inactive_without_gevent(self):
+        with mock.patch.dict(sys.modules, {"gevent": None}):
+            self.assertFalse(keypool._gevent_active())
+
+
+class GeventKeyPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        keypool._pool = None
+        self.addCleanup(setattr, keypool, "_pool", None)
+        self.gevent = types.ModuleType("gevent")
+        self.gevent.threadpool = types.ModuleType("gevent.threadpool")
+        self.gevent.threadpool.ThreadPoolExecutor = mock.Mock(side_effect=futures.ThreadPoolExecutor)
+        self.gevent.get_hub = mock.Mock()
+        self.gevent.get_hub.return_value.threadpool.apply.side_effect = lambda func, args: func(*args)
+        patcher = mock.patch.dict(sys.modules, {"gevent": self.gevent, "gevent.threadpool": self.gevent.threadpool})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("rpaas.keypool._gevent_active", return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch("rpaas.keypool.futures.ProcessPoolExecutor")
+    def test_get_pool_uses_gevent_threadpool(self, ProcessPoolExecutor):
+        pool = keypool.get_pool({"KEY_POOL_SIZE": "1", "KEY_POOL_TYPES": "ecdsa-p256", "KEY_POOL_WORKERS": "2"})
+        self.addCleanup(pool.shutdown)
+        ProcessPoolExecutor.assert_not_called()
+        self.gevent.threadpool.ThreadPoolExecutor.assert_called_once_with(max_workers=2)
+        for _ in range(200):
+            if pool.available("ecdsa-p256"):
+                break
+            time.sleep(0.05)
+        self.assertIn("BEGIN EC PRIVATE KEY", pool.take("ecdsa-p256"))
+
+    def test_take_key_without_pool_off_the_hub(self):
+        key = keypool.take_key({}, serialized=True, key_type="ecdsa-p256")
+        self.assertIn("BEGIN EC PRIVATE KEY", key)
+        self.gevent.get_hub.return_value.threadpool.apply.assert_called_once_with(
+            sslutils.generate_key, (True, "ecdsa-p256"))
@@ -64,21 +64,88 @@ class LeRenewerTestCase(unittest.TestCase):
         renewer.start()
         time.sleep(1)
         renewer.stop()
-        self.assertEqual([mock.call(True)] * 5, generate_key.mock_calls)
-        expected_csr_calls = [mock.call("secret-key", "i0.tsuru.io"),
-                              mock.call("secret-key", "i1.tsuru.io"),
+        self.assertEqual([mock.call(True, "rsa2048")] * 5, generate_key.mock_calls)
+        expected_csr_calls = [mock.call("secret-key", "i5.tsuru.io"),
                               mock.call("secret-key", "i4.tsuru.io"),
-                              mock.call("secret-key", "i5.tsuru.io"),
+                              mock.call("secret-key", "i1.tsuru.io"),
+                              mock.call("secret-key", "i0.tsuru.io"),
                               mock.call("secret-key", "i6.tsuru.io")]
         self.assertEqual(expected_csr_calls, generate_csr.mock_calls)
-        expected_crt_calls = [mock.call(self.config, "instance0", "le", "domain-csr",
-                                        "secret-key", "i0.tsuru.io"),
-                              mock.call(self.config, "instance1", "le", "domain-csr",
-                                        "secret-key", "i1.tsuru.io"),
+        expected_crt_calls = [mock.call(self.config, "instance5", "le", "domain-csr",
+                                        "secret-key", "i5.tsuru.io"),
                               mock.call(self.config, "instance4", "le", "domain-csr",
                                         "secret-key", "i4.tsuru.io"),
-                              mock.call(self.config, "instance5", "le", "domain-csr",
-                                        "secret-key", "i5.tsuru.io"),
+                              mock.call(self.config, "instance1", "le", "domain-csr",
+                                        "secret-key", "i1.tsuru.io"),
+                              mock.call(self.config, "instance0", "le", "domain-csr",
+                                        "secret-key", "i0.tsuru.io"),
                               mock.call(self.config, "instance6", "le", "domain-csr",
                                         "secret-key", "i6.tsuru.io")]
         self.assertEqual(expected_crt_calls, generate_crt.mock_calls)
+
+    @mock.patch("rpaas.sslutils.generate_crt")
+    @mock.patch("rpaas.sslutils.generate_csr")
+    @mock.patch("rpaas.sslutils.generate_key")
+    def test_renew_certificates_caps_orders_in_flight(self, generate_key, generate_csr, generate_crt):
+        generate_key.return_value = "secret-key"
+        coll = self.storage.db[self.storage.le_certificates_collection]
+        coll.update({"_id": "instance5"}, {"$set": {"renewal.status": "scheduled",
+                                                    "renewal.scheduled_at": datetime.datetime.utcnow()}})
+        config = dict(self.config, LE_RENEWAL_MAX_ORDERS=3)
+        tasks.RenewCertsTask().delay(config)
+        self.assertEqual(["instance4", "instance1"], [c[0][1] for c in generate_crt.call_args_list])
+        generate_crt.reset_mock()
+        tasks.RenewCertsTask().delay(config)
+        self.assertEqual(0, generate_crt.call_count)
+
+    @mock.patch("rpaas.sslutils.generate_crt")
+    @mock.patch("rpaas.sslutils.generate_csr")
+    @mock.patch("rpaas.sslutils.generate_key")
+    def test_renew_certificates_failure_backoff(self, generate_key, generate_csr, generate_crt):
+        generate_key.return_value = "secret-key"
+        generate_crt.side_effect = Exception("acme is down")
+        config = dict(self.config, LE_RENEWAL_MAX_ORDERS=1)
+        tasks.RenewCertsTask().delay(config)
+        cert = self.storage.db[self.storage.le_certificates_collection].find_one({"_id": "instance5"})
+        self.assertEqual("failed", cert["renewal"]["status"])
+        self.assertEqual(1, cert["renewal"]["attempts"])
+        self.assertGreater(cert["renewal"]["next_attempt"], datetime.datetime.utcnow())
+        generate_crt.reset_mock()
+        generate_crt.side_effect = None
+        tasks.RenewCertsTask().delay(config)
+        self.assertEqual(["instance4"], [c[0][1] for c in generate_crt.call_args_list])
+
+    @mock.patch("rpaas.sslutils.generate_crt")
+    @mock.patch("rpaas.sslutils.generate_csr")
+    @mock.patch("rpaas.sslutils.generate_key")
+    def test_renew_certificates_soonest_expiry_first(self, generate_key, generate_csr, generate_crt):
+        generate_key.return_value = "secret-key"
+        now = datetime.datetime.utcnow()
+        coll = self.storage.db[self.storage.le_certificates_collection]
+        coll.update({}, {"$set": {"expires": now + datetime.timedelta(days=30)}}, multi=True)
+        coll.update({"_id": "instance2"}, {"$set": {"expires": now + datetime.timedelta(hours=1)}})
+        coll.update({"_id": "instance3"}, {"$set": {"expires": now + datetime.timedelta(days=2)}})
+        tasks.RenewCertsTask().delay(dict(self.config, LE_RENEWAL_MAX_ORDERS=1))
+        self.assertEqual(["instance2"], [c[0][1] for c in generate_crt.call_args_list])
+        tasks.RenewCertsTask().delay(dict(self.config, LE_RENEWAL_MAX_ORDERS=2))
+        self.assertEqual(["instance2", "instance3"], [c[0][1] for c in generate_crt.call_args_list])
+
+    @mock.patch("rpaas.sslutils.generate_crt")
+    def test_download_cert_failure_outside_renewal(self, generate_crt):
+        generate_crt.side_effect = Exception("acme is down")
+        tasks.DownloadCertTask().delay(self.config, "instance5", "le", "domain-csr", "secret-key", "i5.tsuru.io")
+        cert = self.storage.db[self.storage.le_certificates_collection].find_one({"_id": "instance5"})
+        self.assertNotIn("renewal", cert)
+
+    @mock.patch("rpaas.tasks.random")
+    @mock.patch("rpaas.sslutils.generate_crt")
+    @mock.patch("rpaas.sslutils.generate_csr")
+    @mock.patch("rpaas.sslutils.generate_key")
+    def test_renew_certificates_jitter_below_visibility_timeout(self, generate_key, generate_csr, generate_crt,
+                                                                random):
+        generate_key.return_value = "secret-key"
+        random.uniform.return_value = 0
+        config = dict(self.config, LE_RENEWAL_MAX_ORDERS=1, LE_RENEWAL_JITTER=7200)
+        with mock.patch.dict(tasks.app.conf, {"BROKER_TRANSPORT_OPTIONS": {"visibility_timeout": 1800}}):
+            tasks.RenewCertsTask().delay(config)
+        random.uniform.assert_called_once_with(0, 900)
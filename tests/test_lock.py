@@ -81,3 +81,26 @@ class LockManagerTestCase(unittest.TestCase):
         lock_manager.extend_lock("lock1", 30)
         time.sleep(3)
         self.assertFalse(lock_1.acquire(blocking=False))
+
+    def test_lock_many(self):
+        lock_manager = lock.Lock(self.redis_conn)
+        other_manager = lock.Lock(self.redis_conn)
+        self.assertTrue(other_manager.lock("lock2", 60))
+        acquired = lock_manager.lock_many(["lock1", "lock2", "lock3", "lock1"], 60)
+        self.assertEqual(["lock1", "lock3"], acquired)
+        self.assertEqual(["lock1", "lock3"], [redis_lock.name for redis_lock in lock_manager.redis_locks])
+        self.assertTrue(0 < self.redis_conn.pttl("lock1") <= 60000)
+        self.assertFalse(lock_manager.lock("lock1", 60))
+        lock_manager.extend_lock("lock3", 30)
+        self.assertTrue(60000 < self.redis_conn.pttl("lock3") <= 90000)
+        lock_manager.unlock_many(acquired)
+        self.assertEqual([], lock_manager.redis_locks)
+        self.assertIsNone(self.redis_conn.get("lock1"))
+        self.assertIsNone(self.redis_conn.get("lock3"))
+        self.assertIsNotNone(self.redis_conn.get("lock2"))
+
+    def test_unlock_unknown_lock(self):
+        lock_manager = lock.Lock(self.redis_conn)
+        lock_manager.unlock("lock1")
+        lock_manager.extend_lock("lock1", 30)
+        self.assertEqual([], lock_manager.redis_locks)
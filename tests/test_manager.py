@@ -5,6 +5,8 @@
 # license that can be found in the LICENSE file.
 
 import copy
+import threading
+import time
 import consul
 import unittest
 import os
@@ -13,7 +15,7 @@ import mock
 
 import rpaas.manager
 from rpaas.manager import Manager, ScaleError, QuotaExceededError
-from rpaas import tasks, storage, nginx
+from rpaas import tasks, storage, nginx, instance_context, sslutils
 from rpaas.consul_manager import InstanceAlreadySwappedError, CertificateNotFoundError
 
 tasks.app.conf.CELERY_ALWAYS_EAGER = True
@@ -155,6 +157,19 @@ class ManagerTestCase(unittest.TestCase):
         dumb_hc.destroy.assert_called_once()
         self.assertEqual(self.storage.find_task("x").count(), 0)
 
+    @mock.patch("rpaas.tasks.consul_manager")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_new_instance_consul_healthcheck_wait(self, nginx, consul_manager):
+        config = copy.deepcopy(self.config)
+        config["RPAAS_HEALTHCHECK_WAIT_MODE"] = "consul"
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.generate_token.return_value = "abc-123"
+        manager.new_instance("x")
+        host = self.Host.create.return_value
+        consul_manager.ConsulManager.return_value.wait_healthy.assert_called_once_with(host.dns_name, timeout=600)
+        nginx.Nginx.return_value.wait_healthcheck.assert_not_called()
+
     @mock.patch("rpaas.tasks.hc.Dumb")
     @mock.patch("rpaas.tasks.nginx")
     def test_new_instance_nginx_wait_healthcheck_fail_and_rollback(self, nginx, hc):
@@ -415,6 +430,15 @@ class ManagerTestCase(unittest.TestCase):
         with self.assertRaises(QuotaExceededError):
             manager.new_instance("g")
 
+    @mock.patch("rpaas.tasks.nginx")
+    def test_remove_instance_decrement_owner_quota(self, nginx):
+        manager = Manager(self.config)
+        manager.new_instance("x", "myteam")
+        self.assertEqual("myteam", self.storage.find_instance_metadata("x")["team"])
+        manager.storage.decrement_quota = mock.Mock()
+        manager.remove_instance("x")
+        manager.storage.decrement_quota.assert_called_once_with("x", "myteam")
+
     @mock.patch("rpaas.tasks.nginx")
     def test_remove_instance_do_not_remove_similar_instance_name(self, nginx):
         manager = Manager(self.config)
@@ -557,6 +581,56 @@ class ManagerTestCase(unittest.TestCase):
                                       {'CLOUDSTACK_TEMPLATE_ID': u'1234', 'HOST_TAGS': u'a:b,c:d'})
         self.assertEqual(self.storage.find_task("x").count(), 0)
 
+    @mock.patch("rpaas.manager.nginx")
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_restore_instance_in_batches(self, LoadBalancer, nginx):
+        self.config["RPAAS_RESTORE_DELAY"] = 0
+        self.config["RPAAS_RESTORE_MAX_UNAVAILABLE"] = 2
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(), mock.Mock(), mock.Mock()]
+        for idx, host_id in enumerate(['xxx', 'yyy', 'zzz']):
+            lb.hosts[idx].id = host_id
+            lb.hosts[idx].dns_name = '10.1.1.{}'.format(idx)
+        manager = Manager(self.config)
+        responses = [response for response in manager.restore_instance("x")]
+        while "." in responses:
+            responses.remove(".")
+        while "\n" in responses:
+            responses.remove("\n")
+        for host in lb.hosts:
+            host.stop.assert_called_once()
+            host.scale.assert_called_once()
+            host.restore.assert_called_once_with(reset_template=True, reset_tags=True)
+            host.start.assert_called_once()
+        self.assertEqual(responses[0], "Restoring hosts (1-2/3) xxx, yyy\n")
+        self.assertItemsEqual(responses[1:3], ["xxx: successfully restored\n", "yyy: successfully restored\n"])
+        self.assertEqual(responses[3:], ["Restoring host (3/3) zzz ", ": successfully restored\n"])
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
+    @mock.patch("rpaas.manager.nginx")
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_restore_instance_in_batches_keeps_min_healthy_and_stops_on_failure(self, LoadBalancer, nginx):
+        self.config["RPAAS_RESTORE_DELAY"] = 0
+        self.config["RPAAS_RESTORE_MIN_HEALTHY"] = 1
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(), mock.Mock(), mock.Mock()]
+        for idx, host_id in enumerate(['xxx', 'yyy', 'zzz']):
+            lb.hosts[idx].id = host_id
+            lb.hosts[idx].dns_name = '10.1.1.{}'.format(idx)
+        lb.hosts[1].restore.side_effect = Exception("failed to restore")
+        manager = Manager(self.config)
+        responses = [response for response in manager.restore_instance("x", max_unavailable=5)]
+        while "." in responses:
+            responses.remove(".")
+        while "\n" in responses:
+            responses.remove("\n")
+        self.assertEqual(responses[0], "Restoring hosts (1-2/3) xxx, yyy\n")
+        self.assertItemsEqual(responses[1:3], ["xxx: successfully restored\n",
+                                               "yyy: failed to restore - 'failed to restore'\n"])
+        self.assertEqual(responses[3:], ["restore aborted: 1 host(s) failed to restore\n"])
+        lb.hosts[2].stop.assert_not_called()
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
     @mock.patch("rpaas.manager.nginx")
     @mock.patch("rpaas.manager.LoadBalancer")
     def test_restore_instance_service_instance_not_found(self, LoadBalancer, nginx):
@@ -577,7 +651,7 @@ class ManagerTestCase(unittest.TestCase):
         lb.hosts[1].dns_name = '10.2.2.2'
         manager = Manager(self.config)
         manager.consul_manager = mock.Mock()
-        manager.consul_manager.node_hostname.side_effect = ['vm-1', 'vm-2']
+        manager.consul_manager.node_hostnames.return_value = {'10.1.1.1': 'vm-1', '10.2.2.2': 'vm-2'}
         manager.consul_manager.node_status.return_value = {'vm-1': 'OK', 'vm-2': 'DEAD'}
         node_status = manager.node_status("x")
         LoadBalancer.find.assert_called_with("x")
@@ -592,7 +666,7 @@ class ManagerTestCase(unittest.TestCase):
         lb.hosts[1].dns_name = '10.2.2.2'
         manager = Manager(self.config)
         manager.consul_manager = mock.Mock()
-        manager.consul_manager.node_hostname.side_effect = ['vm-1', None]
+        manager.consul_manager.node_hostnames.return_value = {'10.1.1.1': 'vm-1'}
         manager.consul_manager.node_status.return_value = {'vm-1': 'OK', 'vm-2': 'DEAD'}
         node_status = manager.node_status("x")
         LoadBalancer.find.assert_called_with("x")
@@ -697,6 +771,8 @@ destination = app1.host.com (https only)"""},
         self.addCleanup(self.storage.remove_instance_metadata, "x")
         config = copy.deepcopy(self.config)
         config["HOST_TAGS"] = "rpaas_service:test-suite-rpaas,rpaas_instance:x,consul_token:abc-123"
+        self.config["RPAAS_SCALE_CONCURRENCY"] = "1"
+        config["RPAAS_SCALE_CONCURRENCY"] = "1"
         manager = Manager(self.config)
         manager.consul_manager.store_acl_network("x", "10.0.0.4/32", "192.168.0.0/24")
         hosts = [mock.Mock(), mock.Mock(), mock.Mock()]
@@ -769,6 +845,204 @@ destination = app1.host.com (https only)"""},
                           mock.call(created_host.dns_name, timeout=600)]
         self.assertEqual(expected_calls, nginx_manager.wait_healthcheck.call_args_list)
 
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_up_concurrently(self, nginx):
+        lb = self.LoadBalancer.find.return_value
+        lb.dsr = False
+        lb.name = "x"
+        lb.hosts = [mock.Mock()]
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        self.config["RPAAS_SCALE_CONCURRENCY"] = "3"
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.find_acl_network.return_value = []
+        hosts = [mock.Mock(), mock.Mock(), mock.Mock(), mock.Mock()]
+        for idx, host in enumerate(hosts):
+            host.dns_name = "10.0.0.{}".format(idx + 1)
+        self.Host.create.side_effect = hosts
+        manager.scale_instance("x", 5)
+        self.assertEqual(self.Host.create.call_count, 4)
+        self.assertItemsEqual([mock.call(host) for host in hosts], lb.add_host.call_args_list)
+        nginx_manager = nginx.Nginx.return_value
+        expected_calls = [mock.call(host.dns_name, timeout=600) for host in hosts]
+        self.assertItemsEqual(expected_calls, nginx_manager.wait_healthcheck.call_args_list)
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_up_concurrently_stops_on_failure(self, nginx):
+        lb = self.LoadBalancer.find.return_value
+        lb.dsr = False
+        lb.name = "x"
+        lb.hosts = [mock.Mock()]
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        self.config["RPAAS_SCALE_CONCURRENCY"] = "1"
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.find_acl_network.return_value = []
+        self.Host.create.side_effect = [mock.Mock(), Exception("Host create failure"), mock.Mock()]
+        manager.scale_instance("x", 4)
+        self.assertEqual(self.Host.create.call_count, 2)
+        self.assertEqual(lb.add_host.call_count, 1)
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_up_concurrently_rollback_keeps_task(self, nginx):
+        lb = self.LoadBalancer.find.return_value
+        lb.dsr = False
+        lb.name = "x"
+        lb.hosts = [mock.Mock()]
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        config = copy.deepcopy(self.config)
+        config["RPAAS_ROLLBACK_ON_ERROR"] = "1"
+        config["RPAAS_SCALE_CONCURRENCY"] = "2"
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.find_acl_network.return_value = []
+        failed_host = mock.Mock(dns_name="10.0.0.1")
+        rolled_back = threading.Event()
+        failed_host.destroy.side_effect = lambda: rolled_back.set()
+        self.Host.create.side_effect = [failed_host, mock.Mock(dns_name="10.0.0.2")]
+        task_counts = []
+
+        def wait_healthcheck(host, timeout):
+            if host == "10.0.0.1":
+                raise Exception("unhealthy")
+            rolled_back.wait(5)
+            time.sleep(0.2)
+            task_counts.append(self.storage.find_task("x").count())
+        nginx.Nginx.return_value.wait_healthcheck.side_effect = wait_healthcheck
+        manager.scale_instance("x", 3)
+        failed_host.destroy.assert_called_once_with()
+        self.assertEqual([1], task_counts)
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
+    @mock.patch("rpaas.tasks.hc.Dumb")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_new_instance_async_healthcheck(self, nginx, hc):
+        config = copy.deepcopy(self.config)
+        config["RPAAS_HEALTHCHECK_ASYNC"] = "1"
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.generate_token.return_value = "abc-123"
+        host = self.Host.create.return_value
+        host.dns_name = "10.0.0.1"
+        manager.new_instance("x")
+        nginx_manager = nginx.Nginx.return_value
+        nginx_manager.healthcheck.assert_called_once_with("10.0.0.1")
+        nginx_manager.wait_healthcheck.assert_not_called()
+        hc.return_value.add_url.assert_called_once_with("x", "10.0.0.1")
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
+    @mock.patch("rpaas.tasks.hc.Dumb")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_up_async_healthcheck(self, nginx, hc):
+        lb = self.LoadBalancer.find.return_value
+        lb.dsr = False
+        lb.name = "x"
+        lb.hosts = [mock.Mock()]
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        config = copy.deepcopy(self.config)
+        config["RPAAS_HEALTHCHECK_ASYNC"] = "1"
+        config["RPAAS_HEALTHCHECK_TIMEOUT"] = "0"
+        config["RPAAS_SCALE_CONCURRENCY"] = "2"
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        hosts = [mock.Mock(dns_name="10.0.0.1"), mock.Mock(dns_name="10.0.0.2"), mock.Mock(dns_name="10.0.0.3")]
+        self.Host.create.side_effect = hosts
+
+        def healthcheck(host):
+            if host == "10.0.0.2":
+                raise Exception("not ready")
+        nginx.Nginx.return_value.healthcheck.side_effect = healthcheck
+        progress = []
+        increment_task_progress = manager.storage.increment_task_progress
+
+        def track_progress(name, field):
+            task = increment_task_progress(name, field)
+            progress.append(task["progress"])
+            return task
+        with mock.patch("rpaas.tasks.storage.MongoDBStorage.increment_task_progress", side_effect=track_progress):
+            manager.scale_instance("x", 4)
+        self.assertItemsEqual([mock.call("x", "10.0.0.1"), mock.call("x", "10.0.0.3")],
+                              hc.return_value.add_url.call_args_list)
+        self.assertEqual({"total": 3, "added": 2, "failed": 1}, progress[-1])
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
+    @mock.patch("rpaas.tasks.hc.Dumb")
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_up_async_healthcheck_rollback(self, nginx, hc):
+        lb = self.LoadBalancer.find.return_value
+        lb.dsr = False
+        lb.name = "x"
+        lb.hosts = [mock.Mock()]
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        config = copy.deepcopy(self.config)
+        config["RPAAS_HEALTHCHECK_ASYNC"] = "1"
+        config["RPAAS_HEALTHCHECK_TIMEOUT"] = "0"
+        config["RPAAS_ROLLBACK_ON_ERROR"] = "1"
+        config["RPAAS_SCALE_CONCURRENCY"] = "1"
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        hosts = [mock.Mock(dns_name="10.0.0.1"), mock.Mock(dns_name="10.0.0.2"), mock.Mock(dns_name="10.0.0.3")]
+        self.Host.create.side_effect = hosts
+
+        def healthcheck(host):
+            if host == "10.0.0.1":
+                raise Exception("not ready")
+        nginx.Nginx.return_value.healthcheck.side_effect = healthcheck
+        progress = []
+        increment_task_progress = manager.storage.increment_task_progress
+
+        def track_progress(name, field):
+            task = increment_task_progress(name, field)
+            progress.append(task and task["progress"])
+            return task
+        with mock.patch("rpaas.tasks.storage.MongoDBStorage.increment_task_progress", side_effect=track_progress):
+            manager.scale_instance("x", 4)
+        hosts[0].destroy.assert_called_once()
+        self.assertEqual([{"total": 3, "added": 0, "failed": 1}, {"total": 3, "added": 1, "failed": 1},
+                          {"total": 3, "added": 2, "failed": 1}], progress)
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
+    @mock.patch("rpaas.tasks.nginx")
+    def test_scale_instance_up_async_healthcheck_releases_task_on_early_error(self, nginx):
+        lb = self.LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock()]
+        self.storage.store_instance_metadata("x", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "x")
+        config = copy.deepcopy(self.config)
+        config["RPAAS_HEALTHCHECK_ASYNC"] = "1"
+        manager = Manager(config)
+        manager.consul_manager = mock.Mock()
+        with mock.patch("rpaas.tasks.storage.MongoDBStorage.update_task", side_effect=Exception("mongo is down")):
+            manager.scale_instance("x", 3)
+        self.Host.create.assert_not_called()
+        self.assertEqual(self.storage.find_task("x").count(), 0)
+
+    @mock.patch("rpaas.tasks.nginx")
+    def test_wait_healthy_task_reschedules_until_deadline(self, nginx):
+        self.storage.store_task("x")
+        nginx.Nginx.return_value.healthcheck.side_effect = Exception("booting")
+        task = tasks.WaitHealthyTask()
+        deadline = time.time() + 600
+        with mock.patch.object(tasks.WaitHealthyTask, "apply_async") as apply_async:
+            task.run(self.config, "x", "host-id", "10.0.0.1", deadline)
+        apply_async.assert_called_once_with(args=[self.config, "x", "host-id", "10.0.0.1", deadline, False, False],
+                                            countdown=5.0)
+        self.assertEqual(self.storage.find_task("x").count(), 1)
+
+    def test_info_with_scale_progress(self):
+        self.storage.store_task({"_id": "x", "progress": {"total": 4, "added": 1, "failed": 0}})
+        manager = Manager(self.config)
+        manager._get_address = mock.Mock(return_value="pending")
+        info = manager.info("x")
+        self.assertIn({"label": "Scale progress", "value": "1/4 hosts added, 0 failed"}, info)
+
     def test_scale_instance_error_task_running(self):
         self.storage.store_task("x")
         manager = Manager(self.config)
@@ -795,7 +1069,7 @@ destination = app1.host.com (https only)"""},
         lb.hosts[0].id = '1234'
         self.storage.store_instance_metadata("x", consul_token="abc-123")
         self.addCleanup(self.storage.remove_instance_metadata, "x")
-        consul.node_hostname.return_value = 'rpaas-2'
+        consul.node_hostnames.return_value = {'10.2.2.2': 'rpaas-2'}
         manager = Manager(config)
         manager.consul_manager = mock.Mock()
         manager.consul_manager.generate_token.return_value = "abc-123"
@@ -1048,6 +1322,60 @@ destination = app1.host.com (https only)"""},
         with self.assertRaises(rpaas.tasks.NotReadyError):
             manager.update_certificate("inst", "cert", "key")
 
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_instance_context_reused_within_request(self, LoadBalancer):
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(), mock.Mock()]
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        instance_context.begin_request()
+        try:
+            manager.update_certificate("inst", "cert", "key")
+            manager.list_blocks("inst")
+            manager.node_status("inst")
+        finally:
+            instance_context.end_request()
+        LoadBalancer.find.assert_called_once_with("inst")
+        manager.list_blocks("inst")
+        self.assertEqual(LoadBalancer.find.call_count, 2)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_instance_context_invalidated_on_write(self, LoadBalancer):
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock()]
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        self.storage.store_instance_metadata("inst", consul_token="abc-123")
+        instance_context.begin_request()
+        try:
+            manager.list_blocks("inst")
+            manager.update_instance("inst", plan_name="small")
+            manager.list_blocks("inst")
+        finally:
+            instance_context.end_request()
+        self.assertEqual(LoadBalancer.find.call_count, 2)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_instance_context_checks_readiness_on_every_request(self, LoadBalancer):
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.list_blocks("inst")
+        self.storage.store_task("inst")
+        with self.assertRaises(rpaas.tasks.NotReadyError):
+            manager.list_blocks("inst")
+        self.storage.remove_task("inst")
+        manager.list_blocks("inst")
+        self.assertEqual(LoadBalancer.find.call_count, 2)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_delete_route_checks_readiness_once(self, LoadBalancer):
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.task_manager = mock.Mock()
+        with self.assertRaises(storage.InstanceNotFoundError):
+            manager.delete_route("inst", "/somewhere")
+        manager.task_manager.ensure_ready.assert_called_once_with("inst")
+
     @mock.patch("rpaas.manager.LoadBalancer")
     def test_get_certificate_success(self, LoadBalancer):
         lb = LoadBalancer.find.return_value
@@ -1452,6 +1780,41 @@ destination = app1.host.com (https only)"""},
         LoadBalancer.find.assert_called_with("inst")
         manager.consul_manager.list_blocks.assert_called_with("inst")
 
+    @mock.patch.object(Manager, "_check_dns", return_value=True)
+    def test_activate_ssl_with_key_types(self, check_dns):
+        self.storage.store_instance_metadata("inst", consul_token="abc-123")
+        self.addCleanup(self.storage.remove_instance_metadata, "inst")
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.activate_ssl("inst", u"inst.tsuru.io", key_types="ecdsa-p256, rsa2048")
+        self.assertEqual("ecdsa-p256,rsa2048", self.storage.find_instance_metadata("inst")["ssl_key_types"])
+        manager.consul_manager.set_certificates.assert_called_once()
+        name, certificates = manager.consul_manager.set_certificates.call_args[0]
+        self.assertEqual("inst", name)
+        self.assertEqual(["ecdsa", "rsa"], [algorithm for algorithm, _, _ in certificates])
+        for algorithm, cert, key in certificates:
+            self.assertEqual(algorithm, sslutils.key_algorithm(key))
+            self.assertIsNotNone(sslutils.certificate_expiry(cert))
+        certificate = self.storage.db[self.storage.instance_certificates_collection].find_one({"_id": "inst"})
+        self.assertEqual(("default", "inst.tsuru.io"), (certificate["source"], certificate["domain"]))
+
+    @mock.patch.object(Manager, "_check_dns", return_value=True)
+    def test_activate_ssl_invalid_key_types(self, check_dns):
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        with self.assertRaises(rpaas.manager.SslError):
+            manager.activate_ssl("inst", u"inst.tsuru.io", key_types="dsa1024")
+        manager.consul_manager.set_certificates.assert_not_called()
+
+    def test_revoke_ssl_ecdsa_certificate(self):
+        manager = Manager(self.config)
+        manager.consul_manager = mock.Mock()
+        manager.consul_manager.get_certificate.return_value = ("cert", sslutils.generate_key(True, "ecdsa-p256"))
+        with self.assertRaises(rpaas.manager.SslError) as cm:
+            manager.revoke_ssl("inst", "le")
+        self.assertEqual("revoking ecdsa certificates is not supported", str(cm.exception))
+        self.assertEqual(0, self.storage.find_task("inst").count())
+
     @mock.patch("rpaas.manager.LoadBalancer")
     def test_purge_location(self, LoadBalancer):
         lb = LoadBalancer.find.return_value
@@ -1459,14 +1822,109 @@ destination = app1.host.com (https only)"""},
 
         manager = Manager(self.config)
         manager.nginx_manager = mock.Mock()
-        manager.nginx_manager.purge_location.side_effect = [True, True]
+        variants = [("gzip", "purge/foo/bar", {}), ("identity", "purge/foo/bar", {})]
+        manager.nginx_manager.purge_variants.return_value = variants
+        manager.nginx_manager.purge_variant.return_value = True
         purged_hosts = manager.purge_location("inst", "/foo/bar", True)
 
         LoadBalancer.find.assert_called_with("inst")
 
         self.assertEqual(purged_hosts, 2)
-        manager.nginx_manager.purge_location.assert_any_call(lb.hosts[0].dns_name, "/foo/bar", True)
-        manager.nginx_manager.purge_location.assert_any_call(lb.hosts[1].dns_name, "/foo/bar", True)
+        manager.nginx_manager.purge_variants.assert_called_once_with("/foo/bar", True)
+        for host in lb.hosts:
+            for variant in variants:
+                manager.nginx_manager.purge_variant.assert_any_call(host.dns_name, variant)
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_purge_location_hosts_report(self, LoadBalancer):
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(dns_name="10.1.1.1"), mock.Mock(dns_name="10.2.2.2")]
+        manager = Manager(self.config)
+        manager.nginx_manager = mock.Mock()
+        manager.nginx_manager.purge_variants.return_value = [("gzip", "purge/foo", {}), ("identity", "purge/foo", {})]
+        manager.nginx_manager.purge_variant.side_effect = lambda host, variant: host == "10.1.1.1" or \
+            variant[0] == "gzip"
+        hosts = manager.purge_location_hosts("inst", "/foo")
+        self.assertDictEqual(hosts, {
+            "10.1.1.1": {"purged": True, "variants": ["gzip", "identity"], "failed": [], "timed_out": []},
+            "10.2.2.2": {"purged": True, "variants": ["gzip"], "failed": ["identity"], "timed_out": []},
+        })
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_purge_location_hosts_deadline(self, LoadBalancer):
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(dns_name="10.1.1.1"), mock.Mock(dns_name="10.2.2.2")]
+        config = copy.deepcopy(self.config)
+        config["RPAAS_PURGE_TIMEOUT"] = "0.2"
+        manager = Manager(config)
+        manager.nginx_manager = mock.Mock()
+        manager.nginx_manager.purge_variants.return_value = [("gzip", "purge/foo", {})]
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def purge_variant(host, variant):
+            if host == "10.2.2.2":
+                release.wait(5)
+            return True
+        manager.nginx_manager.purge_variant.side_effect = purge_variant
+        hosts = manager.purge_location_hosts("inst", "/foo")
+        self.assertEqual(["gzip"], hosts["10.1.1.1"]["variants"])
+        self.assertFalse(hosts["10.2.2.2"]["purged"])
+        self.assertEqual(["gzip"], hosts["10.2.2.2"]["timed_out"])
+        self.assertEqual(1, manager.purge_location("inst", "/foo"))
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_purge_locations(self, LoadBalancer):
+        lb = LoadBalancer.find.return_value
+        lb.hosts = [mock.Mock(dns_name="10.1.1.1"), mock.Mock(dns_name="10.2.2.2")]
+        manager = Manager(self.config)
+        manager.nginx_manager = mock.Mock()
+        manager.nginx_manager.purge_variants.return_value = [("gzip", "purge/foo", {})]
+        manager.nginx_manager.purge_variant.return_value = True
+        results = list(manager.purge_locations("inst", [{"path": "/foo"}, {"path": "/bar", "preserve_path": True}]))
+        LoadBalancer.find.assert_called_once_with("inst")
+        self.assertItemsEqual(["/foo", "/bar"], [result["path"] for result in results])
+        self.assertEqual([2, 2], [result["instances_purged"] for result in results])
+        self.assertEqual(4, manager.nginx_manager.purge_variant.call_count)
+
+    @mock.patch("rpaas.tasks.nginx")
+    def test_purge_locations_async(self, nginx):
+        self.LoadBalancer.find.return_value.hosts = [mock.Mock(dns_name="10.1.1.1")]
+        nginx_manager = nginx.Nginx.return_value
+        nginx_manager.purge_variants.return_value = [("gzip", "purge/foo", {})]
+        nginx_manager.purge_variant.return_value = True
+        manager = Manager(self.config)
+        with mock.patch("rpaas.manager.LoadBalancer") as LoadBalancer:
+            LoadBalancer.find.return_value.hosts = []
+            task_id = manager.purge_locations_async("x", [{"path": "/foo"}])
+        self.assertIsNotNone(task_id)
+        nginx_manager.purge_variant.assert_called_once_with("10.1.1.1", ("gzip", "purge/foo", {}))
+        self.assertEqual("x", self.storage.find_purge_task("x", task_id)["instance"])
+        result = manager.purge_locations_result("x", task_id)
+        self.assertEqual("SUCCESS", result["status"])
+        self.assertEqual(["/foo"], [r["path"] for r in result["results"]])
+
+    def test_purge_locations_result_unknown_task(self):
+        manager = Manager(self.config)
+        self.storage.store_purge_task("other", "task-1")
+        with self.assertRaises(tasks.TaskNotFoundError):
+            manager.purge_locations_result("x", "task-1")
+        with self.assertRaises(tasks.TaskNotFoundError):
+            manager.purge_locations_result("x", "unknown")
+
+    @mock.patch("rpaas.manager.LoadBalancer")
+    def test_purge_locations_uses_bulk_executor(self, LoadBalancer):
+        LoadBalancer.find.return_value.hosts = [mock.Mock(dns_name="10.1.1.1")]
+        config = copy.deepcopy(self.config)
+        config["RPAAS_PURGE_BULK_CONCURRENCY"] = "2"
+        manager = Manager(config)
+        manager.nginx_manager = mock.Mock()
+        manager.nginx_manager.purge_variants.return_value = [("gzip", "purge/foo", {})]
+        manager.purge_executor = mock.Mock()
+        self.assertEqual(2, manager.purge_bulk_executor._max_workers)
+        results = list(manager.purge_locations("inst", [{"path": "/foo"}]))
+        self.assertEqual(1, results[0]["instances_purged"])
+        manager.purge_executor.submit.assert_not_called()
 
     @mock.patch("rpaas.manager.LoadBalancer")
     def test_add_lua_with_content(self, LoadBalancer):
@@ -6,7 +6,7 @@ import unittest
 
 import mock
 
-from rpaas.nginx import Nginx, NginxError
+from rpaas.nginx import Nginx, NginxError, RetryPolicy
 
 
 class NginxTestCase(unittest.TestCase):
@@ -59,6 +59,7 @@ class NginxTestCase(unittest.TestCase):
 
     @mock.patch('rpaas.nginx.requests')
     def test_purge_location_successfully(self, requests):
+        session = requests.Session.return_value
         nginx = Nginx()
 
         response = mock.Mock()
@@ -69,56 +70,59 @@ class NginxTestCase(unittest.TestCase):
         side_effect.status_code = 404
         side_effect.text = "Not Found"
 
-        requests.request.side_effect = [response, side_effect, response, side_effect]
+        session.request.side_effect = [response, side_effect, response, side_effect]
         purged = nginx.purge_location('myhost', '/foo/bar')
         self.assertTrue(purged)
-        self.assertEqual(requests.request.call_count, 4)
+        self.assertEqual(session.request.call_count, 4)
         expec_responses = []
         for scheme in ['http', 'https']:
             for header in self.cache_headers:
                 expec_responses.append(mock.call('get', 'http://myhost:8089/purge/{}/foo/bar'.format(scheme),
                                        headers=header, timeout=2))
-        requests.request.assert_has_calls(expec_responses)
+        session.request.assert_has_calls(expec_responses)
 
     @mock.patch('rpaas.nginx.requests')
     def test_purge_location_preserve_path_successfully(self, requests):
+        session = requests.Session.return_value
         nginx = Nginx()
 
         response = mock.Mock()
         response.status_code = 200
         response.text = 'purged'
 
-        requests.request.side_effect = [response]
+        session.request.side_effect = [response]
         purged = nginx.purge_location('myhost', 'http://example.com/foo/bar', True)
         self.assertTrue(purged)
-        self.assertEqual(requests.request.call_count, 2)
+        self.assertEqual(session.request.call_count, 2)
         expected_responses = []
         for header in self.cache_headers:
             expected_responses.append(mock.call('get', 'http://myhost:8089/purge/http://example.com/foo/bar',
                                       headers=header, timeout=2))
-        requests.request.assert_has_calls(expected_responses)
+        session.request.assert_has_calls(expected_responses)
 
     @mock.patch('rpaas.nginx.requests')
     def test_purge_location_not_found(self, requests):
+        session = requests.Session.return_value
         nginx = Nginx()
 
         response = mock.Mock()
         response.status_code = 404
         response.text = 'Not Found'
 
-        requests.request.side_effect = [response, response, response, response]
+        session.request.side_effect = [response, response, response, response]
         purged = nginx.purge_location('myhost', '/foo/bar')
         self.assertFalse(purged)
-        self.assertEqual(requests.request.call_count, 4)
+        self.assertEqual(session.request.call_count, 4)
         expec_responses = []
         for scheme in ['http', 'https']:
             for header in self.cache_headers:
                 expec_responses.append(mock.call('get', 'http://myhost:8089/purge/{}/foo/bar'.format(scheme),
                                        headers=header, timeout=2))
-        requests.request.assert_has_calls(expec_responses)
+        session.request.assert_has_calls(expec_responses)
 
     @mock.patch('rpaas.nginx.requests')
     def test_wait_healthcheck(self, requests):
+        session = requests.Session.return_value
         nginx = Nginx()
         count = [0]
         response = mock.Mock()
@@ -131,13 +135,14 @@ class NginxTestCase(unittest.TestCase):
                 raise Exception('some error')
             return response
 
-        requests.request.side_effect = side_effect
+        session.request.side_effect = side_effect
         nginx.wait_healthcheck('myhost.com', timeout=5)
-        self.assertEqual(requests.request.call_count, 2)
-        requests.request.assert_called_with('get', 'http://myhost.com:8089/healthcheck', timeout=2)
+        self.assertEqual(session.request.call_count, 2)
+        session.request.assert_called_with('get', 'http://myhost.com:8089/healthcheck', timeout=2)
 
     @mock.patch('rpaas.nginx.requests')
     def test_wait_app_healthcheck(self, requests):
+        session = requests.Session.return_value
         nginx = Nginx()
         count = [0]
         response = mock.Mock()
@@ -150,13 +155,14 @@ class NginxTestCase(unittest.TestCase):
                 raise Exception('some error')
             return response
 
-        requests.request.side_effect = side_effect
+        session.request.side_effect = side_effect
         nginx.wait_healthcheck('myhost.com', timeout=5, manage_healthcheck=False)
-        self.assertEqual(requests.request.call_count, 2)
-        requests.request.assert_called_with('get', 'http://myhost.com:8080/_nginx_healthcheck/', timeout=2)
+        self.assertEqual(session.request.call_count, 2)
+        session.request.assert_called_with('get', 'http://myhost.com:8080/_nginx_healthcheck/', timeout=2)
 
     @mock.patch('rpaas.nginx.requests')
     def test_wait_app_healthcheck_invalid_response(self, requests):
+        session = requests.Session.return_value
         nginx = Nginx()
         count = [0]
         response = mock.Mock()
@@ -169,40 +175,96 @@ class NginxTestCase(unittest.TestCase):
                 raise Exception('some error')
             return response
 
-        requests.request.side_effect = side_effect
+        session.request.side_effect = side_effect
         with self.assertRaises(NginxError):
             nginx.wait_healthcheck('myhost.com', timeout=5, manage_healthcheck=False)
-        self.assertEqual(requests.request.call_count, 6)
-        requests.request.assert_called_with('get', 'http://myhost.com:8080/_nginx_healthcheck/', timeout=2)
+        self.assertEqual(session.request.call_count, 6)
+        session.request.assert_called_with('get', 'http://myhost.com:8080/_nginx_healthcheck/', timeout=2)
 
     @mock.patch('rpaas.nginx.requests')
     def test_wait_healthcheck_timeout(self, requests):
+        session = requests.Session.return_value
         nginx = Nginx()
 
         def side_effect(method, url, timeout, **params):
             raise Exception('some error')
 
-        requests.request.side_effect = side_effect
+        session.request.side_effect = side_effect
         with self.assertRaises(Exception):
             nginx.wait_healthcheck('myhost.com', timeout=2)
-        self.assertGreaterEqual(requests.request.call_count, 2)
-        requests.request.assert_called_with('get', 'http://myhost.com:8089/healthcheck', timeout=2)
+        self.assertGreaterEqual(session.request.call_count, 2)
+        session.request.assert_called_with('get', 'http://myhost.com:8089/healthcheck', timeout=2)
 
     @mock.patch('os.path')
     @mock.patch('rpaas.nginx.requests')
     def test_add_session_ticket_success(self, requests, os_path):
+        session = requests.Session.return_value
         nginx = Nginx({'CA_CERT': 'cert data'})
         os_path.exists.return_value = True
         response = mock.Mock()
         response.status_code = 200
         response.text = '\n\nticket was succsessfully added'
-        requests.request.return_value = response
+        session.request.return_value = response
         nginx.add_session_ticket('host-1', 'random data', timeout=2)
-        requests.request.assert_called_once_with('post', 'https://host-1:8090/session_ticket', timeout=2,
-                                                 data='random data', verify='/tmp/rpaas_ca.pem')
+        session.request.assert_called_once_with('post', 'https://host-1:8090/session_ticket', timeout=2,
+                                                data='random data', verify='/tmp/rpaas_ca.pem')
 
     @mock.patch('rpaas.nginx.requests')
     def test_missing_ca_cert(self, requests):
         nginx = Nginx()
         with self.assertRaises(NginxError):
             nginx.add_session_ticket('host-1', 'random data', timeout=2)
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_reuses_session_per_host(self, requests):
+        requests.Session.side_effect = lambda: mock.Mock()
+        nginx = Nginx({'NGINX_POOL_MAXSIZE': '8'})
+        self.assertIs(nginx._session('host-1'), nginx._session('host-1'))
+        self.assertIsNot(nginx._session('host-1'), nginx._session('host-2'))
+        self.assertEqual(requests.Session.call_count, 2)
+        requests.adapters.HTTPAdapter.assert_called_with(pool_connections=1, pool_maxsize=8)
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_evicts_least_recently_used_session(self, requests):
+        requests.Session.side_effect = lambda: mock.Mock()
+        nginx = Nginx({'NGINX_MAX_SESSIONS': '2'})
+        session_1 = nginx._session('host-1')
+        nginx._session('host-2')
+        nginx._session('host-1')
+        session_2 = nginx._session('host-2')
+        nginx._session('host-3')
+        self.assertEqual(['host-2', 'host-3'], nginx._sessions.keys())
+        session_1.close.assert_called_once_with()
+        session_2.close.assert_not_called()
+
+    @mock.patch('rpaas.nginx.requests')
+    def test_request_timeout_from_config(self, requests):
+        session = requests.Session.return_value
+        response = mock.Mock()
+        response.status_code = 200
+        response.text = 'WORKING'
+        session.request.return_value = response
+        nginx = Nginx({'NGINX_REQUEST_TIMEOUT': '5'})
+        nginx.wait_healthcheck('myhost.com', timeout=2)
+        session.request.assert_called_once_with('get', 'http://myhost.com:8089/healthcheck', timeout=5.0)
+
+    @mock.patch('rpaas.nginx.time')
+    @mock.patch('rpaas.nginx.requests')
+    def test_wait_healthcheck_backoff_policy(self, requests, time):
+        session = requests.Session.return_value
+        response = mock.Mock()
+        response.status_code = 200
+        response.text = 'WORKING'
+        session.request.side_effect = [Exception('some error')] * 4 + [response]
+        nginx = Nginx({'NGINX_RETRY_INITIAL_DELAY': '0.5', 'NGINX_RETRY_MULTIPLIER': '2',
+                       'NGINX_RETRY_MAX_DELAY': '3'})
+        nginx.wait_healthcheck('myhost.com', timeout=30)
+        self.assertEqual([mock.call(0.5), mock.call(1.0), mock.call(2.0), mock.call(3.0)],
+                         time.sleep.call_args_list)
+
+    def test_retry_policy_jitter(self):
+        policy = RetryPolicy(initial_delay=2, multiplier=2, jitter=0.5, max_delay=5)
+        delays = policy.delays()
+        with mock.patch('rpaas.nginx.random.uniform', return_value=0.5) as uniform:
+            self.assertEqual([1.0, 2.0, 2.5], [next(delays) for _ in range(3)])
+        uniform.assert_called_with(0, 0.5)
@@ -5,6 +5,7 @@
 import os
 import unittest
 import re
+import urlparse
 
 import mock
 import argparse
@@ -256,6 +257,22 @@ class TsuruPluginTestCase(unittest.TestCase):
         urlopen.assert_called_with(request)
         stdout.write.assert_called_with("Certificate successfully updated\n")
 
+    @mock.patch("rpaas.plugin.urlopen")
+    @mock.patch("rpaas.plugin.Request")
+    @mock.patch("sys.stdout")
+    def test_ssl_key_types(self, stdout, Request, urlopen):
+        request = Request.return_value
+        urlopen.return_value.getcode.return_value = 200
+        self.set_envs()
+        self.addCleanup(self.delete_envs)
+        plugin.ssl(['-s', 'service1', '-i', 'inst1', '-d', 'inst1.tsuru.io', '-p', 'le', '-t', 'ecdsa-p256,rsa2048'])
+        Request.assert_called_with(self.target +
+                                   "services/service1/proxy/inst1?" +
+                                   "callback=/resources/inst1/ssl")
+        data = urlparse.parse_qs(request.add_data.call_args[0][0])
+        self.assertEqual({"domain": ["inst1.tsuru.io"], "plugin": ["le"], "key_types": ["ecdsa-p256,rsa2048"]}, data)
+        stdout.write.assert_called_with("Certificate successfully updated\n")
+
     @mock.patch("sys.stderr")
     def test_route_args(self, stderr):
         parsed = plugin.get_route_args(
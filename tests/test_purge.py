@@ -0,0 +1,113 @@
+# Copyright 2017 rpaas authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+import unittest
+
+import mock
+from concurrent import futures
+
+from rpaas import purge
+
+
+class BulkPurgeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = futures.ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(self.executor.shutdown, False)
+        self.nginx = mock.Mock()
+        self.nginx.purge_variants.side_effect = lambda path, preserve_path: [
+            ("gzip", "purge" + path, {"Accept-Encoding": "gzip"}),
+            ("identity", "purge" + path, {"Accept-Encoding": "identity"}),
+        ]
+        self.nginx.purge_variant.return_value = True
+
+    def test_run(self):
+        bulk_purge = purge.BulkPurge(self.nginx, self.executor)
+        results = list(bulk_purge.run(["10.1.1.1", "10.2.2.2"], [{"path": "/a"}, {"path": " /b ",
+                                                                                  "preserve_path": False}], 5))
+        self.assertItemsEqual(["/a", " /b "], [result["path"] for result in results])
+        for result in results:
+            self.assertEqual(2, result["instances_purged"])
+            self.assertEqual({"purged": True, "variants": ["gzip", "identity"], "failed": [], "timed_out": []},
+                             result["hosts"]["10.1.1.1"])
+        self.nginx.purge_variants.assert_any_call("/b", False)
+        self.assertEqual(8, self.nginx.purge_variant.call_count)
+
+    def test_run_preserve_path(self):
+        bulk_purge = purge.BulkPurge(self.nginx, self.executor)
+        list(bulk_purge.run(["10.1.1.1"], [{"path": " http://example.com/a", "preserve_path": True}], 5))
+        self.nginx.purge_variants.assert_called_once_with(" http://example.com/a", True)
+
+    def test_run_reports_failed_variants(self):
+        self.nginx.purge_variant.side_effect = lambda host, variant: host == "10.1.1.1" and variant[0] == "gzip"
+        bulk_purge = purge.BulkPurge(self.nginx, self.executor)
+        result = next(bulk_purge.run(["10.1.1.1", "10.2.2.2"], [{"path": "/a"}], 5))
+        self.assertEqual(1, result["instances_purged"])
+        self.assertEqual({"purged": True, "variants": ["gzip"], "failed": ["identity"], "timed_out": []},
+                         result["hosts"]["10.1.1.1"])
+        self.assertEqual({"purged": False, "variants": [], "failed": ["gzip", "identity"], "timed_out": []},
+                         result["hosts"]["10.2.2.2"])
+
+    def test_run_yields_paths_as_they_complete(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def purge_variant(host, variant):
+            if variant[1] == "purge/slow":
+                release.wait(5)
+            return True
+        self.nginx.purge_variant.side_effect = purge_variant
+        bulk_purge = purge.BulkPurge(self.nginx, self.executor)
+        results = bulk_purge.run(["10.1.1.1"], [{"path": "/slow"}, {"path": "/fast"}], 5)
+        self.assertEqual("/fast", next(results)["path"])
+        release.set()
+        self.assertEqual("/slow", next(results)["path"])
+
+    def test_run_deadline(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def purge_variant(host, variant):
+            if host == "10.2.2.2":
+                release.wait(5)
+            return True
+        self.nginx.purge_variant.side_effect = purge_variant
+        bulk_purge = purge.BulkPurge(self.nginx, self.executor)
+        results = list(bulk_purge.run(["10.1.1.1", "10.2.2.2"], [{"path": "/a"}], 0.2))
+        self.assertEqual(1, len(results))
+        self.assertEqual(1, results[0]["instances_purged"])
+        self.assertEqual({"purged": False, "variants": [], "failed": [], "timed_out": ["gzip", "identity"]},
+                         results[0]["hosts"]["10.2.2.2"])
+
+    def test_run_without_hosts(self):
+        bulk_purge = purge.BulkPurge(self.nginx, self.executor)
+        results = list(bulk_purge.run([], [{"path": "/a"}], 5))
+        self.assertEqual([{"path": "/a", "hosts": {}, "instances_purged": 0}], results)
+
+    def test_run_close_cancels_pending_jobs(self):
+        executor = futures.ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown, False)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def purge_variant(host, variant):
+            if variant[1] == "purge/b":
+                release.wait(5)
+            return True
+        self.nginx.purge_variant.side_effect = purge_variant
+        bulk_purge = purge.BulkPurge(self.nginx, executor)
+        results = bulk_purge.run(["10.1.1.1"], [{"path": "/a"}, {"path": "/b"}], 5)
+        self.assertEqual("/a", next(results)["path"])
+        results.close()
+        release.set()
+        executor.shutdown(wait=True)
+        self.assertEqual(3, self.nginx.purge_variant.call_count)
+
+    def test_run_submits_nothing_until_consumed(self):
+        executor = mock.Mock()
+        bulk_purge = purge.BulkPurge(self.nginx, executor)
+        results = bulk_purge.run(["10.1.1.1"], [{"path": "/a"}], 5)
+        results.close()
+        executor.submit.assert_not_called()
@@ -3,13 +3,14 @@
 # license that can be found in the LICENSE file.
 
 import datetime
+import threading
 import time
 import unittest
 import redis
 import consul
 
 from freezegun import freeze_time
-from mock import patch, call
+from mock import ANY, patch, call
 from rpaas import storage, tasks
 from rpaas import session_resumption, consul_manager
 from cryptography import x509
@@ -131,9 +132,9 @@ class SessionResumptionTestCase(unittest.TestCase):
         session.start()
         time.sleep(1)
         session.stop()
-        nginx_expected_calls = [call('10.1.1.1', 'ticket1', 30), call('10.1.1.2', 'ticket1', 30),
-                                call('10.2.2.2', 'ticket2', 30), call('10.2.2.3', 'ticket2', 30)]
-        self.assertEqual(nginx_expected_calls, nginx_manager.add_session_ticket.call_args_list)
+        nginx_expected_calls = [call('10.1.1.1', 'ticket1', timeout=30), call('10.1.1.2', 'ticket1', timeout=30),
+                                call('10.2.2.2', 'ticket2', timeout=30), call('10.2.2.3', 'ticket2', timeout=30)]
+        self.assertItemsEqual(nginx_expected_calls, nginx_manager.add_session_ticket.call_args_list)
         cert_a, key_a = self.consul_manager.get_certificate("instance-a", "xxx")
         cert_b, key_b = self.consul_manager.get_certificate("instance-b", "bbb")
         redis.StrictRedis().delete("session_resumption:test_rpaas_session_resumption:last_run")
@@ -142,13 +143,13 @@ class SessionResumptionTestCase(unittest.TestCase):
         session.start()
         time.sleep(1)
         session.stop()
-        nginx_expected_calls = [call('10.1.1.1', 'ticket3', 30), call('10.1.1.2', 'ticket3', 30),
-                                call('10.2.2.2', 'ticket4', 30), call('10.2.2.3', 'ticket4', 30)]
-        self.assertEqual(nginx_expected_calls, nginx_manager.add_session_ticket.call_args_list)
+        nginx_expected_calls = [call('10.1.1.1', 'ticket3', timeout=30), call('10.1.1.2', 'ticket3', timeout=30),
+                                call('10.2.2.2', 'ticket4', timeout=30), call('10.2.2.3', 'ticket4', timeout=30)]
+        self.assertItemsEqual(nginx_expected_calls, nginx_manager.add_session_ticket.call_args_list)
         self.assertTupleEqual((cert_a, key_a), self.consul_manager.get_certificate("instance-a", "xxx"))
         self.assertTupleEqual((cert_b, key_b), self.consul_manager.get_certificate("instance-b", "bbb"))
 
-    @patch.object(tasks.SessionResumptionTask, "rotate_session_ticket", return_value=None)
+    @patch.object(tasks.SessionResumptionTask, "rotate_session_ticket", return_value=[])
     @patch("rpaas.tasks.LoadBalancer")
     def test_renew_session_tickets_only_on_selected_instances(self, load_balancer, rotate_session):
         self.config["SESSION_RESUMPTION_INSTANCES"] = "instance-a,instance-c"
@@ -165,7 +166,7 @@ class SessionResumptionTestCase(unittest.TestCase):
         session.start()
         time.sleep(1)
         session.stop()
-        self.assertEqual(rotate_session.call_args_list, [call(lb1.hosts), call(lb3.hosts)])
+        self.assertEqual(rotate_session.call_args_list, [call(ANY, lb1.hosts), call(ANY, lb3.hosts)])
 
     @patch("rpaas.tasks.logging")
     @patch("rpaas.tasks.sslutils.generate_session_ticket")
@@ -185,9 +186,9 @@ class SessionResumptionTestCase(unittest.TestCase):
         session.start()
         time.sleep(1)
         session.stop()
-        nginx_expected_calls = [call('10.1.1.1', 'ticket1', 30), call('10.2.2.2', 'ticket2', 30),
-                                call('10.2.2.3', 'ticket2', 30)]
-        self.assertEqual(nginx_expected_calls, nginx_manager.add_session_ticket.call_args_list)
+        nginx_expected_calls = [call('10.1.1.1', 'ticket1', timeout=30), call('10.2.2.2', 'ticket2', timeout=30),
+                                call('10.2.2.3', 'ticket2', timeout=30)]
+        self.assertItemsEqual(nginx_expected_calls, nginx_manager.add_session_ticket.call_args_list)
         redis.StrictRedis().delete("session_resumption:test_rpaas_session_resumption:last_run")
         lb1_host2.unset_fail("dns_name")
         nginx_manager.reset_mock()
@@ -195,9 +196,9 @@ class SessionResumptionTestCase(unittest.TestCase):
         session.start()
         time.sleep(1)
         session.stop()
-        nginx_expected_calls = [call('10.1.1.1', 'ticket3', 30), call('10.1.1.2', 'ticket3', 30),
-                                call('10.2.2.2', 'ticket4', 30), call('10.2.2.3', 'ticket4', 30)]
-        self.assertEqual(nginx_expected_calls, nginx_manager.add_session_ticket.call_args_list)
+        nginx_expected_calls = [call('10.1.1.1', 'ticket3', timeout=30), call('10.1.1.2', 'ticket3', timeout=30),
+                                call('10.2.2.2', 'ticket4', timeout=30), call('10.2.2.3', 'ticket4', timeout=30)]
+        self.assertItemsEqual(nginx_expected_calls, nginx_manager.add_session_ticket.call_args_list)
         error_msg = "Error renewing session ticket for instance-a: AttributeError('dns_name not defined',)"
         logging.error.assert_called_with(error_msg)
 
@@ -220,3 +221,36 @@ class SessionResumptionTestCase(unittest.TestCase):
                     "Exception('could not generate certificate',)"
         logging.error.assert_called_with(error_msg)
         nginx_manager.add_session_ticket.assert_not_called()
+
+    @patch("rpaas.tasks.logging")
+    @patch("rpaas.tasks.sslutils.generate_session_ticket")
+    @patch("rpaas.tasks.LoadBalancer")
+    @patch("rpaas.tasks.nginx")
+    def test_renew_session_tickets_report(self, nginx, load_balancer, ticket, logging):
+        self.config["SESSION_RESUMPTION_DEADLINE"] = "1"
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def add_session_ticket(host, session_ticket, timeout):
+            if host == "10.1.1.2":
+                release.wait(5)
+            elif host == "10.2.2.3":
+                raise Exception("nginx error connecting to host")
+        nginx_manager = nginx.Nginx.return_value
+        nginx_manager.add_session_ticket.side_effect = add_session_ticket
+        lb1 = LoadBalancerFake("instance-a")
+        lb2 = LoadBalancerFake("instance-b")
+        lb1.hosts = [HostFake("xxx", "instance-a", "10.1.1.1"), HostFake("yyy", "instance-a", "10.1.1.2")]
+        lb2.hosts = [HostFake("aaa", "instance-b", "10.2.2.2"), HostFake("bbb", "instance-b", "10.2.2.3")]
+        load_balancer.list.return_value = [lb1, lb2]
+        ticket.side_effect = ["ticket1", "ticket2"]
+        report = tasks.SessionResumptionTask().run(self.config)
+        self.assertEqual({"instance-a": {"rotated": ["10.1.1.1"], "failed": [], "timed_out": ["10.1.1.2"]},
+                          "instance-b": {"rotated": ["10.2.2.2"], "failed": ["10.2.2.3"], "timed_out": []}},
+                         report)
+        logging.warning.assert_any_call("Hosts of instance-a missed the new session ticket: 10.1.1.2")
+        logging.warning.assert_any_call("Hosts of instance-b missed the new session ticket: 10.2.2.3")
+        self.assertFalse(redis.StrictRedis().set("session_resumption:test_rpaas_session_resumption:instance:"
+                                                 "instance-a", "x", nx=True))
+        self.assertTrue(redis.StrictRedis().set("session_resumption:test_rpaas_session_resumption:instance:"
+                                                "instance-b", "x", nx=True))
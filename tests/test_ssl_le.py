@@ -2,9 +2,16 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
 import unittest
 import mock
 
+import pytz
+from acme import jose, messages
+from certbot import errors
+from certbot.account import Account
+
+from rpaas import sslutils
 from rpaas.ssl_plugins import le
 
 
@@ -30,3 +37,123 @@ class LETest(unittest.TestCase):
             instance = self.instance
             instance.download_crt(None)
         mock_method.assert_called_once_with(None)
+
+
+class FakeLEStorage(object):
+
+    def __init__(self):
+        self.accounts = {}
+        self.authorizations = {}
+
+    def store_le_account(self, server, email, account):
+        self.accounts[(server, email)] = account
+
+    def find_le_account(self, server, email):
+        return self.accounts.get((server, email))
+
+    def store_le_authorization(self, server, account_id, domain, authorization, expires):
+        self.authorizations[(server, account_id, domain)] = (authorization, expires)
+
+    def remove_le_authorizations(self, server, account_id, domains):
+        for domain in domains:
+            self.authorizations.pop((server, account_id, domain), None)
+
+    def find_le_authorizations(self, server, account_id, domains, valid_until):
+        found = {}
+        for domain in domains:
+            authorization, expires = self.authorizations.get((server, account_id, domain), (None, None))
+            if authorization and expires > valid_until:
+                found[domain] = authorization
+        return found
+
+
+class LEAccountStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = FakeLEStorage()
+        key = jose.JWKRSA(key=jose.ComparableRSAKey(sslutils.generate_key()))
+        regr = messages.RegistrationResource(body=messages.Registration(), uri="https://acme/reg/1",
+                                             new_authzr_uri="https://acme/new-authz")
+        self.account = Account(regr, key)
+
+    def test_save_and_load(self):
+        account_storage = le.MongoAccountStorage(self.storage, "https://acme", "admin@tsuru.io")
+        self.assertEqual([], account_storage.find_all())
+        account_storage.save(self.account)
+        self.assertEqual([self.account], account_storage.find_all())
+        self.assertEqual(self.account, account_storage.load(self.account.id))
+        with self.assertRaises(errors.AccountNotFound):
+            account_storage.load("other")
+        other = le.MongoAccountStorage(self.storage, "https://acme", "other@tsuru.io")
+        self.assertEqual([], other.find_all())
+
+    @mock.patch("rpaas.ssl_plugins.le.register")
+    @mock.patch("rpaas.ssl_plugins.le.acme_from_config_key")
+    def test_account_reuses_stored_registration(self, acme_from_config_key, register):
+        account_storage = le.MongoAccountStorage(self.storage, "https://acme", "admin@tsuru.io")
+        account_storage.save(self.account)
+        config = mock.Mock()
+        account, acme = le._account(config, account_storage)
+        self.assertEqual(self.account, account)
+        self.assertEqual(acme_from_config_key.return_value, acme)
+        acme_from_config_key.assert_called_once_with(config, self.account.key)
+        register.assert_not_called()
+
+    @mock.patch("rpaas.ssl_plugins.le.register")
+    def test_account_registers_when_missing(self, register):
+        account_storage = le.MongoAccountStorage(self.storage, "https://acme", "admin@tsuru.io")
+        config = mock.Mock()
+        self.assertEqual(register.return_value, le._account(config, account_storage))
+        register.assert_called_once_with(config, account_storage)
+
+    def _authorization(self, domain, expires):
+        return messages.AuthorizationResource(
+            uri="https://acme/authz/" + domain, new_cert_uri="https://acme/new-cert",
+            body=messages.Authorization(identifier=messages.Identifier(typ=messages.IDENTIFIER_FQDN, value=domain),
+                                        status=messages.STATUS_VALID, expires=expires))
+
+    def test_authorizations_cache(self):
+        now = datetime.datetime.now(pytz.UTC)
+        authzr = [self._authorization("a.tsuru.io", now + datetime.timedelta(days=10)),
+                  self._authorization("b.tsuru.io", now + datetime.timedelta(minutes=1))]
+        lec = mock.Mock()
+        lec.auth_handler.get_authorizations.return_value = authzr
+        domains = ["a.tsuru.io", "b.tsuru.io"]
+        self.assertIsNone(le._cached_authorizations(self.storage, "https://acme", self.account, domains))
+        self.assertEqual(authzr, le._new_authorizations(lec, self.storage, "https://acme", self.account, domains))
+        lec.auth_handler.get_authorizations.assert_called_once_with(domains)
+        self.assertIsNone(le._cached_authorizations(self.storage, "https://acme", self.account, domains))
+        cached = le._cached_authorizations(self.storage, "https://acme", self.account, ["a.tsuru.io"])
+        self.assertEqual([authzr[0].uri], [authorization.uri for authorization in cached])
+        self.assertIsNone(le._cached_authorizations(None, "https://acme", self.account, ["a.tsuru.io"]))
+
+    @mock.patch("rpaas.ssl_plugins.le.crypto_util")
+    @mock.patch("rpaas.ssl_plugins.le.OpenSSL.crypto.dump_certificate")
+    @mock.patch("rpaas.ssl_plugins.le.RpaasLeAuthenticator")
+    @mock.patch("rpaas.ssl_plugins.le.Client")
+    @mock.patch("rpaas.ssl_plugins.le._account")
+    def test_main_validates_again_when_cached_authorizations_are_refused(self, _account, Client, authenticator,
+                                                                         dump_certificate, crypto_util):
+        server = le.ConfigNamespace(None, []).server
+        domains = ["a.tsuru.io"]
+        now = datetime.datetime.now(pytz.UTC)
+        cached = self._authorization("a.tsuru.io", now + datetime.timedelta(days=10))
+        fresh = self._authorization("a.tsuru.io", now + datetime.timedelta(days=20))
+        lec = Client.return_value
+        lec.auth_handler.get_authorizations.return_value = [cached]
+        le._new_authorizations(lec, self.storage, server, self.account, domains)
+        lec.auth_handler.get_authorizations.return_value = [fresh]
+        _account.return_value = (self.account, mock.Mock())
+        certr, chain = mock.Mock(), mock.Mock()
+        lec.obtain_certificate_from_csr.side_effect = [messages.Error(detail="authorization is invalid"),
+                                                       (certr, chain)]
+        dump_certificate.return_value = "crt"
+        crypto_util.dump_pyopenssl_chain.return_value = "chain"
+        result = le._main(domains, "admin@tsuru.io", "inst", csr="csr", storage=self.storage)
+        self.assertEqual(("crt", "chain", None), result)
+        self.assertEqual(2, lec.obtain_certificate_from_csr.call_count)
+        first, second = lec.obtain_certificate_from_csr.call_args_list
+        self.assertEqual([cached.uri], [authorization.uri for authorization in first[1]["authzr"]])
+        self.assertEqual([fresh], second[1]["authzr"])
+        stored, expires = self.storage.authorizations[(server, self.account.id, "a.tsuru.io")]
+        self.assertEqual(fresh.body.expires.replace(tzinfo=None).date(), expires.date())
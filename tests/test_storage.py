@@ -9,8 +9,9 @@ import unittest
 import os
 
 import freezegun
+import pymongo
 
-from rpaas import plan, storage, flavor
+from rpaas import plan, storage, flavor, effective_config
 
 
 class MongoDBStorageTestCase(unittest.TestCase):
@@ -50,6 +51,115 @@ class MongoDBStorageTestCase(unittest.TestCase):
         self.assertEqual(used, q["used"])
         self.assertEqual(quota, q["quota"])
 
+    def test_decrement_quota(self):
+        self.storage.find_team_quota("myteam")
+        self.storage.find_team_quota("yourteam")
+        self.assertTrue(self.storage.increment_quota("myteam", [], "x"))
+        self.assertTrue(self.storage.increment_quota("yourteam", [], "y"))
+        self.storage.decrement_quota("x", "yourteam")
+        self.assertEqual(["x"], self.storage.find_team_quota("myteam")[0])
+        self.storage.decrement_quota("x", "myteam")
+        self.assertEqual([], self.storage.find_team_quota("myteam")[0])
+        self.storage.decrement_quota("y")
+        self.assertEqual([], self.storage.find_team_quota("yourteam")[0])
+
+    def test_list_healings_filters(self):
+        start_time = datetime.datetime(2016, 8, 2, 10, 53, 0)
+        for x in range(6):
+            self.storage.db[self.storage.healing_collection].insert(
+                {"instance": "instance{}".format(x % 2), "machine": "10.10.1.{}".format(x),
+                 "start_time": start_time + datetime.timedelta(minutes=x),
+                 "status": "success" if x % 3 else "failure"})
+        healings = self.storage.list_healings(10, instance="instance1")
+        self.assertEqual(["10.10.1.5", "10.10.1.3", "10.10.1.1"], [h["machine"] for h in healings])
+        healings = self.storage.list_healings(10, status="failure")
+        self.assertEqual(["10.10.1.3", "10.10.1.0"], [h["machine"] for h in healings])
+        healings = self.storage.list_healings(10, machine="10.10.1.2")
+        self.assertEqual(["10.10.1.2"], [h["machine"] for h in healings])
+        healings = self.storage.list_healings(10, since=start_time + datetime.timedelta(minutes=2),
+                                              until=start_time + datetime.timedelta(minutes=4))
+        self.assertEqual(["10.10.1.4", "10.10.1.3", "10.10.1.2"], [h["machine"] for h in healings])
+        page = self.storage.list_healings(4)
+        self.assertEqual(["10.10.1.5", "10.10.1.4", "10.10.1.3", "10.10.1.2"], [h["machine"] for h in page])
+        page = self.storage.list_healings(4, before=page[-1]["start_time"])
+        self.assertEqual(["10.10.1.1", "10.10.1.0"], [h["machine"] for h in page])
+
+    def test_list_healings_pages_equal_start_times(self):
+        start_time = datetime.datetime(2016, 8, 2, 10, 53, 0)
+        for x in range(5):
+            self.storage.db[self.storage.healing_collection].insert(
+                {"instance": "instance", "machine": "10.10.1.{}".format(x),
+                 "start_time": start_time if x < 4 else start_time - datetime.timedelta(minutes=1)})
+        seen = []
+        page = self.storage.list_healings(2)
+        while page:
+            seen.extend(h["machine"] for h in page)
+            page = self.storage.list_healings(2, before=page[-1]["start_time"], before_id=page[-1]["_id"])
+        self.assertEqual(["10.10.1.3", "10.10.1.2", "10.10.1.1", "10.10.1.0", "10.10.1.4"], seen)
+
+    def test_ensure_indexes_healing_ttl(self):
+        os.environ["RPAAS_HEALING_TTL"] = "3600"
+        self.addCleanup(os.environ.pop, "RPAAS_HEALING_TTL")
+        created = self.storage.ensure_indexes()
+        self.assertIn({"collection": "healing", "index": "start_time_1"}, created)
+        indexes = self.storage.db[self.storage.healing_collection].index_information()
+        self.assertEqual(3600, indexes["start_time_1"]["expireAfterSeconds"])
+        os.environ["RPAAS_HEALING_TTL"] = "60"
+        self.storage.ensure_indexes()
+        indexes = self.storage.db[self.storage.healing_collection].index_information()
+        self.assertEqual(60, indexes["start_time_1"]["expireAfterSeconds"])
+
+    def test_ensure_indexes_healing_ttl_replaces_end_time_index(self):
+        self.storage.db[self.storage.healing_collection].create_index([("end_time", pymongo.ASCENDING)],
+                                                                      expireAfterSeconds=3600)
+        self.storage.ensure_indexes()
+        indexes = self.storage.db[self.storage.healing_collection].index_information()
+        self.assertNotIn("end_time_1", indexes)
+        self.assertIn("start_time_1", indexes)
+
+    def test_find_purge_task(self):
+        self.storage.store_purge_task("inst1", "task-1")
+        self.assertEqual("inst1", self.storage.find_purge_task("inst1", "task-1")["instance"])
+        self.assertIsNone(self.storage.find_purge_task("inst2", "task-1"))
+        self.assertIsNone(self.storage.find_purge_task("inst1", "task-2"))
+
+    def test_store_tasks_ignores_duplicates(self):
+        self.storage.store_task({"_id": "restore_10.1.1.1", "host": "10.1.1.1"})
+        self.storage.store_tasks([{"_id": "restore_10.1.1.1", "host": "other"},
+                                  {"_id": "restore_10.2.2.2", "host": "10.2.2.2"}])
+        tasks = list(self.storage.find_task({"_id": {"$regex": "^restore_"}}).sort("_id"))
+        self.assertEqual([{"_id": "restore_10.1.1.1", "host": "10.1.1.1"},
+                          {"_id": "restore_10.2.2.2", "host": "10.2.2.2"}], tasks)
+
+    def test_find_host_dns_names(self):
+        self.storage.db[self.storage.hosts_collection].insert({"_id": 0, "dns_name": "10.1.1.1"})
+        self.storage.db[self.storage.hosts_collection].insert({"_id": 1, "dns_name": "10.2.2.2"})
+        self.assertEqual(set(["10.1.1.1"]), self.storage.find_host_dns_names(["10.1.1.1", "10.3.3.3"]))
+
+    def test_ensure_indexes(self):
+        created = self.storage.ensure_indexes()
+        self.assertIn({"collection": "tasks", "index": "created_1"}, created)
+        self.assertIn({"collection": "healing", "index": "start_time_-1__id_-1"}, created)
+        self.assertIn({"collection": "hosts", "index": "dns_name_1"}, created)
+        self.assertEqual(created, self.storage.ensure_indexes())
+        indexes = self.storage.db[self.storage.le_certificates_collection].index_information()
+        self.assertIn("created_1", indexes)
+
+    def test_index_report(self):
+        report = self.storage.index_report()
+        self.assertEqual([(query[0], query[1]) for query in self.storage.index_queries()],
+                         [(query["query"], query["collection"]) for query in report])
+        indexed = dict((query["query"], query["indexed"]) for query in report)
+        for query in ["healing history", "expiring certificates", "host by dns name", "quota owner"]:
+            self.assertFalse(indexed[query], query)
+        self.storage.ensure_indexes()
+        report = self.storage.index_report()
+        for query in report:
+            self.assertTrue(query["indexed"], query)
+            self.assertNotIn("COLLSCAN", query["stages"])
+        healing = [query for query in report if query["query"] == "healing history"][0]
+        self.assertEqual(["start_time_-1__id_-1"], healing["indexes"])
+
     def test_list_plans(self):
         plans = self.storage.list_plans()
         expected = [
@@ -106,6 +216,16 @@ class MongoDBStorageTestCase(unittest.TestCase):
         with self.assertRaises(storage.PlanNotFoundError):
             self.storage.update_plan("my_plan", description="woot")
 
+    def test_update_and_delete_plan_bump_effective_config_version(self):
+        p = plan.Plan(name="super_huge", description="very huge thing",
+                      config={"serviceofferingid": "abcdef123"})
+        self.storage.store_plan(p)
+        version = effective_config.current_version("plan", p.name)
+        self.storage.update_plan(p.name, config={"serviceofferingid": "abcdef123459"})
+        self.assertEqual(version + 1, effective_config.current_version("plan", p.name))
+        self.storage.delete_plan(p.name)
+        self.assertEqual(version + 2, effective_config.current_version("plan", p.name))
+
     def test_delete_plan(self):
         p = plan.Plan(name="super_huge", description="very huge thing",
                       config={"serviceofferingid": "abcdef123"})
@@ -231,6 +351,78 @@ class MongoDBStorageTestCase(unittest.TestCase):
         item = coll.find_one({"_id": "myinstance"})
         self.assertIsNotNone(item)
 
+    def test_store_le_account(self):
+        self.storage.store_le_account("https://acme", "admin@tsuru.io", {"account_id": "abc", "key": "{}"})
+        self.storage.store_le_account("https://acme", "admin@tsuru.io", {"account_id": "def", "key": "{}"})
+        account = self.storage.find_le_account("https://acme", "admin@tsuru.io")
+        self.assertEqual("def", account["account_id"])
+        self.assertEqual("https://acme", account["server"])
+        self.assertIsNone(self.storage.find_le_account("https://acme", "other@tsuru.io"))
+
+    def test_le_authorizations(self):
+        now = datetime.datetime.utcnow()
+        self.storage.store_le_authorization("https://acme", "abc", "a.tsuru.io", "{}",
+                                            now + datetime.timedelta(days=10))
+        self.storage.store_le_authorization("https://acme", "abc", "b.tsuru.io", "{}",
+                                            now + datetime.timedelta(hours=1))
+        self.storage.store_le_authorization("https://acme", "def", "c.tsuru.io", "{}",
+                                            now + datetime.timedelta(days=10))
+        authorizations = self.storage.find_le_authorizations("https://acme", "abc",
+                                                             ["a.tsuru.io", "b.tsuru.io", "c.tsuru.io"],
+                                                             now + datetime.timedelta(days=1))
+        self.assertEqual({"a.tsuru.io": "{}"}, authorizations)
+        self.storage.remove_le_authorizations("https://acme", "abc", ["a.tsuru.io"])
+        self.assertEqual({}, self.storage.find_le_authorizations("https://acme", "abc", ["a.tsuru.io"], now))
+
+    def test_le_renewal_state(self):
+        self.storage.store_le_certificate("myinstance", "docs.tsuru.io")
+        self.storage.schedule_le_renewals(["myinstance"])
+        since = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        self.assertEqual(1, self.storage.count_le_renewals_in_flight(since))
+        next_attempt = self.storage.fail_le_renewal("myinstance", "acme is down")
+        self.assertEqual(0, self.storage.count_le_renewals_in_flight(since))
+        cert = self.storage.db[self.storage.le_certificates_collection].find_one({"_id": "myinstance"})
+        self.assertEqual("failed", cert["renewal"]["status"])
+        self.assertEqual("acme is down", cert["renewal"]["error"])
+        self.assertEqual(1, cert["renewal"]["attempts"])
+        self.storage.fail_le_renewal("myinstance", "acme is down")
+        cert = self.storage.db[self.storage.le_certificates_collection].find_one({"_id": "myinstance"})
+        self.assertEqual(2, cert["renewal"]["attempts"])
+        self.assertGreater(cert["renewal"]["next_attempt"], next_attempt)
+        self.assertIsNone(self.storage.fail_le_renewal("otherinstance", "error"))
+        self.storage.store_le_certificate("myinstance", "docs.tsuru.io")
+        cert = self.storage.db[self.storage.le_certificates_collection].find_one({"_id": "myinstance"})
+        self.assertNotIn("renewal", cert)
+
+    def test_instance_certificates(self):
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        self.storage.store_instance_certificate("inst1", now + datetime.timedelta(days=40), source="le",
+                                                domain="i1.tsuru.io")
+        self.storage.store_instance_certificate("inst2", now + datetime.timedelta(days=5), source="upload")
+        self.storage.store_instance_certificate("inst3", None)
+        expiring = list(self.storage.find_expiring_certificates(now + datetime.timedelta(days=50)))
+        self.assertEqual(["inst2", "inst1"], [c["instance"] for c in expiring])
+        self.assertEqual("i1.tsuru.io", expiring[1]["domain"])
+        self.storage.store_instance_certificate("inst1", now + datetime.timedelta(days=90))
+        expiring = list(self.storage.find_expiring_certificates(now + datetime.timedelta(days=50)))
+        self.assertEqual(["inst2"], [c["instance"] for c in expiring])
+        cert = self.storage.db[self.storage.instance_certificates_collection].find_one({"_id": "inst1"})
+        self.assertEqual("le", cert["source"])
+        self.storage.remove_instance_certificate("inst2")
+        self.assertEqual([], list(self.storage.find_expiring_certificates(now + datetime.timedelta(days=50))))
+
+    def test_store_le_certificate_expires(self):
+        expires = datetime.datetime(2017, 3, 23, 10, 53, 0)
+        self.storage.store_le_certificate("myinstance", "docs.tsuru.io", expires)
+        item = self.storage.db[self.storage.le_certificates_collection].find_one({"_id": "myinstance"})
+        self.assertEqual(expires, item["expires"])
+
+    def test_find_instances_metadata(self):
+        self.storage.store_instance_metadata("instance1", plan_name="small")
+        self.storage.store_instance_metadata("instance2", plan_name="huge")
+        metadata = self.storage.find_instances_metadata(["instance1", "instance3"])
+        self.assertEqual({"instance1": {"_id": "instance1", "plan_name": "small"}}, metadata)
+
     def test_find_le_certificates(self):
         self.storage.store_le_certificate("myinstance", "docs.tsuru.io")
         self.storage.store_le_certificate("myinstance", "docs.tsuru.com")
@@ -269,4 +461,5 @@ class MongoDBStorageTestCase(unittest.TestCase):
             loop_time = loop_time + datetime.timedelta(minutes=5)
         expected.reverse()
         healing_list = self.storage.list_healings(3)
+        self.assertTrue(all(healing.pop("_id") for healing in healing_list))
         self.assertListEqual(healing_list, expected)